@@ -1,28 +1,28 @@
 import pandas as pd
 from web3 import Web3
 
+from tools.senders import SenderCache, resolve_senders
+
 url="http://127.0.0.1:8545" #This should really only be run against a local node
 w3 = Web3(Web3.HTTPProvider(url))
 
-def getSender(txhash):
-	try:
-		tx = w3.eth.get_transaction(txhash)
-		sender = tx['from']
-	except Exception as e:
-		sender = None
-	return sender
-
-def addSender(datafile):
+def addSender(datafile,column='msg.sender'):
+	"""
+	Fill in the sender of each event's transaction in the column msg.sender
+	Only rows without a sender are looked up, so running this again after a scan only fetches the new rows
+	Senders are cached in data/tx_senders.csv
+	"""
 	df = pd.read_csv(datafile)
 
 	if 'txhash' not in df.columns:
 		return
 
-	new_col = 'msg.sender'
-	while new_col in df.columns:
-		new_col += 'a'
-		
-	df[new_col] = df.txhash.apply(getSender)
+	if column not in df.columns:
+		df[column] = None
+
+	missing = df[column].isnull()
+	senders = resolve_senders(w3, df.loc[missing,'txhash'], cache=SenderCache())
+	df.loc[missing,column] = df.loc[missing,'txhash'].map(senders)
 	
 	df.to_csv(datafile,index=False)
 
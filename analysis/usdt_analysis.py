@@ -1,13 +1,61 @@
+import os
+import sys
+import sqlite3
 import pandas as pd
 
-#CSV columns:
-#event_name,block_number,txhash,log_index,timestamp,newAddress,amount,feeBasisPoints,maxFee,_user,_balance,_blackListedUser,contract_address
-usdt_configs = pd.read_csv("../data/usdt_configs.csv")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.sqlitestate import load_events
+from tools.blacklist import BlacklistIndex, USDT_BLACKLIST_EVENTS
+from tools.aggregatestate import load_aggregates
 
-print( usdt_configs.groupby(['event_name']).size() )
+#Frozen intervals of every blacklisted address, updated with the events scanned since the last run
+blacklist_index = BlacklistIndex("../data/usdt_blacklist.sqlite")
 
-blacklists = usdt_configs.loc[usdt_configs.event_name=='AddedBlacklist']
-unblacklists = usdt_configs.loc[usdt_configs.event_name=='RemovedBlacklist']
+#Event counts and the supply series, kept up to date by get_usdt_configs.py while it scans
+aggregates = None
+if os.path.exists("../data/usdt_aggregates.json"):
+	aggregates = load_aggregates("../data/usdt_aggregates.json")
+	if not aggregates["complete"]:
+		print( "The aggregates are incomplete, counting the events instead" )
+		aggregates = None
+if aggregates is not None:
+	print( pd.Series(aggregates["event_counts"],name='size').sort_index() )
+	supply = aggregates["supply"]["series"]
+	if supply:
+		print( f"Supply at block {supply[-1][0]} ({supply[-1][1]}): {supply[-1][2]}" )
+
+if os.path.exists("../data/usdt_configs.sqlite"):
+	#Database written by get_usdt_configs.py with outfile = "data/usdt_configs.sqlite"
+	if aggregates is None:
+		conn = sqlite3.connect("../data/usdt_configs.sqlite")
+		print( pd.read_sql_query("SELECT event_name, COUNT(*) AS size FROM events GROUP BY event_name", conn).set_index('event_name')['size'] )
+		conn.close()
+
+	blacklists = load_events("../data/usdt_configs.sqlite",event_names=['AddedBlackList'])
+	unblacklists = load_events("../data/usdt_configs.sqlite",event_names=['RemovedBlackList'])
+	#Forget the blocks a reorg rollback of the scanner may have changed since the last run, then apply the events from there
+	conn = sqlite3.connect("../data/usdt_configs.sqlite")
+	data_last_block = conn.execute("SELECT MAX(block_number) FROM events WHERE event_name IN (" + ",".join("?" * len(USDT_BLACKLIST_EVENTS)) + ")", list(USDT_BLACKLIST_EVENTS)).fetchone()[0]
+	conn.close()
+	since_block = blacklist_index.rewind( data_last_block or 0 )
+	new_events = load_events("../data/usdt_configs.sqlite",event_names=list(USDT_BLACKLIST_EVENTS),start_block=since_block)
+else:
+	#CSV columns:
+	#event_name,block_number,txhash,log_index,timestamp,newAddress,amount,feeBasisPoints,maxFee,_user,_balance,_blackListedUser,contract_address
+	usdt_configs = pd.read_csv("../data/usdt_configs.csv")
+
+	if aggregates is None:
+		print( usdt_configs.groupby(['event_name']).size() )
+
+	blacklists = usdt_configs.loc[usdt_configs.event_name=='AddedBlackList']
+	unblacklists = usdt_configs.loc[usdt_configs.event_name=='RemovedBlackList']
+	blacklist_events = usdt_configs.loc[usdt_configs.event_name.isin(list(USDT_BLACKLIST_EVENTS))]
+	since_block = blacklist_index.rewind( blacklist_events.block_number.max() if len(blacklist_events) > 0 else 0 )
+	new_events = blacklist_events.loc[blacklist_events.block_number >= since_block]
+
+blacklist_index.update( new_events.sort_values(by=['block_number','log_index']).to_dict('records') )
+blacklist_index.save()
+print( f"{len(blacklist_index.frozen_at(blacklist_index.last_block))} addresses frozen at block {blacklist_index.last_block}" )
 
 if 'msg.sender' in blacklists.columns:
 	print( blacklists.groupby(['msg.sender']).size() )	
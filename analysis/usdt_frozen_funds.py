@@ -3,9 +3,14 @@ from web3 import Web3
 import json
 import datetime
 import sys
+import os
 import progressbar
 import pandas as pd
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.sqlitestate import load_events
+from tools.balances import BalanceFetcher
+
 
 api_url = 'http://127.0.0.1:8545'
 provider = HTTPProvider(api_url) 
@@ -18,20 +23,28 @@ USDT_ABI = json.loads('[{"constant":true,"inputs":[{"name":"who","type":"address
 usdt_address = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
 usdt_contract = web3.eth.contract(address=usdt_address,abi=USDT_ABI)
 
+balance_fetcher = BalanceFetcher(web3,usdt_address)
+
 def balance_at( user, block_number ):
-	balance = usdt_contract.functions.balanceOf(user).call(block_identifier=block_number)
-	return balance
+	return balance_fetcher.balance_at(user,block_number)
 	
-#event_name,block_number,txhash,log_index,timestamp,newAddress,amount,feeBasisPoints,maxFee,_user,_balance,_blackListedUser,contract_address
-usdt_configs = pd.read_csv("../data/usdt_configs.csv")
+if os.path.exists("../data/usdt_configs.sqlite"):
+	#Database written by get_usdt_configs.py with outfile = "data/usdt_configs.sqlite", only the blacklist events are read
+	freezes = load_events("../data/usdt_configs.sqlite",event_names=['AddedBlackList'])
+else:
+	#event_name,block_number,txhash,log_index,timestamp,newAddress,amount,feeBasisPoints,maxFee,_user,_balance,_blackListedUser,contract_address
+	usdt_configs = pd.read_csv("../data/usdt_configs.csv")
 
-freezes = usdt_configs.loc[usdt_configs['event_name'] == 'AddedBlackList'].copy()
-freezes.reset_index(inplace=True)
+	freezes = usdt_configs.loc[usdt_configs['event_name'] == 'AddedBlackList'].copy()
+	freezes.reset_index(inplace=True)
 
 print( freezes.columns )
 print( freezes.head() )
 
-freezes['balance'] = freezes.apply( lambda row: balance_at(row['_user'],row['block_number']), axis=1 )
+#All balances are fetched in batches, grouped by block
+queries = list(zip(freezes['_user'],freezes['block_number']))
+balances = balance_fetcher.balances_at(queries)
+freezes['balance'] = [ balances[(user,int(block_number))] for user, block_number in queries ]
 
 freezes.to_csv( 'freezes_balances.csv' )
 
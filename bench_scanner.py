@@ -0,0 +1,136 @@
+"""
+Benchmark the event scanner against a local mock JSON-RPC node (tools/mocknode.py)
+Every backend is run in every scenario on the same synthetic chain of USDT events
+For each run we report events per second, RPC calls and bytes per 1k blocks, the time spent in end_chunk/save (checkpointing)
+and the time of each stage of the scan from the scanner's metrics
+Results are printed and appended to results_file, one JSON object per run, so they can be compared over time
+"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from web3 import Web3
+from web3.providers.rpc import HTTPProvider
+
+from tools.eventscanner import EventScanner
+from tools.blocktimes import BlockTimestampCache
+from tools.get_contract_events import make_state
+from tools.mocknode import MockChain, MockNode, USDT_ADDRESS
+from utils import get_event_args, get_event_types, get_cached_abi
+
+blocks = 20000 #Length of the synthetic chain
+logs_per_block = 2 #Average number of USDT events per block
+workers = 1 #workers > 1 benchmarks scan_parallel
+backends = { "csv": "events.csv", "sqlite": "events.sqlite", "parquet": "events.parquet", "jsonl": "events.jsonl" } #Output file per backend, make_state picks the state from the name
+scanned_events = ["Transfer","Issue","Redeem","AddedBlackList","RemovedBlackList"]
+scenarios = {
+	"local": dict(), #A node on the same machine with no limits
+	"hosted": dict(latency=0.02, max_logs=10000, max_block_range=5000, error_rate=0.02), #Round-trip latency, Infura/Alchemy style limits and some 429/503 responses
+}
+results_file = "data/bench_results.jsonl"
+
+def _timed(obj,name,totals):
+	#Wrap a method of obj so the time spent in it is added to totals[name]
+	method = getattr(obj,name)
+	totals[name] = 0.0
+	def wrapper(*args,**kwargs):
+		start = time.perf_counter()
+		try:
+			return method(*args,**kwargs)
+		finally:
+			totals[name] += time.perf_counter() - start
+	setattr(obj,name,wrapper)
+
+def run(backend,scenario,chain):
+	"""
+	Scan the whole mock chain into a fresh output of the given backend
+	Returns a dictionary of measurements
+	"""
+	node = MockNode(chain,**scenarios[scenario]).start()
+	workdir = tempfile.mkdtemp(prefix="bench_")
+	try:
+		web3 = Web3(HTTPProvider(node.url, exception_retry_configuration=None))
+		abi = get_cached_abi(USDT_ADDRESS)
+		contract = web3.eth.contract(abi=abi)
+		event_names, db_columns = get_event_args(USDT_ADDRESS,scanned_events)
+		event_types = get_event_types(USDT_ADDRESS,scanned_events)
+
+		state = make_state(os.path.join(workdir,backends[backend]),db_columns,event_types)
+		state.reset()
+		#Only end_chunk is wrapped, the saves it makes itself are counted once, the final save is timed below
+		checkpoint = {}
+		_timed(state,"end_chunk",checkpoint)
+
+		scanner = EventScanner(
+			web3=web3,
+			contract=contract,
+			state=state,
+			events=[getattr(contract.events,evt) for evt in scanned_events],
+			filters={"address": USDT_ADDRESS},
+			max_chunk_scan_size=10000,
+			request_retry_seconds=0.05,
+			single_filter=True,
+			block_timestamps=BlockTimestampCache(os.path.join(workdir,"block_timestamps.bin"))
+		)
+
+		start = time.perf_counter()
+		if workers > 1:
+			result, chunks = scanner.scan_parallel(1, chain.head, workers=workers)
+		else:
+			result, chunks = scanner.scan(1, chain.head)
+		save_start = time.perf_counter()
+		state.save()
+		checkpoint["save"] = time.perf_counter() - save_start
+		duration = time.perf_counter() - start
+		metrics = scanner.metrics.snapshot()
+	finally:
+		node.stop()
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	stats = node.stats
+	per_1k = 1000 / chain.head
+	return {
+		"time": datetime.datetime.utcnow().isoformat(),
+		"backend": backend,
+		"scenario": scenario,
+		"blocks": chain.head,
+		"events": len(result),
+		"chunks": chunks,
+		"seconds": round(duration,3),
+		"events_per_second": round(len(result) / duration,1),
+		"http_requests_per_1k_blocks": round(stats["http_requests"] * per_1k,2),
+		"rpc_calls_per_1k_blocks": round(stats["rpc_calls"] * per_1k,2),
+		"bytes_per_1k_blocks": round((stats["bytes_in"] + stats["bytes_out"]) * per_1k),
+		"rpc_errors": stats["errors"],
+		"injected_errors": stats["injected_errors"],
+		"calls": stats["calls"],
+		"checkpoint_seconds": round(sum(checkpoint.values()),3),
+		"checkpoint_share": round(sum(checkpoint.values()) / duration,3),
+		"stage_seconds": { name: round(timer["total"],3) for name, timer in metrics["timers"].items() },
+		"scanner_counters": metrics["counters"],
+	}
+
+if __name__ == '__main__':
+	chain = MockChain.synthetic(blocks=blocks,logs_per_block=logs_per_block)
+	print( f"Synthetic chain of {blocks} blocks with {len(chain.logs)} events" )
+
+	results = []
+	for scenario in scenarios:
+		for backend in backends:
+			try:
+				r = run(backend,scenario,chain)
+			except ImportError as e:
+				print( f"Skipping {backend}: {e}" )
+				continue
+			results.append(r)
+			print( f"{scenario:8} {backend:8} {r['events_per_second']:>10} events/s {r['rpc_calls_per_1k_blocks']:>8} calls/1k blocks "
+				f"{r['bytes_per_1k_blocks']:>10} bytes/1k blocks  checkpoint {r['checkpoint_seconds']}s ({r['checkpoint_share']:.0%})" )
+
+	os.makedirs(os.path.dirname(results_file), exist_ok=True)
+	with open(results_file, "a") as f:
+		for r in results:
+			f.write(json.dumps(r) + "\n")
@@ -1,22 +1,48 @@
+import os
 import pandas as pd
 
-usdc_configs = pd.read_csv("data/usdc_configs.csv")
+from tools.sqlitestate import load_events
+from tools.ledger import BalanceLedger, dataframe_event_source
+from tools.blacklist import BlacklistIndex, USDC_BLACKLIST_EVENTS
 
-blacklists = usdc_configs.loc[usdc_configs.event_name=='Blacklisted']
+#Frozen intervals of every blacklisted account, updated with the events scanned since the last run
+blacklist_index = BlacklistIndex("data/usdc_blacklist.sqlite",events=USDC_BLACKLIST_EVENTS)
 
-transfers = pd.read_csv("data/usdc_transfers.csv")
+if os.path.exists("data/usdc_configs.sqlite"):
+	#Database written by getContractEvents with outfile = "data/usdc_configs.sqlite", only the blacklist events are read
+	blacklist_events = load_events("data/usdc_configs.sqlite",event_names=list(USDC_BLACKLIST_EVENTS))
+else:
+	usdc_configs = pd.read_csv("data/usdc_configs.csv")
 
-transfers_to = transfers[transfers['to'].isin(blacklists._account)][['block_number','txhash','timestamp','value','to']].copy()
-transfers_to = transfers[['block_number','txhash','timestamp','value','to']].copy()
-transfers_to.rename({'to':'user'},axis='columns',inplace=True)
-transfers_from = transfers[transfers['from'].isin(blacklists._account)][['block_number','txhash','timestamp','value','from']].copy()
-transfers_from = transfers[['block_number','txhash','timestamp','value','to']].copy()
-transfers_from.rename({'from':'user'},axis='columns',inplace=True)
-transfers_from['value'] *= -1
+	blacklist_events = usdc_configs.loc[usdc_configs.event_name.isin(list(USDC_BLACKLIST_EVENTS))]
 
-transfers = pd.concat( [transfers_to,transfers_from] )
-transfers.sort_values(by=['user','block_number','timestamp'],inplace=True)
+blacklist_events = blacklist_events.sort_values(by=['block_number','log_index'])
+blacklists = blacklist_events.loc[blacklist_events.event_name=='Blacklisted']
+#Forget the blocks a reorg rollback of the scanner may have changed since the last run, then apply the events from there
+since_block = blacklist_index.rewind( blacklist_events.block_number.max() if len(blacklist_events) > 0 else 0 )
+blacklist_index.update( blacklist_events.loc[blacklist_events.block_number >= since_block].to_dict('records') )
+blacklist_index.save()
 
-user_balances = transfers.groupby(by=['user','block_number'])[['value']].sum().groupby(level=0).cumsum()
+#Read amounts as strings so they are not rounded to floats
+transfers = pd.read_csv("data/usdc_transfers.csv",dtype={'value':str})
+transfers.sort_values(by=['block_number','log_index'],inplace=True)
 
-print( user_balances.head() )
+#Replay every transfer with exact integer arithmetic, recording the balance of each blacklisted account at the block it was blacklisted
+#USDC mints and burns also emit Transfer events, so transfers are all the ledger needs
+#The ledger is kept in data/usdc_ledger.sqlite, so later runs only apply the new transfers.
+#Blacklistings before the blocks it had already applied are answered from its snapshots plus the transfers since them
+ledger = BalanceLedger("data/usdc_ledger.sqlite")
+queries = list(zip(blacklists._account,blacklists.block_number))
+transfers = transfers[['event_name','block_number','log_index','from','to','value']]
+balances = ledger.replay( transfers.to_dict('records'), queries=queries, events=dataframe_event_source(transfers) )
+ledger.save()
+
+blacklists = blacklists.copy()
+blacklists['balance'] = [ balances[(user,int(block_number))] for user, block_number in queries ]
+
+print( blacklists[['block_number','_account','balance']].head() )
+
+#Transfers from or to an account that was frozen at the time, checked with one lookup per transfer
+frozen_from = blacklist_index.are_frozen(list(transfers['from']),list(transfers.block_number),list(transfers.log_index))
+frozen_to = blacklist_index.are_frozen(list(transfers['to']),list(transfers.block_number),list(transfers.log_index))
+print( f"{sum(frozen_from)} transfers from and {sum(frozen_to)} transfers to a frozen account" )
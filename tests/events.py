@@ -0,0 +1,37 @@
+"""Decoded events as the scanner passes them to the states."""
+
+import datetime
+import hashlib
+
+from hexbytes import HexBytes
+
+USDT = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+
+COLUMNS = ["from", "to", "value", "amount", "_user"]
+
+def transfer(block_number, log_index=0, value=1, sender="0x0000000000000000000000000000000000000001", receiver="0x0000000000000000000000000000000000000002"):
+	return event("Transfer", block_number, log_index, {"from": sender, "to": receiver, "value": value})
+
+def event(name, block_number, log_index=0, args=None, address=USDT):
+	txhash = hashlib.sha256(f"{block_number}-{log_index}".encode()).digest()
+	return {
+		"event": name,
+		"blockNumber": block_number,
+		"logIndex": log_index,
+		"transactionHash": HexBytes(txhash),
+		"address": address,
+		"args": dict(args or {}),
+	}
+
+def block_time(block_number):
+	return datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=12 * block_number)
+
+def scan(state, first_block, last_block, per_block=1, chunk_size=1):
+	"""Feed the state the events of a range of blocks, chunk_size blocks per chunk."""
+	for chunk_start in range(first_block, last_block + 1, chunk_size):
+		chunk_end = min(chunk_start + chunk_size - 1, last_block)
+		state.start_chunk(chunk_start, chunk_end - chunk_start + 1)
+		for block_number in range(chunk_start, chunk_end + 1):
+			for log_index in range(per_block):
+				state.process_event(block_time(block_number), transfer(block_number, log_index, value=block_number * 10**18 + log_index))
+		state.end_chunk(chunk_end)
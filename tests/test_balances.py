@@ -0,0 +1,18 @@
+import pytest
+from web3 import Web3
+from web3.providers.rpc import HTTPProvider
+
+from tools.balances import BalanceFetcher, MULTICALL3_BLOCKS
+from tools.mocknode import MockChain, MockNode, USDT_ADDRESS
+
+@pytest.mark.parametrize("chain_id, multicall_block", [(1, MULTICALL3_BLOCKS[1]), (12345, None)])
+def test_multicall_deployment_of_the_chain(chain_id, multicall_block):
+	node = MockNode(MockChain([], 10), chain_id=chain_id).start()
+	try:
+		fetcher = BalanceFetcher(Web3(HTTPProvider(node.url, exception_retry_configuration=None)), USDT_ADDRESS)
+		assert fetcher.multicall_block == multicall_block
+		# Unknown chains only use eth_call batches
+		assert fetcher._multicall(20000000) == (multicall_block is not None)
+		assert not fetcher._multicall(1)
+	finally:
+		node.stop()
@@ -0,0 +1,67 @@
+import random
+
+from tools.blacklist import BlacklistIndex
+
+ADDRESSES = [ f"0x{i:040x}" for i in range(1, 11) ]
+
+def blacklist_events(seed=1, blocks=500):
+	rnd = random.Random(seed)
+	events = []
+	for block_number in range(1, blocks + 1):
+		for log_index in range(rnd.randrange(3)):
+			event_name = rnd.choice(["AddedBlackList", "RemovedBlackList", "DestroyedBlackFunds"])
+			arg = "_blackListedUser" if event_name == "DestroyedBlackFunds" else "_user"
+			events.append({"event_name": event_name, "block_number": block_number, "log_index": log_index, arg: rnd.choice(ADDRESSES[:6])})
+	return events
+
+def test_are_frozen_matches_is_frozen(tmp_path):
+	index = BlacklistIndex(str(tmp_path / "blacklist.sqlite"))
+	index.update(blacklist_events())
+
+	rnd = random.Random(2)
+	addresses = [ rnd.choice(ADDRESSES).upper().replace("0X", "0x") for i in range(5000) ]
+	block_numbers = [ rnd.randrange(0, 510) for i in range(5000) ]
+	log_indexes = [ rnd.randrange(3) for i in range(5000) ]
+
+	assert index.are_frozen(addresses, block_numbers, log_indexes) == [ index.is_frozen(*row) for row in zip(addresses, block_numbers, log_indexes) ]
+	assert index.are_frozen(addresses, block_numbers) == [ index.is_frozen(*row) for row in zip(addresses, block_numbers) ]
+	assert index.are_frozen([], []) == []
+
+def test_rewind_after_the_events_were_rolled_back(tmp_path):
+	events = blacklist_events()
+	index = BlacklistIndex(str(tmp_path / "blacklist.sqlite"))
+	index.update(events)
+	index.save()
+
+	# The scanner rolled back to block 300 and found other events in the new blocks
+	events = [ event for event in events if event["block_number"] < 300 ] + [ event for event in blacklist_events(seed=3) if event["block_number"] >= 300 ]
+	data_last_block = max(event["block_number"] for event in events if event["block_number"] < 300)
+
+	index = BlacklistIndex(str(tmp_path / "blacklist.sqlite"))
+	since_block = index.rewind(data_last_block)
+	assert since_block <= data_last_block + 1
+	index.update( event for event in events if event["block_number"] >= since_block )
+	index.save()
+
+	expected = BlacklistIndex(str(tmp_path / "expected.sqlite"))
+	expected.update(events)
+	for address in ADDRESSES:
+		assert index.intervals(address) == expected.intervals(address)
+
+def test_rewind_reapplies_the_most_recent_blocks(tmp_path):
+	events = blacklist_events()
+	index = BlacklistIndex(str(tmp_path / "blacklist.sqlite"))
+	index.update(events)
+	last_block = index.last_block
+
+	# Same last block, but a reorg may have changed the blocks before it
+	since_block = index.rewind(last_block)
+	assert since_block == last_block - index.reorg_blocks + 1
+	assert index.last_block == since_block - 1
+	index.update( event for event in events if event["block_number"] >= since_block )
+	assert index.last_block == last_block
+
+	expected = BlacklistIndex(str(tmp_path / "expected.sqlite"))
+	expected.update(events)
+	for address in ADDRESSES:
+		assert index.intervals(address) == expected.intervals(address)
@@ -0,0 +1,21 @@
+from types import SimpleNamespace
+
+from tools.blocktimes import BlockTimestampCache
+
+def web3_of_chain(chain_id):
+	return SimpleNamespace(eth=SimpleNamespace(chain_id=chain_id))
+
+def test_every_chain_has_its_own_file(tmp_path):
+	mainnet = BlockTimestampCache.for_chain(web3_of_chain(1), data_dir=str(tmp_path))
+	sepolia = BlockTimestampCache.for_chain(web3_of_chain(11155111), data_dir=str(tmp_path))
+	assert mainnet.fname != sepolia.fname
+
+	mainnet.set_many({100: 1600000000, 101: 1600000012})
+	assert mainnet.get_many([100, 101]) == {100: 1600000000, 101: 1600000012}
+	assert sepolia.get_many([100, 101]) == {}
+
+def test_invalidate(tmp_path):
+	cache = BlockTimestampCache(str(tmp_path / "timestamps.bin"))
+	cache.set_many({5: 50, 6: 60, 7: 70})
+	cache.invalidate(6, 10)
+	assert cache.get_many([5, 6, 7]) == {5: 50}
@@ -0,0 +1,174 @@
+import os
+
+import pytest
+from eth_utils import keccak
+from web3 import Web3
+from web3.providers.rpc import HTTPProvider
+
+from tools.eventscanner import EventScanner
+from tools.blocktimes import BlockTimestampCache
+from tools.get_contract_events import make_state, _run_scan, _scan_contracts
+from tools.mocknode import MockChain, MockNode, USDT_ADDRESS
+from utils import get_cached_abi, get_event_args, get_event_types
+
+SCANNED_EVENTS = ["Transfer", "Issue", "Redeem", "AddedBlackList", "RemovedBlackList"]
+
+@pytest.fixture
+def node():
+	node = MockNode(MockChain.synthetic(blocks=300, logs_per_block=1)).start()
+	yield node
+	node.stop()
+
+def make_scanner(node, tmp_path, outfile):
+	web3 = Web3(HTTPProvider(node.url, exception_retry_configuration=None))
+	contract = web3.eth.contract(abi=get_cached_abi(USDT_ADDRESS))
+	event_names, db_columns = get_event_args(USDT_ADDRESS, SCANNED_EVENTS)
+	state = make_state(str(tmp_path / outfile), db_columns, get_event_types(USDT_ADDRESS, SCANNED_EVENTS))
+	state.restore()
+	scanner = EventScanner(
+		web3=web3,
+		contract=contract,
+		state=state,
+		events=[getattr(contract.events, evt) for evt in SCANNED_EVENTS],
+		filters={"address": USDT_ADDRESS},
+		single_filter=True,
+		block_timestamps=BlockTimestampCache(str(tmp_path / "block_timestamps.bin")))
+	return scanner, state
+
+@pytest.mark.parametrize("outfile", ["events.csv", "events.sqlite", "events.jsonl", "events.parquet"])
+@pytest.mark.parametrize("workers", [1, 4])
+def test_scan_the_same_head_twice(node, tmp_path, outfile, workers):
+	scanner, state = make_scanner(node, tmp_path, outfile)
+	_run_scan(scanner, state, 1, workers)
+	assert state.get_last_scanned_block() == node.chain.head - 1
+
+	# Cron style rerun before a new block is mined
+	scanner, state = make_scanner(node, tmp_path, outfile)
+	_run_scan(scanner, state, 1, workers)
+	assert state.get_last_scanned_block() == node.chain.head - 1
+
+	# And once one is
+	node.chain.head += 1
+	scanner, state = make_scanner(node, tmp_path, outfile)
+	_run_scan(scanner, state, 1, workers)
+	assert state.get_last_scanned_block() == node.chain.head - 1
+
+OTHER_ADDRESS = "0x0000000000000000000000000000000000000Abc"
+
+def two_contract_chain(blocks):
+	"""Logs of USDT and of a second contract with the same events, log indexes numbered per block."""
+	logs = MockChain.synthetic(blocks=blocks, logs_per_block=1).logs + MockChain.synthetic(blocks=blocks, logs_per_block=1, seed=2, address=OTHER_ADDRESS).logs
+	logs.sort(key=lambda log: int(log["blockNumber"], 16))
+	log_index = {}
+	for log in logs:
+		log_index[log["blockNumber"]] = log_index.get(log["blockNumber"], -1) + 1
+		log["logIndex"] = hex(log_index[log["blockNumber"]])
+	return MockChain(logs, blocks)
+
+def scan_contracts(node, tmp_path, addresses):
+	web3 = Web3(HTTPProvider(node.url, exception_retry_configuration=None))
+	event_names, db_columns = get_event_args(USDT_ADDRESS, SCANNED_EVENTS)
+	states = {}
+	events_by_address = {}
+	for address in addresses:
+		contract = web3.eth.contract(address=Web3.to_checksum_address(address), abi=get_cached_abi(USDT_ADDRESS))
+		states[contract.address] = make_state(str(tmp_path / f"{address}.csv"), db_columns, None)
+		events_by_address[contract.address] = [getattr(contract.events, evt) for evt in SCANNED_EVENTS]
+	_scan_contracts(web3, states, events_by_address, 1, BlockTimestampCache(str(tmp_path / "block_timestamps.bin")))
+	return states
+
+def stored_logs(state):
+	df = state.get_dataframe()
+	return sorted(zip(df['block_number'], df['txhash']))
+
+def expected_logs(chain, address, last_block):
+	return sorted( (int(log["blockNumber"], 16), log["transactionHash"][2:]) for log in chain.logs
+		if log["address"] == address and int(log["blockNumber"], 16) <= last_block )
+
+def test_add_a_contract_to_a_joint_scan(tmp_path):
+	chain = two_contract_chain(400)
+	chain.head = 300
+	node = MockNode(chain).start()
+	try:
+		states = scan_contracts(node, tmp_path, [USDT_ADDRESS])
+		assert stored_logs(states[USDT_ADDRESS]) == expected_logs(chain, USDT_ADDRESS, 299)
+
+		# The new contract is scanned on its own up to block 299, then there is nothing left for the joint scan
+		states = scan_contracts(node, tmp_path, [USDT_ADDRESS, OTHER_ADDRESS])
+		other = Web3.to_checksum_address(OTHER_ADDRESS)
+		assert states[other].get_last_scanned_block() == 299
+		assert stored_logs(states[USDT_ADDRESS]) == expected_logs(chain, USDT_ADDRESS, 299)
+		assert stored_logs(states[other]) == expected_logs(chain, OTHER_ADDRESS, 299)
+
+		# New blocks are scanned for both contracts together
+		chain.head = 400
+		states = scan_contracts(node, tmp_path, [USDT_ADDRESS, OTHER_ADDRESS])
+		for address, state in states.items():
+			assert state.get_last_scanned_block() == 399
+		assert stored_logs(states[USDT_ADDRESS]) == expected_logs(chain, USDT_ADDRESS, 399)
+		assert stored_logs(states[other]) == expected_logs(chain, OTHER_ADDRESS, 399)
+	finally:
+		node.stop()
+
+class ForkedChain(MockChain):
+	"""A chain that replaced its blocks from fork_block on with the ones of another chain."""
+
+	def __init__(self, chain, fork, fork_block):
+		self.fork_block = fork_block
+		logs = [log for log in chain.logs if int(log["blockNumber"], 16) < fork_block]
+		for log in fork.logs:
+			if int(log["blockNumber"], 16) >= fork_block:
+				logs.append(dict(log, blockHash=self.get_block_hash(int(log["blockNumber"], 16))))
+		super().__init__(logs, chain.head)
+
+	def get_block_hash(self, block_number):
+		return "0x" + keccak(b"fork" + block_number.to_bytes(32, "big")).hex()
+
+	def get_block(self, block_number):
+		block = super().get_block(block_number)
+		if block is not None and block_number >= self.fork_block:
+			block["hash"] = self.get_block_hash(block_number)
+		return block
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_reorg_after_the_oldest_unfinalized_block(tmp_path, workers):
+	chain = MockChain.synthetic(blocks=310, logs_per_block=1)
+	chain.head = 300
+	node = MockNode(chain).start()
+	try:
+		scanner, state = make_scanner(node, tmp_path, "events.csv")
+		_run_scan(scanner, state, 1, workers)
+		# The hash of every block after the finalized one, not only of the last one of each chunk
+		assert sorted(state.get_block_hashes()) == list(range(node.chain.head - 64 + 1, node.chain.head))
+
+		# Blocks from 280 on are replaced, the node moves on
+		node.chain = ForkedChain(chain, MockChain.synthetic(blocks=310, logs_per_block=1, seed=2), 280)
+		node.chain.head = 310
+		scanner, state = make_scanner(node, tmp_path, "events.csv")
+		assert scanner.find_fork_point() == 280
+		_run_scan(scanner, state, 1, workers)
+		assert stored_logs(state) == expected_logs(node.chain, USDT_ADDRESS, 309)
+	finally:
+		node.stop()
+
+class ReorgWhileFetchingChain(ForkedChain):
+	"""A chain that serves the logs of the old fork once, when they are asked for the forked blocks."""
+
+	def __init__(self, chain, fork, fork_block):
+		super().__init__(chain, fork, fork_block)
+		self.old = chain
+
+	def get_logs(self, from_block, to_block, *args, **kwargs):
+		if self.old is not None and to_block >= self.fork_block:
+			old, self.old = self.old, None
+			return old.get_logs(from_block, to_block, *args, **kwargs)
+		return super().get_logs(from_block, to_block, *args, **kwargs)
+
+def test_reorg_while_fetching_a_chunk(node, tmp_path):
+	node.chain = ReorgWhileFetchingChain(node.chain, MockChain.synthetic(blocks=300, logs_per_block=1, seed=2), 280)
+	scanner, state = make_scanner(node, tmp_path, "events.csv")
+	_run_scan(scanner, state, 1, 1)
+	assert node.chain.old is None
+	assert scanner.metrics.counters.get(("reorgs_while_fetching", ()))
+	assert stored_logs(state) == expected_logs(node.chain, USDT_ADDRESS, 299)
+	assert state.get_block_hashes()[299] == node.chain.get_block_hash(299)
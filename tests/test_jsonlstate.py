@@ -0,0 +1,109 @@
+import os
+
+from tools.jsonlstate import JSONLinesState, _seek_block, read_events
+
+from events import scan
+
+def make_state(tmp_path, segment_bytes=64 * 1024 * 1024):
+	state = JSONLinesState(root=str(tmp_path / "events.jsonl"), segment_bytes=segment_bytes)
+	state.restore()
+	return state
+
+def stored_blocks(state):
+	return [ event["block_number"] for event in read_events(state.root) ]
+
+def test_seek_block(tmp_path):
+	state = make_state(tmp_path)
+	# Blocks 2, 4, ..., 40 with three events each
+	for block_number in range(2, 41, 2):
+		scan(state, block_number, block_number, per_block=3)
+	state.save()
+	first, last, fname, size = state.segments[0]
+	with open(os.path.join(state.root, fname), "rb") as f:
+		lines = f.readlines()
+	offsets = [ sum(len(line) for line in lines[:i]) for i in range(len(lines)) ]
+
+	with open(os.path.join(state.root, fname), "rb") as f:
+		assert _seek_block(f, size, 0) == 0
+		assert _seek_block(f, size, 2) == 0
+		assert _seek_block(f, size, 3) == offsets[3]
+		assert _seek_block(f, size, 4) == offsets[3]
+		assert _seek_block(f, size, 40) == offsets[-3]
+		assert _seek_block(f, size, 41) == size
+		for block_number in range(1, 42):
+			expected = next((offset for offset, line in zip(offsets, lines) if int(line.split(b'"block_number": ')[1].split(b",")[0]) >= block_number), size)
+			assert _seek_block(f, size, block_number) == expected
+
+def test_rollback_of_the_last_scanned_block(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 10, 11)
+	state.save()
+	state.delete_data(11)
+	assert state.get_last_scanned_block() == 10
+	assert stored_blocks(state) == [10]
+
+def test_rollback_across_segment_boundaries(tmp_path):
+	# Small segments of three blocks
+	state = make_state(tmp_path, segment_bytes=2000)
+	for block_number in range(1, 31):
+		scan(state, block_number, block_number, per_block=2)
+		state.save()
+	assert len(state.segments) > 3
+	boundaries = [ first for first, last, fname, size in state.segments ]
+
+	# Rolling back to the first block of a segment removes it and every later one
+	since = boundaries[2]
+	state.delete_data(since)
+	assert [ first for first, last, fname, size in state.segments ] == boundaries[:2]
+	assert sorted(os.listdir(state.root)) == sorted([ fname for first, last, fname, size in state.segments ] + ["_checkpoint.json"])
+	assert stored_blocks(state) == [ b for b in range(1, since) for i in range(2) ]
+
+	# Rolling back inside a segment truncates it
+	since = boundaries[1] + 1
+	state.delete_data(since)
+	assert stored_blocks(state) == [ b for b in range(1, since) for i in range(2) ]
+
+	state = make_state(tmp_path, segment_bytes=2000)
+	assert state.get_last_scanned_block() == since - 1
+	scan(state, since, 40, per_block=2)
+	state.save()
+	assert stored_blocks(state) == [ b for b in range(1, 41) for i in range(2) ]
+	assert list(read_events(state.root, start_block=20, end_block=21)) == [ e for e in read_events(state.root) if 20 <= e["block_number"] <= 21 ]
+
+def test_restore_after_a_crash_with_extra_bytes(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 10)
+	state.save()
+	first, last, fname, size = state.segments[-1]
+
+	# A crash while appending, after the write and before the checkpoint
+	with open(os.path.join(state.root, fname), "ab") as f:
+		f.write(b'{"block_number": 11, "log_index": 0, "event_na')
+	with open(os.path.join(state.root, "000000000012.jsonl"), "wb") as f:
+		f.write(b'{"block_number": 12}\n')
+
+	state = make_state(tmp_path)
+	assert os.path.getsize(os.path.join(state.root, fname)) == size
+	assert not os.path.exists(os.path.join(state.root, "000000000012.jsonl"))
+	assert state.get_last_scanned_block() == 10
+	scan(state, 11, 12)
+	state.save()
+	assert stored_blocks(state) == list(range(1, 13))
+
+def test_restore_after_a_crash_with_a_truncated_segment(tmp_path):
+	state = make_state(tmp_path, segment_bytes=1000)
+	for block_number in range(1, 21):
+		scan(state, block_number, block_number)
+		state.save()
+	assert len(state.segments) > 2
+	first, last, fname, size = state.segments[1]
+
+	# A segment cut short outside of the scanner, e.g. a rollback that crashed before writing the checkpoint
+	os.truncate(os.path.join(state.root, fname), size // 2)
+
+	state = make_state(tmp_path, segment_bytes=1000)
+	assert state.get_last_scanned_block() == first - 1
+	assert stored_blocks(state) == list(range(1, first))
+	scan(state, first, 25)
+	state.save()
+	assert stored_blocks(state) == list(range(1, 26))
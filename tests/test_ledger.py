@@ -0,0 +1,43 @@
+import pandas as pd
+
+from tools.ledger import BalanceLedger, dataframe_event_source
+
+A = "0x00000000000000000000000000000000000000aa"
+B = "0x00000000000000000000000000000000000000bb"
+
+def transfers():
+	return pd.DataFrame([
+		{"event_name": "Transfer", "block_number": 1, "log_index": 0, "from": B, "to": A, "value": "10"},
+		{"event_name": "Transfer", "block_number": 5, "log_index": 0, "from": B, "to": A, "value": "10"},
+		{"event_name": "Transfer", "block_number": 7, "log_index": 3, "from": B, "to": A, "value": "10"},
+		{"event_name": "Transfer", "block_number": 250, "log_index": 1, "from": A, "to": B, "value": "5"},
+	])
+
+def run(fname, snapshot_interval):
+	df = transfers()
+	ledger = BalanceLedger(fname, snapshot_interval=snapshot_interval)
+	balances = ledger.replay(df.to_dict('records'), queries=[(A, 1), (A, 5), (A, 7), (A, 100), (A, 300)], events=dataframe_event_source(df))
+	ledger.save()
+	ledger.conn.close()
+	return balances
+
+def test_historical_queries_are_the_same_on_every_run(tmp_path):
+	for snapshot_interval in (3, 100000):
+		fname = str(tmp_path / f"ledger_{snapshot_interval}.sqlite")
+		expected = {(A, 1): 10, (A, 5): 20, (A, 7): 30, (A, 100): 30, (A, 300): 25}
+		assert run(fname, snapshot_interval) == expected
+		assert run(fname, snapshot_interval) == expected
+
+def test_continue_from_the_last_block(tmp_path):
+	fname = str(tmp_path / "ledger.sqlite")
+	df = transfers()
+	ledger = BalanceLedger(fname)
+	ledger.replay(df.iloc[:2].to_dict('records'))
+	ledger.save()
+
+	ledger = BalanceLedger(fname)
+	assert ledger.last_block == 5
+	answers = ledger.replay(df.to_dict('records'), queries=[(A, 1), (A, 7)], events=dataframe_event_source(df))
+	assert answers == {(A, 1): 10, (A, 7): 30}
+	assert ledger.balances[A] == 25
+	assert ledger.balances[B] == -25
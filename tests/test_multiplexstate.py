@@ -0,0 +1,56 @@
+import pandas as pd
+
+from tools.scannerstate import TabularState
+from tools.multiplexstate import MultiplexState
+
+from events import COLUMNS, block_time, event
+
+USDT = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+USDC = "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48"
+
+def make_states(tmp_path):
+	states = {}
+	for name, address in [("usdt", USDT), ("usdc", USDC)]:
+		states[address] = TabularState(fname=str(tmp_path / f"{name}.csv"), columns=COLUMNS)
+		states[address].restore()
+	return states
+
+def scan(state, first_block, last_block, addresses):
+	"""One event of every contract in every block, one chunk per block."""
+	for block_number in range(first_block, last_block + 1):
+		state.start_chunk(block_number, 1)
+		for log_index, address in enumerate(addresses):
+			state.process_event(block_time(block_number), event("Transfer", block_number, log_index, {"value": block_number}, address=address))
+		state.record_block_hash(block_number, f"0x{block_number:064x}")
+		state.end_chunk(block_number)
+
+def stored_blocks(state):
+	state.save()
+	return list(pd.read_csv(state.fname)['block_number'])
+
+def test_each_contract_only_gets_the_blocks_it_has_not_scanned(tmp_path):
+	states = make_states(tmp_path)
+	scan(states[USDT], 1, 20, [USDT])
+	state = MultiplexState(states)
+	assert state.get_last_scanned_block() == 0
+
+	scan(state, 1, 25, [USDT, USDC])
+
+	assert stored_blocks(states[USDT]) == list(range(1, 26))
+	assert stored_blocks(states[USDC]) == list(range(1, 26))
+	assert state.get_last_scanned_block() == 25
+	assert sorted(state.get_block_hashes()) == list(range(1, 26))
+
+def test_rollback_only_touches_the_contracts_that_scanned_the_blocks(tmp_path):
+	states = make_states(tmp_path)
+	scan(states[USDT], 1, 20, [USDT])
+	scan(states[USDC], 1, 10, [USDC])
+	state = MultiplexState(states)
+
+	state.delete_data(15)
+	assert states[USDT].get_last_scanned_block() == 14
+	assert states[USDC].get_last_scanned_block() == 10
+
+	state.delete_data(8)
+	assert stored_blocks(states[USDT]) == list(range(1, 8))
+	assert stored_blocks(states[USDC]) == list(range(1, 8))
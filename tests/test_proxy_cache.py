@@ -0,0 +1,50 @@
+from web3 import Web3
+
+import utils
+
+ADDRESS = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+
+class FakeEth:
+	def __init__(self, block_number, upgrades=()):
+		self.block_number = block_number
+		self.upgrades = list(upgrades)
+		self.get_logs_calls = []
+
+	def get_logs(self, params):
+		self.get_logs_calls.append(params)
+		return [ block for block in self.upgrades if params["fromBlock"] <= block <= params["toBlock"] ]
+
+class FakeWeb3:
+	to_hex = staticmethod(Web3.to_hex)
+	keccak = staticmethod(Web3.keccak)
+
+	def __init__(self, eth):
+		self.eth = eth
+
+def test_clean_checks_advance_the_cached_block(tmp_path, monkeypatch):
+	monkeypatch.setattr(utils, "_proxy_dir", str(tmp_path))
+	utils._write_proxy_cache(ADDRESS, {"implementation": ADDRESS, "beacon": None, "block": 100})
+	eth = FakeEth(block_number=150)
+
+	assert utils.get_proxy_address(FakeWeb3(eth), ADDRESS) == ADDRESS
+	assert eth.get_logs_calls[-1]["fromBlock"] == 101
+	assert eth.get_logs_calls[-1]["toBlock"] == 150
+	assert utils._read_proxy_cache(ADDRESS)["block"] == 150
+
+	# The next check only covers the new blocks
+	eth.block_number = 160
+	utils.get_proxy_address(FakeWeb3(eth), ADDRESS)
+	assert (eth.get_logs_calls[-1]["fromBlock"], eth.get_logs_calls[-1]["toBlock"]) == (151, 160)
+	assert utils._read_proxy_cache(ADDRESS)["block"] == 160
+
+	# No new blocks, no call
+	utils.get_proxy_address(FakeWeb3(eth), ADDRESS)
+	assert len(eth.get_logs_calls) == 2
+
+def test_an_upgrade_keeps_the_cached_block(tmp_path, monkeypatch):
+	monkeypatch.setattr(utils, "_proxy_dir", str(tmp_path))
+	utils._write_proxy_cache(ADDRESS, {"implementation": ADDRESS, "beacon": None, "block": 100})
+	eth = FakeEth(block_number=150, upgrades=[120])
+
+	assert utils._upgraded_since(FakeWeb3(eth), utils._read_proxy_cache(ADDRESS), ADDRESS)
+	assert utils._read_proxy_cache(ADDRESS)["block"] == 100
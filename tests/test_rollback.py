@@ -0,0 +1,42 @@
+"""Rolling back a reorg in every state that stores events."""
+
+import pandas as pd
+import pytest
+
+from tools.scannerstate import TabularState
+from tools.parquetstate import ParquetState, read_events
+from tools.sqlitestate import SQLiteState, load_events
+
+from events import COLUMNS, scan
+
+EVENT_TYPES = {"Transfer": [("from", "address"), ("to", "address"), ("value", "uint256")]}
+
+def tabular(tmp_path):
+	state = TabularState(fname=str(tmp_path / "events.csv"), columns=COLUMNS)
+	return state, lambda: list(state.get_dataframe()['block_number'])
+
+def parquet(tmp_path):
+	state = ParquetState(str(tmp_path / "events"), EVENT_TYPES)
+	return state, lambda: list(read_events(state.root, "Transfer")['block_number'])
+
+def sqlite(tmp_path):
+	state = SQLiteState(str(tmp_path / "events.sqlite"), EVENT_TYPES)
+	return state, lambda: list(load_events(state.fname)['block_number'])
+
+@pytest.mark.parametrize("make_state", [tabular, parquet, sqlite])
+def test_rollback_of_the_last_scanned_block(tmp_path, make_state):
+	state, stored_blocks = make_state(tmp_path)
+	state.restore()
+	scan(state, 10, 11)
+	state.save()
+
+	# find_fork_point returns the first block after the common ancestor, here the last scanned block
+	state.delete_data(11)
+	assert state.get_last_scanned_block() == 10
+	assert 11 not in state.get_block_hashes()
+	state.save()
+	assert stored_blocks() == [10]
+
+	scan(state, 11, 12)
+	state.save()
+	assert stored_blocks() == [10, 11, 12]
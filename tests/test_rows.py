@@ -0,0 +1,68 @@
+from tools.rows import event_row, to_int, BASE_COLUMNS
+from tools.scannerstate import TabularState
+from tools.jsonlstate import JSONLinesState, read_events
+from tools.aggregatestate import AggregatingState, default_aggregates, load_aggregates
+
+from events import COLUMNS, block_time, event
+
+def test_event_row():
+	row = event_row(block_time(5), event("Params", 5, 2, {"timestamp": 1, "data": b"\x01\xff", "amount": 10**30}))
+	assert list(row) == BASE_COLUMNS + ["data", "amount"]
+	assert row["timestamp"] == block_time(5).isoformat()
+	assert row["data"] == "0x01ff"
+	assert row["amount"] == 10**30
+
+def test_to_int():
+	assert to_int(10**30) == 10**30
+	assert to_int(str(10**30)) == 10**30
+	assert to_int("10030614670.0") == 10030614670
+	assert to_int(5.0) == 5
+
+def test_states_store_the_same_row(tmp_path):
+	issue = event("Issue", 7, 1, {"amount": 10**20})
+	tabular = TabularState(fname=str(tmp_path / "events.csv"), columns=COLUMNS)
+	tabular.restore()
+	jsonl = JSONLinesState(root=str(tmp_path / "events.jsonl"))
+	jsonl.restore()
+	for state in [tabular, jsonl]:
+		state.start_chunk(7, 1)
+		state.process_event(block_time(7), issue)
+		state.end_chunk(7)
+	jsonl.save()
+
+	expected = event_row(block_time(7), issue)
+	assert list(read_events(jsonl.root)) == [expected]
+	stored = tabular.get_dataframe().iloc[0]
+	assert { col: stored[col] for col in expected } == { **expected, "amount": float(10**20) }
+
+def test_supply_starts_from_the_initial_supply(tmp_path):
+	inner = TabularState(fname=str(tmp_path / "events.csv"), columns=COLUMNS)
+	state = AggregatingState(inner, str(tmp_path / "aggregates.json"), aggregates=default_aggregates(100 * 10**6))
+	state.restore()
+	state.start_chunk(1, 2)
+	state.process_event(block_time(1), event("Issue", 1, 0, {"amount": 5 * 10**6}))
+	state.process_event(block_time(2), event("Redeem", 2, 0, {"amount": 2 * 10**6}))
+	state.end_chunk(2)
+
+	supply = load_aggregates(state.fname)["supply"]
+	assert supply["supply"] == 103 * 10**6
+	assert [ (block_number, amount) for block_number, timestamp, amount in supply["series"] ] == [ (1, 105 * 10**6), (2, 103 * 10**6) ]
+
+def test_failed_sender_lookups_make_the_aggregates_incomplete(tmp_path):
+	inner = TabularState(fname=str(tmp_path / "events.csv"), columns=COLUMNS)
+	failed = event("Issue", 2, 0)["transactionHash"].hex()
+	# Like resolve_senders when the batch of a transaction failed
+	senders = lambda txhashes: { txhash: None if txhash == failed else "0xSender" for txhash in txhashes }
+	state = AggregatingState(inner, str(tmp_path / "aggregates.json"), senders=senders)
+	state.restore()
+	state.start_chunk(1, 1)
+	state.process_event(block_time(1), event("Issue", 1, 0, {"amount": 5}))
+	state.end_chunk(1)
+	assert load_aggregates(state.fname)["complete"]
+
+	state.start_chunk(2, 1)
+	state.process_event(block_time(2), event("Issue", 2, 0, {"amount": 5}))
+	state.end_chunk(2)
+	aggregates = load_aggregates(state.fname)
+	assert aggregates["sender_counts"] == {"Issue": {"0xSender": 1}}
+	assert not aggregates["complete"]
@@ -0,0 +1,136 @@
+import os
+
+import pandas as pd
+
+from tools.scannerstate import TabularState
+
+from events import COLUMNS, scan
+
+def make_state(tmp_path, name="events.csv"):
+	state = TabularState(fname=str(tmp_path / name), columns=COLUMNS)
+	state.restore()
+	return state
+
+def blocks_in_file(state):
+	return list(pd.read_csv(state.fname)['block_number'])
+
+def test_restore_after_the_csv_was_rewritten_with_a_new_column(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 20)
+	state.save()
+
+	# add_sender.py rewrites the whole csv with an extra column, so it is larger than the checkpoint offset
+	df = pd.read_csv(state.fname)
+	df['msg.sender'] = "0x0000000000000000000000000000000000000003"
+	df.to_csv(state.fname, index=False)
+	size = os.path.getsize(state.fname)
+
+	state = make_state(tmp_path)
+	assert os.path.getsize(state.fname) == size
+	assert state.get_last_scanned_block() == 20
+	assert list(state.get_dataframe()['msg.sender'].unique()) == ["0x0000000000000000000000000000000000000003"]
+
+	scan(state, 21, 25)
+	state.save()
+	df = pd.read_csv(state.fname)
+	assert list(df['block_number']) == list(range(1, 26))
+	assert df['msg.sender'].isnull().sum() == 5
+
+def test_every_chunk_is_checkpointed(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 10)
+	# No save, a crash here loses nothing
+	state = make_state(tmp_path)
+	assert state.get_last_scanned_block() == 10
+	assert blocks_in_file(state) == list(range(1, 11))
+
+def test_append_after_an_unloaded_restore(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 10, per_block=2)
+
+	state = make_state(tmp_path)
+	assert state.state['blocks'] is None
+	scan(state, 11, 15, per_block=2)
+	assert state.state['blocks'] is None
+
+	df = pd.read_csv(state.fname)
+	assert list(df['block_number']) == [ b for b in range(1, 16) for i in range(2) ]
+	assert list(df['value']) == [ b * 10**18 + i for b in range(1, 16) for i in range(2) ]
+	assert state.get_dataframe().shape[0] == 30
+
+def test_rollback_inside_the_last_segment(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 10)
+	scan(state, 11, 15, chunk_size=5)
+
+	state = make_state(tmp_path)
+	state.delete_data(13)
+	# Only the last save was read and written back, the table is still not loaded
+	assert state.state['blocks'] is None
+	assert state.get_last_scanned_block() == 12
+	assert blocks_in_file(state) == list(range(1, 13))
+
+	scan(state, 13, 14)
+	state = make_state(tmp_path)
+	assert blocks_in_file(state) == list(range(1, 15))
+	assert state.get_last_scanned_block() == 14
+
+def test_rollback_before_the_oldest_segment(tmp_path):
+	state = make_state(tmp_path)
+	state.max_segments = 3
+	scan(state, 1, 10)
+
+	state = make_state(tmp_path)
+	state.max_segments = 3
+	# The saves of blocks 1-7 are forgotten, the whole file is rewritten
+	state.delete_data(4)
+	assert state.get_last_scanned_block() == 3
+	assert blocks_in_file(state) == [1, 2, 3]
+
+	scan(state, 4, 5)
+	assert blocks_in_file(make_state(tmp_path)) == [1, 2, 3, 4, 5]
+
+def test_rollback_after_the_csv_was_rewritten_with_a_new_column(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 20)
+	df = pd.read_csv(state.fname)
+	df['msg.sender'] = "0x0000000000000000000000000000000000000003"
+	df.to_csv(state.fname, index=False)
+
+	# The checkpoint does not match the rewritten file, the table is read in full
+	state = make_state(tmp_path)
+	assert state.state['blocks'] is not None
+	state.delete_data(18)
+	assert state.get_last_scanned_block() == 17
+
+	state = make_state(tmp_path)
+	df = state.get_dataframe()
+	assert list(df['block_number']) == list(range(1, 18))
+	assert list(df['msg.sender'].unique()) == ["0x0000000000000000000000000000000000000003"]
+
+def test_restore_drops_rows_appended_after_the_checkpoint(tmp_path):
+	state = make_state(tmp_path)
+	scan(state, 1, 10)
+	size = os.path.getsize(state.fname)
+
+	# A crash after appending rows but before writing the checkpoint
+	with open(state.fname, "at") as f:
+		f.write("Transfer,11,0xabc,0,2020-01-01T00:02:12\n")
+
+	state = make_state(tmp_path)
+	assert os.path.getsize(state.fname) == size
+	assert state.get_last_scanned_block() == 10
+
+def test_chunks_are_fsynced_every_sync_every_chunks(tmp_path, monkeypatch):
+	synced = []
+	monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd))
+	state = make_state(tmp_path)
+	state.sync_every = 10
+	scan(state, 1, 25)
+	# The csv and the checkpoint, after chunks 10 and 20
+	assert len(synced) == 4
+	state.save()
+	assert len(synced) == 6
+
+	# Unsynced chunks are checkpointed all the same
+	assert make_state(tmp_path).get_last_scanned_block() == 25
@@ -0,0 +1,344 @@
+"""Aggregates of the scanned events, kept up to date as the scan goes.
+
+`AggregatingState` wraps the state that stores the events. Every event it passes on is also held
+until the scanner ends its chunk, then applied to a list of aggregates, and the aggregates are written
+to a small JSON file that dashboards read with `load_aggregates` instead of going over all the events.
+
+The events of the most recent `journal_blocks` blocks are kept in a journal,
+so when the scanner deletes the blocks of a chain reorganisation their updates are reverted.
+Older blocks are final: when they are scanned again, e.g. because the wrapped state
+had not saved them before a crash, their events are already counted and are skipped.
+
+Aggregates:
+
+* EventCounts: number of events by event name
+* SenderCounts: number of events by the sender of their transaction, e.g. blacklistings by owner address
+* SupplySeries: total supply after every block that changed it, from USDT Issue, Redeem and DestroyedBlackFunds
+"""
+
+from .eventscanner import EventScannerState
+from .scannerstate import write_json_atomic
+from .rows import event_row, to_int
+
+import datetime
+import json
+import logging
+from typing import Callable, Dict, List, Optional
+
+from web3.datastructures import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+class EventCounts:
+	"""Number of events by event name."""
+
+	name = "event_counts"
+	needs_senders = False
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.counts = {}
+
+	def apply(self, row):
+		self.counts[row["event_name"]] = self.counts.get(row["event_name"], 0) + 1
+
+	def revert(self, rows, since_block):
+		for row in rows:
+			self.counts[row["event_name"]] -= 1
+			if self.counts[row["event_name"]] == 0:
+				del self.counts[row["event_name"]]
+
+	def to_dict(self):
+		return self.counts
+
+	def load(self, data):
+		self.counts = dict(data)
+
+class SenderCounts:
+	"""Number of events by event name and the sender of their transaction (msg.sender)."""
+
+	name = "sender_counts"
+	needs_senders = True
+
+	def __init__(self, event_names=("AddedBlackList", "RemovedBlackList", "DestroyedBlackFunds", "Issue", "Redeem")):
+		"""
+		:param event_names: Events to count, the sender of each one has to be looked up
+		"""
+		self.event_names = set(event_names)
+		self.reset()
+
+	def reset(self):
+		# Event name: {sender: count}
+		self.counts = {}
+
+	def _add(self, row, n):
+		sender = row.get("msg.sender")
+		# Missing senders are None, or NaN in rows read from a csv
+		if row["event_name"] not in self.event_names or not isinstance(sender, str):
+			return
+		counts = self.counts.setdefault(row["event_name"], {})
+		counts[sender] = counts.get(sender, 0) + n
+		if counts[sender] == 0:
+			del counts[sender]
+
+	def apply(self, row):
+		self._add(row, 1)
+
+	def revert(self, rows, since_block):
+		for row in rows:
+			self._add(row, -1)
+
+	def to_dict(self):
+		return self.counts
+
+	def load(self, data):
+		self.counts = { event_name: dict(counts) for event_name, counts in data.items() }
+
+class SupplySeries:
+	"""Total supply of USDT after every block that issued, redeemed or destroyed tokens."""
+
+	name = "supply"
+	needs_senders = False
+
+	def __init__(self, initial_supply=0):
+		"""
+		:param initial_supply: Supply minted by the constructor, which emits no event
+		"""
+		self.initial_supply = initial_supply
+		self.reset()
+
+	def reset(self):
+		self.supply = self.initial_supply
+		# [block number, timestamp, supply after the block]
+		self.series = []
+
+	def _delta(self, row):
+		event_name = row["event_name"]
+		if event_name == "Issue":
+			return to_int(row["amount"])
+		if event_name == "Redeem":
+			return -to_int(row["amount"])
+		if event_name == "DestroyedBlackFunds":
+			return -to_int(row["_balance"])
+		return 0
+
+	def apply(self, row):
+		delta = self._delta(row)
+		if delta == 0:
+			return
+		self.supply += delta
+		block_number = int(row["block_number"])
+		if len(self.series) > 0 and self.series[-1][0] == block_number:
+			self.series[-1][2] = self.supply
+		else:
+			self.series.append( [block_number, row["timestamp"], self.supply] )
+
+	def revert(self, rows, since_block):
+		for row in rows:
+			self.supply -= self._delta(row)
+		while len(self.series) > 0 and self.series[-1][0] >= since_block:
+			self.series.pop()
+
+	def to_dict(self):
+		return {"supply": self.supply, "series": self.series}
+
+	def load(self, data):
+		self.supply = data["supply"]
+		self.series = data["series"]
+
+def default_aggregates(initial_supply=0):
+	return [EventCounts(), SenderCounts(), SupplySeries(initial_supply)]
+
+def load_aggregates(fname) -> dict:
+	"""The aggregates written by AggregatingState, by aggregate name, plus last_block and complete."""
+	with open(fname, "rt") as f:
+		data = json.load(f)
+	data.pop("journal", None)
+	return data
+
+class AggregatingState(EventScannerState):
+	"""Pass events to another state and keep aggregates of them, updated at the end of every chunk.
+
+	The aggregates file is written before the wrapped state saves, so it is never behind the stored events.
+	If it is ahead after a crash, the recent blocks are reverted from the journal
+	and the events of the older ones are skipped when they are scanned again.
+	"""
+
+	# How many of the most recent blocks we keep the events of, to revert them after a reorg
+	journal_blocks = 256
+
+	def __init__(self, state: EventScannerState, fname: str, aggregates: Optional[List] = None,
+			senders: Optional[Callable[[List[str]], Dict[str, str]]] = None):
+		"""
+		:param state: The state that stores the events
+		:param fname: JSON file the aggregates are written to
+		:param aggregates: Aggregates to keep, default_aggregates() if not given
+		:param senders: Callable returning a dict of txhash: sender for a list of transaction hashes, e.g. a partial of tools.senders.resolve_senders.
+			Aggregates that need the sender skip events without one, if a lookup fails the aggregates are marked incomplete.
+		"""
+		self.state = state
+		self.fname = fname
+		self.aggregates = aggregates if aggregates is not None else default_aggregates()
+		self.senders = senders
+		self.reset_aggregates()
+
+	def reset_aggregates(self):
+		for aggregate in self.aggregates:
+			aggregate.reset()
+		# Last block applied to the aggregates
+		self.last_block = 0
+		# False when the aggregates miss events, e.g. they were added to a state that already had data
+		self.complete = True
+		# Rows of the current chunk, applied in end_chunk
+		self.pending = []
+		# Rows of the last journal_blocks blocks applied to the aggregates, all the rows from block journal_from on
+		self.journal = []
+		self.journal_from = 0
+
+	def _write(self):
+		data = {
+			"last_block": self.last_block,
+			"complete": self.complete,
+			"journal": self.journal,
+			"journal_from": self.journal_from,
+		}
+		for aggregate in self.aggregates:
+			data[aggregate.name] = aggregate.to_dict()
+		write_json_atomic(self.fname, data)
+
+	def _revert(self, since_block):
+		"""Undo the rows at or after since_block that are in the journal, blocks before the journal are final."""
+		since_block = max(since_block, self.journal_from)
+		if since_block > self.last_block:
+			return
+		keep = [ row for row in self.journal if row["block_number"] < since_block ]
+		reverted = [ row for row in self.journal if row["block_number"] >= since_block ][::-1]
+		for aggregate in self.aggregates:
+			aggregate.revert(reverted, since_block)
+		self.journal = keep
+		self.last_block = max(since_block - 1, 0)
+
+	def reset(self):
+		self.state.reset()
+		self.reset_aggregates()
+
+	def restore(self):
+		self.state.restore()
+		self.reset_aggregates()
+		last_scanned_block = self.state.get_last_scanned_block()
+		try:
+			with open(self.fname, "rt") as f:
+				data = json.load(f)
+		except (IOError, json.decoder.JSONDecodeError):
+			if last_scanned_block > 0:
+				print(f"No aggregates in {self.fname} for the {last_scanned_block} blocks already scanned, rebuild them")
+				self.complete = False
+			self.last_block = last_scanned_block
+			return
+
+		for aggregate in self.aggregates:
+			if aggregate.name in data:
+				aggregate.load(data[aggregate.name])
+		self.last_block = data["last_block"]
+		self.complete = data["complete"]
+		self.journal = data["journal"]
+		self.journal_from = data["journal_from"]
+		if self.last_block > last_scanned_block:
+			# Written before the wrapped state saved the same blocks
+			self._revert(last_scanned_block + 1)
+		else:
+			# Chunks without events are not written, so the file can stop before the last scanned block
+			self.last_block = last_scanned_block
+
+	def rebuild(self, rows):
+		"""Recompute the aggregates from all the stored events, in block and log index order, e.g. `df.to_dict('records')`.
+
+		Events need a msg.sender column for the aggregates that count by sender.
+		"""
+		self.reset_aggregates()
+		last_scanned_block = self.state.get_last_scanned_block()
+		for row in rows:
+			if int(row["block_number"]) <= last_scanned_block:
+				self._apply(row)
+		self.last_block = last_scanned_block
+		self._trim_journal()
+		self._write()
+
+	def save(self):
+		self._write()
+		self.state.save()
+
+	def _apply(self, row):
+		for aggregate in self.aggregates:
+			aggregate.apply(row)
+		self.journal.append(row)
+
+	def _trim_journal(self):
+		self.journal_from = max(self.journal_from, self.last_block - self.journal_blocks + 1)
+		if len(self.journal) > 0 and self.journal[0]["block_number"] < self.journal_from:
+			self.journal = [ row for row in self.journal if row["block_number"] >= self.journal_from ]
+
+	def _resolve_senders(self, rows):
+		if self.senders is None:
+			return
+		event_names = set()
+		for aggregate in self.aggregates:
+			if aggregate.needs_senders:
+				event_names |= aggregate.event_names
+		txhashes = [ row["txhash"] for row in rows if row["event_name"] in event_names and row.get("msg.sender") is None ]
+		if len(txhashes) > 0:
+			senders = self.senders(txhashes)
+			for row in rows:
+				if row["txhash"] in senders:
+					row["msg.sender"] = senders[row["txhash"]]
+			unresolved = { row["txhash"] for row in rows if row["event_name"] in event_names and row.get("msg.sender") is None }
+			if len(unresolved) > 0:
+				print(f"Could not get the sender of {len(unresolved)} transactions, the aggregates by sender miss their events")
+				self.complete = False
+
+	#
+	# EventScannerState methods implemented below
+	#
+
+	def get_last_scanned_block(self):
+		return self.state.get_last_scanned_block()
+
+	def delete_data(self, since_block):
+		"""Remove potentially reorganised blocks from the stored events and revert them from the aggregates."""
+		self.pending = [ row for row in self.pending if row["block_number"] < since_block ]
+		if since_block <= self.last_block:
+			self._revert(since_block)
+			self._write()
+		self.state.delete_data(since_block)
+
+	def record_block_hash(self, block_number, block_hash):
+		self.state.record_block_hash(block_number, block_hash)
+
+	def get_block_hashes(self):
+		return self.state.get_block_hashes()
+
+	def start_chunk(self, block_number, chunk_size):
+		self.state.start_chunk(block_number, chunk_size)
+
+	def end_chunk(self, block_number):
+		"""Apply the events of the chunk to the aggregates, then end the chunk of the wrapped state."""
+		if len(self.pending) > 0:
+			self._resolve_senders(self.pending)
+			for row in self.pending:
+				self._apply(row)
+			self.pending = []
+			self.last_block = max(self.last_block, block_number)
+			self._trim_journal()
+			# The wrapped state may save in end_chunk, the aggregates have to be on disk first
+			self._write()
+		else:
+			self.last_block = max(self.last_block, block_number)
+		self.state.end_chunk(block_number)
+
+	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> object:
+		# Blocks up to last_block are already counted, they are only scanned again for the wrapped state
+		if event["blockNumber"] > self.last_block:
+			self.pending.append(event_row(block_when, event))
+		return self.state.process_event(block_when, event)
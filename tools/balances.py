@@ -0,0 +1,126 @@
+"""Token balances of many (address, block) pairs.
+
+Asking the node for balanceOf one call at a time spends most of the time on round-trips.
+Queries are grouped by block and sent either as one Multicall3 call per block (for blocks after
+Multicall3 was deployed on the chain, if we know when) or as JSON-RPC batches of eth_call, with several blocks in flight at once.
+Results are memoized by (address, block), historical balances never change.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+from eth_abi import encode, decode
+from web3 import Web3
+
+from .rpcbatch import batch_request
+
+logger = logging.getLogger(__name__)
+
+# balanceOf(address)
+BALANCE_OF_SELECTOR = bytes.fromhex("70a08231")
+
+# aggregate3((address,bool,bytes)[]) of Multicall3, https://github.com/mds1/multicall
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+# Deployment block of Multicall3 by chain id, chains not listed here only use eth_call batches
+MULTICALL3_BLOCKS = {
+	1: 14353601,  # Ethereum mainnet
+	10: 4286263,  # Optimism
+	56: 15921452,  # BNB Smart Chain
+	137: 25770160,  # Polygon
+	8453: 5022,  # Base
+	42161: 7654707,  # Arbitrum One
+	11155111: 751532,  # Sepolia
+}
+AGGREGATE3_SELECTOR = bytes.fromhex("82ad56cb")
+
+def _balance_of_data(address):
+	return BALANCE_OF_SELECTOR + encode(["address"], [address])
+
+class BalanceFetcher:
+	"""balanceOf of one token at any block, for many addresses and blocks at a time."""
+
+	def __init__(self, web3, token_address, workers=4, batch_size=100, use_multicall=True):
+		"""
+		:param token_address: ERC-20 contract to call balanceOf on
+		:param workers: How many blocks (or batches) we query at the same time
+		:param batch_size: How many eth_calls we put in one JSON-RPC batch
+		:param use_multicall: Use Multicall3 for blocks where it is deployed, if the chain is in MULTICALL3_BLOCKS
+		"""
+		self.web3 = web3
+		self.token_address = Web3.to_checksum_address(token_address)
+		self.workers = workers
+		self.batch_size = batch_size
+		# First block we use Multicall3 for, None to only use eth_call batches
+		self.multicall_block = None
+		if use_multicall:
+			chain_id = web3.eth.chain_id
+			self.multicall_block = MULTICALL3_BLOCKS.get(chain_id)
+			if self.multicall_block is None:
+				logger.info("No Multicall3 deployment known on chain %d, using eth_call batches", chain_id)
+		self.cache = {}
+		self.lock = threading.Lock()
+
+	def balance_at(self, address, block_number):
+		"""Balance of address at the end of block_number."""
+		return self.balances_at([(address, block_number)])[(address, block_number)]
+
+	def balances_at(self, queries):
+		"""Balances for an iterable of (address, block number) pairs.
+
+		:return: Dict of (address, block number): balance
+		"""
+		queries = set( (address, int(block_number)) for address, block_number in queries )
+		with self.lock:
+			missing = sorted( (block_number, address) for address, block_number in queries if (address, block_number) not in self.cache )
+
+		# Each job is a list of (block, address) pairs, all in one block for Multicall3
+		jobs = []
+		batch = []
+		for block_number, pairs in groupby(missing, key=lambda pair: pair[0]):
+			pairs = list(pairs)
+			if self._multicall(block_number):
+				jobs.append(pairs)
+				continue
+			for pair in pairs:
+				batch.append(pair)
+				if len(batch) == self.batch_size:
+					jobs.append(batch)
+					batch = []
+		if batch:
+			jobs.append(batch)
+
+		if jobs:
+			logger.info("Fetching %d balances in %d requests", len(missing), len(jobs))
+			with ThreadPoolExecutor(max_workers=self.workers) as executor:
+				for balances in executor.map(self._fetch, jobs):
+					with self.lock:
+						self.cache.update(balances)
+
+		return { query: self.cache[query] for query in queries }
+
+	def _fetch(self, pairs):
+		block_number = pairs[0][0]
+		if self._multicall(block_number) and all(b == block_number for b, a in pairs):
+			return self._fetch_multicall(block_number, [address for b, address in pairs])
+		return self._fetch_batch(pairs)
+
+	def _multicall(self, block_number):
+		return self.multicall_block is not None and block_number >= self.multicall_block
+
+	def _fetch_batch(self, pairs):
+		"""One JSON-RPC batch of eth_call, the pairs can be in different blocks."""
+		params = [ [{"to": self.token_address, "data": Web3.to_hex(_balance_of_data(address))}, hex(block_number)] for block_number, address in pairs ]
+		results = batch_request(self.web3, "eth_call", params, batch_size=self.batch_size)
+		return { (address, block_number): int(result, 16) if result not in (None, "0x") else None
+			for (block_number, address), result in zip(pairs, results) }
+
+	def _fetch_multicall(self, block_number, addresses):
+		"""One eth_call to Multicall3 with the balanceOf calls of all addresses in a block."""
+		calls = [ (self.token_address, True, _balance_of_data(address)) for address in addresses ]
+		data = AGGREGATE3_SELECTOR + encode(["(address,bool,bytes)[]"], [calls])
+		result = self.web3.eth.call({"to": MULTICALL3_ADDRESS, "data": Web3.to_hex(data)}, block_identifier=block_number)
+		(returned,) = decode(["(bool,bytes)[]"], bytes(result))
+		return { (address, block_number): int.from_bytes(return_data, "big") if success and len(return_data) >= 32 else None
+			for address, (success, return_data) in zip(addresses, returned) }
@@ -0,0 +1,193 @@
+"""Which addresses were frozen (blacklisted) at which block.
+
+The index is built incrementally from the blacklist events of a token
+and keeps, for every address that was ever frozen, the sorted (block, log index) of each change of its status.
+Whether an address was frozen at a block is then a bisect in the changes of that address,
+and checking a whole column of transfer counterparties is one vectorised search per frozen address over the rows of that address.
+
+The changes are stored in SQLite, so a run only applies the events scanned since the previous one.
+The scanner may have rolled back a reorg since then, so `rewind` first forgets the most recent blocks
+and anything after the last block of the events, and the update starts from the block it returns.
+
+USDT events:
+
+* AddedBlackList(_user) and RemovedBlackList(_user)
+* DestroyedBlackFunds(_blackListedUser, _balance), only possible while the address is frozen
+
+USDC uses Blacklisted(_account) and UnBlacklisted(_account), see USDC_BLACKLIST_EVENTS.
+"""
+
+import bisect
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Event name: (argument with the address, whether the address is frozen after the event)
+USDT_BLACKLIST_EVENTS = {
+	"AddedBlackList": ("_user", True),
+	"RemovedBlackList": ("_user", False),
+	"DestroyedBlackFunds": ("_blackListedUser", True),
+}
+
+USDC_BLACKLIST_EVENTS = {
+	"Blacklisted": ("_account", True),
+	"UnBlacklisted": ("_account", False),
+}
+
+# Sorts after every log index, a lookup with it sees all the events of the block
+END_OF_BLOCK = 2**31
+
+class BlacklistIndex:
+	"""Frozen intervals of every blacklisted address of one token."""
+
+	# How many of the last applied blocks a chain reorganisation may have changed
+	reorg_blocks = 256
+
+	def __init__(self, fname, events=USDT_BLACKLIST_EVENTS):
+		"""
+		:param fname: SQLite database the changes are stored in
+		:param events: Dict of event name: (address argument, frozen after the event)
+		"""
+		self.fname = fname
+		self.events = events
+		self.conn = sqlite3.connect(fname)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS blacklist_changes (address TEXT, block_number INTEGER, log_index INTEGER, frozen INTEGER, PRIMARY KEY (address, block_number, log_index))")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS blacklist_state (key TEXT PRIMARY KEY, value INTEGER)")
+		self.conn.commit()
+		self._restore()
+
+	def _restore(self):
+		# Lowercase address: sorted list of (block number, log index), and the status after each of them
+		self.keys = {}
+		self.frozen = {}
+		# Changes not written to the database yet
+		self.pending = []
+		state = dict(self.conn.execute("SELECT key, value FROM blacklist_state"))
+		self.last_block = state.get("last_block", 0)
+		self.last_log_index = state.get("last_log_index", -1)
+		for address, block_number, log_index, frozen in self.conn.execute("SELECT address, block_number, log_index, frozen FROM blacklist_changes ORDER BY block_number, log_index"):
+			self.keys.setdefault(address, []).append( (block_number, log_index) )
+			self.frozen.setdefault(address, []).append( bool(frozen) )
+
+	def apply(self, row):
+		"""Apply one event, given as a dict with event_name, block_number, log_index and the event arguments.
+
+		Events at or before the last applied one are skipped, so updating from overlapping ranges is safe.
+		"""
+		block_number, log_index = int(row["block_number"]), int(row["log_index"])
+		if (block_number, log_index) <= (self.last_block, self.last_log_index):
+			return
+		change = self.events.get(row["event_name"])
+		if change is not None:
+			arg, frozen = change
+			address = str(row[arg]).lower()
+			keys = self.keys.setdefault(address, [])
+			states = self.frozen.setdefault(address, [])
+			# Events come in order, so the changes stay sorted
+			keys.append( (block_number, log_index) )
+			states.append(frozen)
+			self.pending.append( (address, block_number, log_index, int(frozen)) )
+		self.last_block, self.last_log_index = block_number, log_index
+
+	def update(self, rows):
+		"""Apply an iterable of events in block and log index order, e.g. `df.to_dict('records')`."""
+		for row in rows:
+			self.apply(row)
+
+	def save(self):
+		"""Write the changes applied since the last save and commit."""
+		self.conn.executemany("INSERT OR REPLACE INTO blacklist_changes (address, block_number, log_index, frozen) VALUES (?, ?, ?, ?)", self.pending)
+		self.conn.executemany("INSERT OR REPLACE INTO blacklist_state (key, value) VALUES (?, ?)",
+			[ ("last_block", self.last_block), ("last_log_index", self.last_log_index) ])
+		self.conn.commit()
+		self.pending = []
+
+	def rollback(self, since_block):
+		"""Forget everything at or after since_block, e.g. after a chain reorganisation.
+
+		Events from since_block onwards have to be applied again.
+		"""
+		self.save()
+		self.conn.execute("DELETE FROM blacklist_changes WHERE block_number >= ?", (since_block,))
+		self.conn.executemany("INSERT OR REPLACE INTO blacklist_state (key, value) VALUES (?, ?)",
+			[ ("last_block", max(since_block - 1, 0)), ("last_log_index", END_OF_BLOCK) ])
+		self.conn.commit()
+		self._restore()
+
+	def rewind(self, data_last_block):
+		"""Roll back what the events may no longer hold before updating from them.
+
+		The last `reorg_blocks` applied blocks may have been reorganised, and a rollback of the scanner
+		may have removed every event after data_last_block.
+
+		:param data_last_block: Last block of the blacklist events in the stored data, 0 if there are none
+		:return: The block to apply the events from
+		"""
+		since = max(min(self.last_block - self.reorg_blocks + 1, int(data_last_block) + 1), 0)
+		if since <= self.last_block:
+			self.rollback(since)
+		return since
+
+	def is_frozen(self, address, block_number, log_index=END_OF_BLOCK):
+		"""Whether the address was frozen just before the given log of a block, or at the end of the block without log_index."""
+		keys = self.keys.get(str(address).lower())
+		if keys is None:
+			return False
+		i = bisect.bisect_left(keys, (int(block_number), int(log_index))) - 1
+		return i >= 0 and self.frozen[str(address).lower()][i]
+
+	def are_frozen(self, addresses, block_numbers, log_indexes=None):
+		"""is_frozen for whole columns, e.g. the senders of transfers and their blocks and log indexes.
+
+		:return: list of bools, one per row
+		"""
+		result = np.zeros(len(addresses), dtype=bool)
+		if len(self.keys) == 0 or len(addresses) == 0:
+			return result.tolist()
+		# (block, log index) as one sortable integer, log indexes and END_OF_BLOCK fit in 32 bits
+		row_keys = np.asarray(block_numbers, dtype=np.int64) << 32
+		if log_indexes is None:
+			row_keys += END_OF_BLOCK
+		else:
+			row_keys += np.asarray(log_indexes, dtype=np.int64)
+
+		# Code of the frozen address of every row, -1 for the most counterparties that were never frozen
+		frozen_addresses = list(self.keys)
+		codes = pd.Index(frozen_addresses).get_indexer(pd.Series(addresses, dtype=str).str.lower())
+		rows = np.flatnonzero(codes >= 0)
+		rows = rows[np.argsort(codes[rows], kind="stable")]
+		row_codes = codes[rows]
+		starts = np.searchsorted(row_codes, np.arange(len(frozen_addresses)), side="left")
+		ends = np.searchsorted(row_codes, np.arange(len(frozen_addresses)), side="right")
+		for code in np.flatnonzero(ends > starts):
+			address = frozen_addresses[code]
+			change_keys = np.array([ (block_number << 32) + log_index for block_number, log_index in self.keys[address] ], dtype=np.int64)
+			frozen = np.array(self.frozen[address], dtype=bool)
+			address_rows = rows[starts[code]:ends[code]]
+			# Same as is_frozen: the last change strictly before the row
+			i = np.searchsorted(change_keys, row_keys[address_rows], side="left") - 1
+			result[address_rows] = (i >= 0) & frozen[np.maximum(i, 0)]
+		return result.tolist()
+
+	def intervals(self, address):
+		"""List of (first block, last block) the address was frozen, last block None if it still is."""
+		address = str(address).lower()
+		result = []
+		start = None
+		for (block_number, log_index), frozen in zip(self.keys.get(address, []), self.frozen.get(address, [])):
+			if frozen and start is None:
+				start = block_number
+			elif not frozen and start is not None:
+				result.append( (start, block_number - 1) )
+				start = None
+		if start is not None:
+			result.append( (start, None) )
+		return result
+
+	def frozen_at(self, block_number):
+		"""Set of the addresses frozen at the end of a block."""
+		return { address for address in self.keys if self.is_frozen(address, block_number) }
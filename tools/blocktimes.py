@@ -0,0 +1,105 @@
+"""Persistent block number -> timestamp index.
+
+Timestamps are stored as a flat array of little-endian uint32 in a file, at offset 4 * block number,
+with 0 meaning unknown. Looking up a block is one read at a known offset, the file is sparse where
+blocks were never looked up, and it can be shared by scans of different contracts and across restarts.
+Block numbers only identify a block within one chain, so every chain gets its own file, see `for_chain`.
+"""
+
+import os
+import struct
+import threading
+
+_record = struct.Struct("<I")
+
+class BlockTimestampCache:
+	"""Block timestamps (seconds since epoch) keyed by block number, backed by a file."""
+
+	# Read the whole span of the requested blocks in one go if it is smaller than this many blocks
+	max_span_read = 1000000
+
+	def __init__(self, fname="data/block_timestamps_1.bin"):
+		self.fname = fname
+		self.fd = None
+		self.lock = threading.Lock()
+
+	@classmethod
+	def for_chain(cls, web3, data_dir="data"):
+		"""The cache of the chain web3 is connected to, in <data_dir>/block_timestamps_<chain id>.bin"""
+		chain_id = web3.eth.chain_id
+		fname = os.path.join(data_dir, f"block_timestamps_{chain_id}.bin")
+		legacy_fname = os.path.join(data_dir, "block_timestamps.bin")
+		if chain_id == 1 and os.path.exists(legacy_fname) and not os.path.exists(fname):
+			# Written before the file was keyed by chain, only mainnet was scanned then
+			os.replace(legacy_fname, fname)
+		return cls(fname)
+
+	def _open(self):
+		if self.fd is None:
+			with self.lock:
+				if self.fd is None:
+					dirname = os.path.dirname(self.fname)
+					if dirname:
+						os.makedirs(dirname, exist_ok=True)
+					self.fd = os.open(self.fname, os.O_RDWR | os.O_CREAT, 0o644)
+		return self.fd
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def get(self, block_number):
+		"""Timestamp of a block, None if we do not have it."""
+		return self.get_many([block_number]).get(block_number)
+
+	def get_many(self, block_numbers):
+		"""Timestamps of the blocks we have, as a dict of block number: timestamp."""
+		block_numbers = sorted(set(block_numbers))
+		if len(block_numbers) == 0:
+			return {}
+		fd = self._open()
+		found = {}
+		first, last = block_numbers[0], block_numbers[-1]
+		if last - first < self.max_span_read:
+			data = os.pread(fd, (last - first + 1) * _record.size, first * _record.size)
+			for block_number in block_numbers:
+				offset = (block_number - first) * _record.size
+				if offset + _record.size <= len(data):
+					(timestamp,) = _record.unpack_from(data, offset)
+					if timestamp:
+						found[block_number] = timestamp
+		else:
+			for block_number in block_numbers:
+				data = os.pread(fd, _record.size, block_number * _record.size)
+				if len(data) == _record.size:
+					(timestamp,) = _record.unpack(data)
+					if timestamp:
+						found[block_number] = timestamp
+		return found
+
+	def set_many(self, timestamps):
+		"""Store a dict of block number: timestamp, consecutive blocks are written with one call."""
+		fd = self._open()
+		run_start = None
+		run = []
+		for block_number in sorted(timestamps):
+			if run and block_number != run_start + len(run):
+				os.pwrite(fd, b"".join(run), run_start * _record.size)
+				run = []
+			if not run:
+				run_start = block_number
+			run.append(_record.pack(int(timestamps[block_number])))
+		if run:
+			os.pwrite(fd, b"".join(run), run_start * _record.size)
+
+	def invalidate(self, since_block, until_block):
+		"""Forget the timestamps of blocks in [since_block, until_block], e.g. after a chain reorganisation."""
+		if until_block < since_block:
+			return
+		fd = self._open()
+		size = os.fstat(fd).st_size
+		end = min((until_block + 1) * _record.size, size)
+		start = since_block * _record.size
+		if end > start:
+			os.pwrite(fd, bytes(end - start), start)
@@ -5,11 +5,19 @@ where events are added wherever the scanner left off.
 """
 
 import datetime
+import json
+import random
+import re
 import time
 import logging
+import threading
 from abc import ABC, abstractmethod
-from typing import Tuple, Optional, Callable, List, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Tuple, Optional, Callable, List, Iterable, Iterator, NamedTuple
 
+import requests
 from web3 import Web3
 from web3.contract import Contract
 from web3.datastructures import AttributeDict
@@ -19,16 +27,36 @@ from eth_abi.codec import ABICodec
 # Currently this method is not exposed over official web3 API,
 # but we need it to construct eth_getLogs parameters
 from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
+
+from .blocktimes import BlockTimestampCache
+from .rpcbatch import batch_request
+from .logdecoder import LogDecoder
+from .metrics import ScanMetrics, ChunkProfiler
 
 
 logger = logging.getLogger(__name__)
 
 
+class ScanBatch(NamedTuple):
+	"""The events of one scanned chunk, as yielded by `EventScanner.iter_scan`."""
+	# First and last block of the chunk
+	start_block: int
+	end_block: int
+	# When the last block of the chunk was mined
+	end_block_timestamp: Optional[datetime.datetime]
+	# Decoded events ordered by block and log index
+	events: list
+	# What the state's process_event returned for each event
+	processed: list
+
+
 class EventScannerState(ABC):
 	"""Application state that remembers what blocks we have scanned in the case of crash.
 	"""
 
+	# How many of the most recent block hashes states that record them keep
+	max_block_hashes = 256
+
 	@abstractmethod
 	def get_last_scanned_block(self) -> int:
 		"""Number of the last block we have scanned on the previous cycle.
@@ -69,8 +97,20 @@ class EventScannerState(ABC):
 		"""Delete any data since this block was scanned.
 
 		Purges any potential minor reorg data.
+		Recorded block hashes at or after since_block should be dropped too.
 		"""
 
+	def record_block_hash(self, block_number: int, block_hash: str):
+		"""Remember the hash of a scanned block that is not finalized yet.
+
+		The scanner compares recorded hashes with the node's to find where the chain forked.
+		States that do not store hashes make the scanner rescan a fixed number of blocks instead.
+		"""
+
+	def get_block_hashes(self) -> dict:
+		"""Recorded block hashes as a dict of block number: hash."""
+		return {}
+
 
 class EventScanner:
 	"""Scan blockchain for events and try not to abuse JSON-RPC API too much.
@@ -83,8 +123,14 @@ class EventScanner:
 	because it cannot correctly throttle and decrease the `eth_getLogs` block number range.
 	"""
 
+	# How many blocks we rescan on restart when the state does not record block hashes
+	NUM_BLOCKS_RESCAN_FOR_FORKS = 10
+
 	def __init__(self, web3: Web3, contract: Contract, state: EventScannerState, events: List, filters: {},
-				 max_chunk_scan_size: int = 10000, max_request_retries: int = 30, request_retry_seconds: float = 3.0):
+				 max_chunk_scan_size: int = 10000, max_request_retries: int = 30, request_retry_seconds: float = 3.0,
+				 single_filter: bool = False, block_timestamps: Optional[BlockTimestampCache] = None,
+				 target_logs_per_request: int = 2000, target_request_seconds: float = 10.0,
+				 metrics: Optional[ScanMetrics] = None, profiler: Optional[ChunkProfiler] = None):
 		"""
 		:param contract: Contract
 		:param events: List of web3 Event we scan
@@ -92,14 +138,35 @@ class EventScanner:
 		:param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
 		:param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
 		:param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+		:param single_filter: Fetch all event types with one `eth_getLogs` call per chunk (OR list of topic0 values).
+			Only an `address` filter can be combined this way.
+		:param block_timestamps: Persistent block timestamp index, shared across chunks, restarts and contracts
+		:param target_logs_per_request: How many logs we try to get with each `eth_getLogs` call
+		:param target_request_seconds: How long we want an `eth_getLogs` call to take at most
+		:param metrics: Where to record stage timings and counters, a new `ScanMetrics` if not given
+		:param profiler: Optional `ChunkProfiler` run over some of the chunks
 		"""
 
+		if single_filter and set(filters.keys()) - {"address"}:
+			raise ValueError("single_filter mode only supports filtering by address")
+
 		self.logger = logger
 		self.contract = contract
 		self.web3 = web3
 		self.state = state
 		self.events = events
+		# Every event ABI compiled once, fetched logs are decoded by their topic0,
+		# and by their contract address too for events of contracts with an address
+		self.decoder = LogDecoder([], web3.codec)
+		for event in events:
+			self.decoder.add(event._get_event_abi(), getattr(event, "address", None))
 		self.filters = filters
+		self.single_filter = single_filter
+		self.block_timestamps = block_timestamps
+		self.metrics = metrics if metrics is not None else ScanMetrics()
+		self.profiler = profiler
+		# Blocks at or below this one are final, we neither record their hashes nor rescan them
+		self.finalized_block = None
 
 		# Our JSON-RPC throttling parameters
 		self.min_scan_chunk_size = 10  # 12 s/block = 120 seconds period
@@ -107,42 +174,189 @@ class EventScanner:
 		self.max_request_retries = max_request_retries
 		self.request_retry_seconds = request_retry_seconds
 
-		# Factor how fast we increase the chunk size if results are found
-		# # (slow down scan after starting to get hits)
+		# Factor how fast we decrease the chunk size if the node cannot serve it
 		self.chunk_size_decrease = 0.5
 
-		# Factor how was we increase chunk size if no results found
+		# Factor how fast we increase chunk size if we are below the target
 		self.chunk_size_increase = 2.0
 
+		# How many logs, and how many seconds, we aim an `eth_getLogs` call at.
+		# Providers commonly cap responses at 10,000 logs.
+		self.target_logs_per_request = target_logs_per_request
+		self.target_request_seconds = target_request_seconds
+
+		# Moving average of logs per block, and how much weight the last chunk gets
+		self.logs_per_block = None
+		self.logs_per_block_smoothing = 0.3
+		# scan_parallel workers estimate their chunk sizes concurrently
+		self.chunk_size_lock = threading.Lock()
+
 	@property
 	def address(self):
 		return self.token_address
 
 	def get_block_timestamp(self, block_num) -> datetime.datetime:
 		"""Get Ethereum block timestamp"""
+		return self.get_block_timestamps([block_num])[block_num]
+
+	def get_block_timestamps(self, block_numbers) -> dict:
+		"""Get the timestamps of many blocks.
+
+		Blocks missing from the persistent index are fetched with JSON-RPC batch requests and added to it.
+
+		:return: Dict of block number: UTC datetime, None for blocks that are not mined yet
+		"""
+		block_timestamps, block_hashes = self.get_blocks(block_numbers)
+		return block_timestamps
+
+	def get_blocks(self, block_numbers, hash_block_numbers=()) -> Tuple[dict, dict]:
+		"""Get the timestamps of many blocks, and the hashes of some of them, in one batch request.
+
+		Blocks missing from the persistent timestamp index, and all the blocks we want the hash of, are fetched.
+
+		:return: tuple(dict of block number: UTC datetime or None, dict of block number: hex hash of the hash_block_numbers that are mined)
+		"""
+		block_numbers = set(block_numbers)
+		hash_block_numbers = set(hash_block_numbers)
+		timestamps = self.block_timestamps.get_many(block_numbers) if self.block_timestamps else {}
+
+		missing = sorted(block_numbers - timestamps.keys())
+		self.metrics.incr("block_timestamps", len(block_numbers) - len(missing), source="cache")
+		fetch = sorted(set(missing) | hash_block_numbers)
+		block_hashes = {}
+		if fetch:
+			self.metrics.incr("block_timestamps", len(missing), source="rpc")
+			with self.metrics.timer("rpc", method="eth_getBlockByNumber"):
+				blocks = batch_request(self.web3, "eth_getBlockByNumber", [[hex(block_num), False] for block_num in fetch])
+			fetched = {}
+			for block_num, block_info in zip(fetch, blocks):
+				# Block was not mined yet,
+				# minor chain reorganisation?
+				if block_info is not None:
+					fetched[block_num] = int(block_info["timestamp"], 16)
+					if block_num in hash_block_numbers:
+						block_hashes[block_num] = block_info["hash"]
+			if self.block_timestamps:
+				self.block_timestamps.set_many(fetched)
+			timestamps.update(fetched)
+
+		block_timestamps = {
+			block_num: datetime.datetime.utcfromtimestamp(timestamps[block_num]) if block_num in timestamps else None
+			for block_num in block_numbers
+		}
+		return block_timestamps, block_hashes
+
+	def get_finalized_block(self) -> Optional[int]:
+		"""Number of the latest finalized block, None if the node does not support the `finalized` tag."""
 		try:
-			block_info = self.web3.eth.get_block(block_num)
-		except BlockNotFound:
-			# Block was not mined yet,
-			# minor chain reorganisation?
+			self.finalized_block = self.web3.eth.get_block("finalized")["number"]
+		except Exception as e:
+			logger.debug("Could not get the finalized block: %s", e)
+			self.finalized_block = None
+		return self.finalized_block
+
+	def get_block_hashes(self, block_numbers) -> dict:
+		"""Hashes of blocks as a dict of block number: hex hash, in one batch request."""
+		block_numbers = sorted(set(block_numbers))
+		with self.metrics.timer("rpc", method="eth_getBlockByNumber"):
+			blocks = batch_request(self.web3, "eth_getBlockByNumber", [[hex(block_num), False] for block_num in block_numbers])
+		return { block_num: block_info["hash"] for block_num, block_info in zip(block_numbers, blocks) if block_info is not None }
+
+	def unfinalized_blocks(self, start_block, end_block) -> range:
+		"""The blocks of a range we record the hashes of: the ones after the finalized block,
+		or the last `max_block_hashes` of the range if the node does not tell which blocks are finalized."""
+		if self.finalized_block is not None:
+			return range(max(start_block, self.finalized_block + 1), end_block + 1)
+		return range(max(start_block, end_block - self.state.max_block_hashes + 1), end_block + 1)
+
+	def record_block_hashes(self, block_hashes: dict):
+		"""Let the state remember the hashes of scanned blocks that are not finalized yet."""
+		for block_number in sorted(block_hashes):
+			if self.finalized_block is None or block_number > self.finalized_block:
+				self.state.record_block_hash(block_number, block_hashes[block_number])
+
+	def _fetch_blocks_of_chunk(self, start_block, end_block) -> Tuple[int, list, float, dict, dict]:
+		"""Fetch the events of a chunk, the timestamps of their blocks and the hashes of its unfinalized blocks.
+
+		The hashes come from the same batch as the timestamps. If the logs were served from another fork
+		than those blocks, i.e. the chain reorganised while we fetched, the chunk is fetched again,
+		so the recorded hashes are always the ones of the blocks the events came from.
+
+		:return: tuple(actual end block number, events, seconds spent in `eth_getLogs`, timestamps, hashes)
+		"""
+		while True:
+			with self.metrics.timer("fetch"):
+				actual_end_block, events, get_logs_seconds = self._fetch_chunk(start_block, end_block)
+
+			# Timestamps of all blocks with events, and hashes of all unfinalized blocks, in one batch
+			with self.metrics.timer("block_timestamps"):
+				block_timestamps, block_hashes = self.get_blocks(
+					{evt["blockNumber"] for evt in events} | {actual_end_block},
+					self.unfinalized_blocks(start_block, actual_end_block))
+
+			forked = _forked_blocks(events, block_hashes)
+			if not forked:
+				return actual_end_block, events, get_logs_seconds, block_timestamps, block_hashes
+			logger.warning("Chain reorganisation at block %d while scanning blocks %d - %d, fetching them again", forked[0], start_block, actual_end_block)
+			self.metrics.incr("reorgs_while_fetching")
+
+	def find_fork_point(self, check_latest_first: bool = True) -> Optional[int]:
+		"""Compare the block hashes the state recorded with the node's to find a chain reorganisation.
+
+		A block hash commits to all its ancestors, so if a recorded block still has the same hash
+		every block before it is still valid.
+
+		:param check_latest_first: Ask only for the latest recorded block first, which is enough when there was no reorganisation
+		:return: First block we have to scan again, None if nothing changed or the state records no hashes
+		"""
+		recorded = self.state.get_block_hashes()
+		if not recorded:
 			return None
-		last_time = block_info["timestamp"]
-		return datetime.datetime.utcfromtimestamp(last_time)
+
+		block_numbers = sorted(recorded)
+		if check_latest_first:
+			latest = block_numbers[-1]
+			if self.get_block_hashes([latest]).get(latest) == recorded[latest]:
+				return None
+
+		node_hashes = self.get_block_hashes(block_numbers)
+		for block_num in reversed(block_numbers):
+			if node_hashes.get(block_num) == recorded[block_num]:
+				logger.info("Chain reorganisation after block %d", block_num)
+				return block_num + 1
+
+		# Forked before the oldest block we know about, which can only be after the finalized block
+		logger.warning("Chain reorganisation before block %d", block_numbers[0])
+		finalized_block = self.get_finalized_block()
+		if finalized_block is not None and finalized_block < block_numbers[0]:
+			return finalized_block + 1
+		return block_numbers[0] - self.NUM_BLOCKS_RESCAN_FOR_FORKS
 
 	def get_suggested_scan_start_block(self):
 		"""Get where we should start to scan for new token events.
 
 		If there are no prior scans, start from block 1.
+		If the state recorded block hashes, we rescan only from where the chain forked, if it did.
 		Otherwise, start from the last end block minus ten blocks.
 		We rescan the last ten scanned blocks in the case there were forks to avoid
 		misaccounting due to minor single block works (happens once in a hour in Ethereum).
-		These heurestics could be made more robust, but this is for the sake of simple reference implementation.
+		Blocks at or below the finalized block are never rescanned.
 		"""
 
 		end_block = self.get_last_scanned_block()
-		if end_block:
-			return max(1, end_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS)
-		return 1
+		if not end_block:
+			return 1
+
+		if self.state.get_block_hashes():
+			fork_block = self.find_fork_point()
+			start_block = end_block + 1 if fork_block is None else min(fork_block, end_block + 1)
+		else:
+			start_block = end_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS
+
+		finalized_block = self.get_finalized_block()
+		if finalized_block is not None:
+			start_block = max(start_block, min(finalized_block, end_block) + 1)
+		return max(1, start_block)
 
 	def get_suggested_scan_end_block(self):
 		"""Get the last mined block on Ethereum chain we are following."""
@@ -156,37 +370,53 @@ class EventScanner:
 
 	def delete_potentially_forked_block_data(self, after_block: int):
 		"""Purge old data in the case of blockchain reorganisation."""
+		if self.block_timestamps:
+			self.block_timestamps.invalidate(after_block, self.get_last_scanned_block())
 		self.state.delete_data(after_block)
 
-	def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
-		"""Read and process events between to block numbers.
+	def fetch_chunk(self, start_block, end_block) -> Tuple[int, list]:
+		"""Fetch and decode the events between two block numbers, without processing them.
 
 		Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
 
-		:return: tuple(actual end block number, when this block was mined, processed events)
+		:return: tuple(actual end block number, events ordered by block and log index)
 		"""
-
-		block_timestamps = {}
-		get_block_timestamp = self.get_block_timestamp
-
-		# Cache block timestamps to reduce some RPC overhead
-		# Real solution might include smarter models around block
-		def get_block_when(block_num):
-			if block_num not in block_timestamps:
-				block_timestamps[block_num] = get_block_timestamp(block_num)
-			return block_timestamps[block_num]
-
-		all_processed = []
-
-		for event_type in self.events:
-
-			# Callable that takes care of the underlying web3 call
-			def _fetch_events(_start_block, _end_block):
-				return _fetch_events_for_all_contracts(self.web3,
-													   event_type,
-													   self.filters,
-													   from_block=_start_block,
-													   to_block=_end_block)
+		end_block, all_events, get_logs_seconds = self._fetch_chunk(start_block, end_block)
+		return end_block, all_events
+
+	def _fetch_chunk(self, start_block, end_block) -> Tuple[int, list, float]:
+		"""`fetch_chunk` that also returns the seconds spent in the `eth_getLogs` calls that succeeded."""
+
+		# Retry sleeps, decoding and processing are not the node's latency, only the calls are timed
+		get_logs_seconds = []
+
+		if self.single_filter:
+			# One `eth_getLogs` call for every event type we scan
+			fetchers = [lambda _start_block, _end_block: _fetch_events_for_all_event_types(
+				self.web3,
+				self.events,
+				self.filters,
+				from_block=_start_block,
+				to_block=_end_block,
+				decoder=self.decoder,
+				metrics=self.metrics,
+				durations=get_logs_seconds)]
+		else:
+			# Callable that takes care of the underlying web3 call, one per event type
+			fetchers = [
+				lambda _start_block, _end_block, event_type=event_type: _fetch_events_for_all_contracts(
+					self.web3,
+					event_type,
+					self.filters,
+					from_block=_start_block,
+					to_block=_end_block,
+					decoder=self.decoder,
+					metrics=self.metrics,
+					durations=get_logs_seconds)
+				for event_type in self.events]
+
+		all_events = []
+		for _fetch_events in fetchers:
 
 			# Do `n` retries on `eth_getLogs`,
 			# throttle down block range if needed
@@ -195,29 +425,78 @@ class EventScanner:
 				start_block=start_block,
 				end_block=end_block,
 				retries=self.max_request_retries,
-				delay=self.request_retry_seconds)
+				delay=self.request_retry_seconds,
+				on_retry=self._on_retry)
+			all_events += events
+
+		# A later event type may have throttled down the range,
+		# drop what earlier ones found past it, the next chunk will scan those blocks
+		all_events = [evt for evt in all_events if evt["blockNumber"] <= end_block]
+		if len(fetchers) > 1:
+			all_events.sort(key=lambda evt: (evt["blockNumber"], evt["logIndex"]))
+		return end_block, all_events, sum(get_logs_seconds)
+
+	def _on_retry(self, kind, start_block, end_block, new_end_block, sleep):
+		self.metrics.incr("retries", kind=kind)
+		if new_end_block < end_block:
+			self.metrics.incr("range_splits")
+		if sleep:
+			self.metrics.observe("retry_sleep", sleep)
+
+	def process_events(self, events, get_block_when) -> list:
+		"""Pass fetched events to the state.
+
+		:param get_block_when: Callable returning the timestamp of a block number
+		"""
+		with self.metrics.timer("process_events"):
+			all_processed = self._process_events(events, get_block_when)
+		self.metrics.incr("events", len(all_processed))
+		return all_processed
 
-			for evt in events:
-				idx = evt["logIndex"]  # Integer of the log index position in the block, null when its pending
+	def _process_events(self, events, get_block_when) -> list:
+		all_processed = []
+		for evt in events:
+			idx = evt["logIndex"]  # Integer of the log index position in the block, null when its pending
 
-				# We cannot avoid minor chain reorganisations, but
-				# at least we must avoid blocks that are not mined yet
-				assert idx is not None, "Somehow tried to scan a pending block"
+			# We cannot avoid minor chain reorganisations, but
+			# at least we must avoid blocks that are not mined yet
+			assert idx is not None, "Somehow tried to scan a pending block"
 
-				block_number = evt["blockNumber"]
+			block_number = evt["blockNumber"]
 
-				# Get UTC time when this event happened (block mined timestamp)
-				# from our in-memory cache
-				block_when = get_block_when(block_number)
+			# Get UTC time when this event happened (block mined timestamp)
+			# from our in-memory cache
+			block_when = get_block_when(block_number)
 
-				logger.debug("Processing event %s, block:%d count:%d", evt["event"], evt["blockNumber"])
-				processed = self.state.process_event(block_when, evt)
-				all_processed.append(processed)
+			logger.debug("Processing event %s, block:%d", evt["event"], evt["blockNumber"])
+			processed = self.state.process_event(block_when, evt)
+			all_processed.append(processed)
+		return all_processed
 
-		end_block_timestamp = get_block_when(end_block)
+	def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
+		"""Read and process events between to block numbers.
+
+		Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
+
+		:return: tuple(actual end block number, when this block was mined, processed events)
+		"""
+		end_block, end_block_timestamp, all_processed, events, get_logs_seconds = self._scan_chunk(start_block, end_block)
 		return end_block, end_block_timestamp, all_processed
 
-	def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
+	def _scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list, list, float]:
+		"""`scan_chunk` that also returns the decoded events and the seconds spent in `eth_getLogs`."""
+
+		end_block, events, get_logs_seconds, block_timestamps, block_hashes = self._fetch_blocks_of_chunk(start_block, end_block)
+		all_processed = self.process_events(events, block_timestamps.get)
+
+		with self.metrics.timer("record_block_hash"):
+			self.record_block_hashes(block_hashes)
+
+		end_block_timestamp = block_timestamps[end_block]
+		return end_block, end_block_timestamp, all_processed, events, get_logs_seconds
+
+	def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int, blocks_scanned: Optional[int] = None,
+								 duration: Optional[float] = None, throttled: bool = False):
 		"""Try to figure out optimal chunk size
 
 		Our scanner might need to scan the whole blockchain for all events
@@ -231,85 +510,489 @@ class EventScanner:
 		Currently Ethereum JSON-API does not have an API to tell when a first event occured in a blockchain
 		and our heuristics try to accelerate block fetching (chunk size) until we see the first event.
 
-		These heurestics exponentially increase the scan chunk size depending on if we are seeing events or not.
-		When any transfers are encountered, we are back to scanning only a few blocks at a time.
-		It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
+		We keep a moving average of the number of logs per block, and aim each `eth_getLogs` call
+		at `target_logs_per_request` logs and `target_request_seconds` of latency.
+		Empty chunks double the chunk size, chunks with events grow it towards the target at most twofold,
+		and a chunk that had to be throttled down by the retry loop, or was too slow, halves it (AIMD style).
+
+		:param current_chuck_size: Blocks we asked for in the last chunk
+		:param event_found_count: Logs we got in the last chunk
+		:param blocks_scanned: Blocks the last chunk actually covered, after any throttling
+		:param duration: Seconds the `eth_getLogs` calls of the last chunk took
+		:param throttled: The JSON-RPC server made us throttle down the last chunk
 		"""
 
-		if event_found_count > 0:
-			# When we encounter first events, reset the chunk size window
-			current_chuck_size = self.min_scan_chunk_size
-		else:
-			current_chuck_size *= self.chunk_size_increase
+		with self.chunk_size_lock:
+			if blocks_scanned is None:
+				blocks_scanned = current_chuck_size
+
+			if blocks_scanned > 0:
+				observed = event_found_count / blocks_scanned
+				if self.logs_per_block is None:
+					self.logs_per_block = observed
+				else:
+					self.logs_per_block += self.logs_per_block_smoothing * (observed - self.logs_per_block)
+
+			if throttled:
+				# The node could not serve the range, back off from what actually worked
+				current_chuck_size = blocks_scanned * self.chunk_size_decrease
+			elif event_found_count == 0:
+				current_chuck_size *= self.chunk_size_increase
+			else:
+				# Aim at the target number of logs, but do not grow faster than the increase factor
+				target = self.target_logs_per_request / max(self.logs_per_block, 1e-9)
+				current_chuck_size = min(target, current_chuck_size * self.chunk_size_increase)
 
-		current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-		current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-		return int(current_chuck_size)
+			if duration is not None and duration > self.target_request_seconds and not throttled:
+				# Slow responses, shrink the range in proportion
+				current_chuck_size = min(current_chuck_size, blocks_scanned * self.target_request_seconds / duration)
 
-	def scan(self, start_block, end_block, start_chunk_size=20, progress_callback=Optional[Callable]) -> Tuple[
-		list, int]:
-		"""Perform a token balances scan.
+			current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
+			current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
+			return int(current_chuck_size)
 
-		Assumes all balances in the database are valid before start_block (no forks sneaked in).
+	def iter_scan(self, start_block, end_block, start_chunk_size=20) -> Iterator[ScanBatch]:
+		"""Scan a block range chunk by chunk, yielding the events of each chunk as it is done.
+
+		Each chunk is fetched and passed to the state's `process_event`,
+		then yielded as a `ScanBatch` of the decoded events and what the state returned for them.
+		The next chunk is not fetched until the caller asks for it,
+		and the state's `end_chunk` checkpoint for a chunk is written when the caller asks for the next one
+		or stops iterating, so the caller can stream the events into a sink before the scan moves past them.
+		Memory does not grow with the length of the range.
 
 		:param start_block: The first block included in the scan
 
 		:param end_block: The last block included in the scan
 
 		:param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
-
-		:param progress_callback: If this is an UI application, update the progress of the scan
-
-		:return: [All processed events, number of chunks used]
 		"""
 
 		assert start_block <= end_block
 
+		self.get_finalized_block()
+
 		current_block = start_block
 
 		# Scan in chunks, commit between
 		chunk_size = start_chunk_size
 		last_scan_duration = last_logs_found = 0
-		total_chunks_scanned = 0
-
-		# All processed entries we got on this scan cycle
-		all_processed = []
 
 		while current_block <= end_block:
 
 			self.state.start_chunk(current_block, chunk_size)
 
 			# Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-			estimated_end_block = current_block + chunk_size
+			# Never scan past the end block, it may not be mined yet
+			estimated_end_block = min(current_block + chunk_size - 1, end_block)
 			logger.debug(
 				"Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d",
 				current_block, estimated_end_block, chunk_size, last_scan_duration, last_logs_found)
 
 			start = time.time()
-			actual_end_block, end_block_timestamp, new_entries = self.scan_chunk(current_block, estimated_end_block)
+			with self._profile(current_block, estimated_end_block):
+				actual_end_block, end_block_timestamp, new_entries, events, get_logs_seconds = self._scan_chunk(current_block, estimated_end_block)
 
 			# Where does our current chunk scan ends - are we out of chain yet?
 			current_end = actual_end_block
 
 			last_scan_duration = time.time() - start
-			all_processed += new_entries
-
-			# Print progress bar
-			if progress_callback:
-				progress_callback(start_block, end_block, current_block, end_block_timestamp, chunk_size, len(new_entries))
 
 			# Try to guess how many blocks to fetch over `eth_getLogs` API next time
-			chunk_size = self.estimate_next_chunk_size(chunk_size, len(new_entries))
+			last_logs_found = len(new_entries)
+			chunk_size = self.estimate_next_chunk_size(
+				chunk_size,
+				last_logs_found,
+				blocks_scanned=current_end - current_block + 1,
+				duration=get_logs_seconds,
+				throttled=current_end < estimated_end_block)
+
+			self._record_chunk(current_block, current_end, len(new_entries), last_scan_duration)
+			try:
+				yield ScanBatch(current_block, current_end, end_block_timestamp, events, new_entries)
+			finally:
+				# Also when the caller stops early, the state already holds the events of this chunk
+				self._end_chunk(current_end)
 
 			# Set where the next chunk starts
 			current_block = current_end + 1
+
+	def scan(self, start_block, end_block, start_chunk_size=20, progress_callback: Optional[Callable] = None) -> Tuple[
+		list, int]:
+		"""Perform a token balances scan.
+
+		Assumes all balances in the database are valid before start_block (no forks sneaked in).
+		Collects what `iter_scan` yields, use that instead for long ranges.
+
+		:param start_block: The first block included in the scan
+
+		:param end_block: The last block included in the scan
+
+		:param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
+
+		:param progress_callback: If this is an UI application, update the progress of the scan
+
+		:return: [All processed events, number of chunks used]
+		"""
+
+		# All processed entries we got on this scan cycle
+		all_processed = []
+		total_chunks_scanned = 0
+
+		for batch in self.iter_scan(start_block, end_block, start_chunk_size):
+			all_processed += batch.processed
 			total_chunks_scanned += 1
-			self.state.end_chunk(current_end)
+
+			# Print progress bar
+			if progress_callback:
+				progress_callback(start_block, end_block, batch.start_block, batch.end_block_timestamp, batch.end_block - batch.start_block + 1, len(batch.processed))
 
 		return all_processed, total_chunks_scanned
 
+	def _profile(self, start_block, end_block):
+		if self.profiler is None:
+			return nullcontext()
+		return self.profiler.profile(f"chunk-{start_block}-{end_block}")
+
+	def _end_chunk(self, block_number):
+		with self.metrics.timer("end_chunk"):
+			self.state.end_chunk(block_number)
+
+	def _record_chunk(self, start_block, end_block, events_count, duration):
+		"""Count a finished chunk and update the gauges of the scan."""
+		self.metrics.incr("chunks")
+		self.metrics.incr("blocks", end_block - start_block + 1)
+		self.metrics.set("last_block", end_block)
+		self.metrics.set("chunk_size", end_block - start_block + 1)
+		if duration > 0:
+			self.metrics.set("events_per_second", events_count / duration)
+			self.metrics.set("blocks_per_second", (end_block - start_block + 1) / duration)
+		if self.logs_per_block is not None:
+			self.metrics.set("logs_per_block", self.logs_per_block)
+
+	def _new_heads(self, ws_url: Optional[str], poll_interval: float, stop: threading.Event):
+		"""Yield the number of each new chain head.
+
+		Heads come from an `eth_subscribe` newHeads websocket subscription if `ws_url` is given,
+		and from polling `eth_blockNumber` every `poll_interval` seconds otherwise, or if the websocket fails.
+		"""
+		if ws_url:
+			try:
+				from websockets.sync.client import connect
+				with connect(ws_url) as ws:
+					ws.send(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]}))
+					reply = json.loads(ws.recv(timeout=30))
+					if "error" in reply:
+						raise ValueError(reply["error"])
+					logger.info("Subscribed to new heads at %s", ws_url)
+					while not stop.is_set():
+						try:
+							message = json.loads(ws.recv(timeout=poll_interval))
+						except TimeoutError:
+							continue
+						head = message.get("params", {}).get("result", {})
+						if "number" in head:
+							yield int(head["number"], 16)
+				return
+			except Exception as e:
+				logger.warning("New heads subscription at %s failed with %s, polling for new blocks instead", ws_url, e)
+
+		last_head = None
+		while not stop.is_set():
+			head = self.web3.eth.block_number
+			if head != last_head:
+				last_head = head
+				yield head
+			stop.wait(poll_interval)
+
+	def follow(self, start_block: Optional[int] = None, ws_url: Optional[str] = None, poll_interval: float = 2.0,
+			   confirmations: int = 1, stop: Optional[threading.Event] = None, progress_callback: Optional[Callable] = None):
+		"""Keep scanning new blocks as they are mined, until `stop` is set or CTRL+C.
+
+		Each new head triggers a scan of just the blocks mined since the previous one,
+		checkpointed through the state's `end_chunk` as usual.
+
+		:param start_block: First block to scan, defaults to the block after the last scanned block
+
+		:param ws_url: Websocket JSON-RPC endpoint to subscribe to new heads, we poll if not given
+
+		:param poll_interval: Seconds between polls for a new block number
+
+		:param confirmations: How many blocks must be mined on top of a block before we scan it
+
+		:param stop: Event that ends the loop when set, e.g. from another thread
+
+		:param progress_callback: Called after each chunk, like in `scan`
+		"""
+
+		if stop is None:
+			stop = threading.Event()
+		if start_block is None:
+			start_block = self.get_last_scanned_block() + 1
+
+		next_block = start_block
+		for head in self._new_heads(ws_url, poll_interval, stop):
+			end_block = head - confirmations
+			if end_block < next_block:
+				continue
+
+			# Roll back to where the chain forked, if it did since the last head
+			self.get_finalized_block()
+			fork_block = self.find_fork_point()
+			if fork_block is not None and fork_block < next_block:
+				if self.finalized_block is not None:
+					fork_block = max(fork_block, self.finalized_block + 1)
+				self.delete_potentially_forked_block_data(fork_block)
+				next_block = fork_block
+
+			while next_block <= end_block:
+				self.state.start_chunk(next_block, end_block - next_block + 1)
+				chunk_end_block = min(end_block, next_block + self.max_scan_chunk_size - 1)
+				start = time.time()
+				with self._profile(next_block, chunk_end_block):
+					actual_end_block, end_block_timestamp, new_entries = self.scan_chunk(next_block, chunk_end_block)
+				if progress_callback:
+					progress_callback(start_block, end_block, next_block, end_block_timestamp, actual_end_block - next_block + 1, len(new_entries))
+				self._record_chunk(next_block, actual_end_block, len(new_entries), time.time() - start)
+				self._end_chunk(actual_end_block)
+				logger.debug("Followed blocks %d - %d, %d events", next_block, actual_end_block, len(new_entries))
+				next_block = actual_end_block + 1
+
+	def _fetch_range(self, start_block, end_block) -> Tuple[list, dict, dict]:
+		"""Fetch all events, their block timestamps and the hashes of the unfinalized blocks of a block range, for a backfill worker.
+
+		Unlike `fetch_chunk` the whole range is covered,
+		if the JSON-RPC server makes us throttle down we fetch the rest with more calls.
+		Like `_fetch_blocks_of_chunk` the range is fetched again if the chain reorganised meanwhile.
+		"""
+		while True:
+			all_events = self._fetch_range_events(start_block, end_block)
+			with self.metrics.timer("block_timestamps"):
+				block_timestamps, block_hashes = self.get_blocks(
+					{evt["blockNumber"] for evt in all_events} | {end_block},
+					self.unfinalized_blocks(start_block, end_block))
+			forked = _forked_blocks(all_events, block_hashes)
+			if not forked:
+				return all_events, block_timestamps, block_hashes
+			logger.warning("Chain reorganisation at block %d while scanning blocks %d - %d, fetching them again", forked[0], start_block, end_block)
+			self.metrics.incr("reorgs_while_fetching")
+
+	def _fetch_range_events(self, start_block, end_block) -> list:
+		all_events = []
+		current_block = start_block
+		chunk_size = end_block - start_block + 1
+		with self.chunk_size_lock:
+			logs_per_block = self.logs_per_block
+		if logs_per_block:
+			# Split the range up front if it likely holds more logs than we want in one call
+			chunk_size = min(chunk_size, max(self.min_scan_chunk_size, int(self.target_logs_per_request / logs_per_block)))
+		while current_block <= end_block:
+			requested_end_block = min(current_block + chunk_size - 1, end_block)
+			with self.metrics.timer("fetch"):
+				actual_end_block, events, get_logs_seconds = self._fetch_chunk(current_block, requested_end_block)
+			chunk_size = self.estimate_next_chunk_size(
+				chunk_size,
+				len(events),
+				blocks_scanned=actual_end_block - current_block + 1,
+				duration=get_logs_seconds,
+				throttled=actual_end_block < requested_end_block)
+			all_events += events
+			current_block = actual_end_block + 1
+		return all_events
+
+	def iter_scan_parallel(self, start_block, end_block, workers=4, chunk_size=None) -> Iterator[ScanBatch]:
+		"""Backfill a block range with several JSON-RPC calls in flight at the same time, yielding each chunk as it is done.
+
+		The range is split into fixed size chunks that a pool of threads fetch concurrently.
+		Chunks are handed to the state strictly in block order, each between `start_chunk` and `end_chunk`,
+		so `last_scanned_block` checkpoints are the same as with `iter_scan`.
+		At most `2 * workers` fetched chunks wait in memory for their turn,
+		and no more are fetched while the caller is busy with a chunk.
+
+		:param start_block: The first block included in the scan
+
+		:param end_block: The last block included in the scan
+
+		:param workers: How many threads fetch from the JSON-RPC API at the same time
+
+		:param chunk_size: How many blocks each worker fetches at a time, defaults to the max chunk scan size
+		"""
+
+		assert start_block <= end_block
+
+		self.get_finalized_block()
+
+		if chunk_size is None:
+			chunk_size = self.max_scan_chunk_size
+
+		ranges = ((s, min(s + chunk_size - 1, end_block)) for s in range(start_block, end_block + 1, chunk_size))
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			in_flight = deque()
+
+			def submit_next():
+				block_range = next(ranges, None)
+				if block_range is not None:
+					in_flight.append( (block_range, executor.submit(self._fetch_range, *block_range)) )
+
+			for i in range(2 * workers):
+				submit_next()
+
+			try:
+				while in_flight:
+					(chunk_start, chunk_end), future = in_flight.popleft()
+					start = time.time()
+					with self.metrics.timer("wait_for_fetch"):
+						events, block_timestamps, block_hashes = future.result()
+					submit_next()
+
+					with self._profile(chunk_start, chunk_end):
+						self.state.start_chunk(chunk_start, chunk_end - chunk_start + 1)
+						new_entries = self.process_events(events, block_timestamps.get)
+						with self.metrics.timer("record_block_hash"):
+							self.record_block_hashes(block_hashes)
+					self._record_chunk(chunk_start, chunk_end, len(new_entries), time.time() - start)
+					try:
+						yield ScanBatch(chunk_start, chunk_end, block_timestamps[chunk_end], events, new_entries)
+					finally:
+						self._end_chunk(chunk_end)
+			finally:
+				# The caller stopped early, do not wait for fetches nobody will use
+				for _, future in in_flight:
+					future.cancel()
+
+	def scan_parallel(self, start_block, end_block, workers=4, chunk_size=None, progress_callback: Optional[Callable] = None) -> Tuple[
+		list, int]:
+		"""Backfill a block range with several JSON-RPC calls in flight at the same time.
+
+		Collects what `iter_scan_parallel` yields.
+
+		:param start_block: The first block included in the scan
+
+		:param end_block: The last block included in the scan
+
+		:param workers: How many threads fetch from the JSON-RPC API at the same time
+
+		:param chunk_size: How many blocks each worker fetches at a time, defaults to the max chunk scan size
+
+		:param progress_callback: If this is an UI application, update the progress of the scan
 
-def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
+		:return: [All processed events, number of chunks used]
+		"""
+
+		all_processed = []
+		total_chunks_scanned = 0
+
+		for batch in self.iter_scan_parallel(start_block, end_block, workers, chunk_size):
+			all_processed += batch.processed
+			total_chunks_scanned += 1
+
+			if progress_callback:
+				progress_callback(start_block, end_block, batch.start_block, batch.end_block_timestamp, batch.end_block - batch.start_block + 1, len(batch.processed))
+
+		return all_processed, total_chunks_scanned
+
+
+# Kinds of JSON-RPC failures, see classify_rpc_error
+RANGE_TOO_LARGE = "range_too_large"
+RATE_LIMITED = "rate_limited"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# Provider messages that mean the block range or the response was too large
+_range_too_large_messages = [
+	"query returned more than",  # Infura
+	"log response size exceeded",  # Alchemy
+	"response size",
+	"block range",  # "block range is too wide", "block range too large", "exceed maximum block range"
+	"range is too large",
+	"is limited to a",  # QuickNode "eth_getLogs is limited to a 10,000 range"
+	"too many results",
+	"query timeout exceeded",
+	"context deadline exceeded",
+	"context canceled",
+	"context cancelled",
+	"limit exceeded",
+]
+_rate_limited_messages = [
+	"rate limit",
+	"too many requests",
+	"exceeded its compute units",
+	"capacity exceeded",
+	"throughput",
+]
+_fatal_messages = [
+	"invalid argument",
+	"invalid params",
+	"method not found",
+	"does not exist/is not available",
+	"unauthorized",
+	"invalid api key",
+]
+
+# "[0x1b4, 0x1c2]" style block range hints (Infura, Alchemy)
+_range_hint = re.compile(r"\[\s*(0x[0-9a-fA-F]+|\d+)\s*,\s*(0x[0-9a-fA-F]+|\d+)\s*\]")
+# "up to a 2K block range", "limited to a 10,000 range", "maximum block range: 5000"
+_span_hint = re.compile(r"(?:up to a|limited to a|maximum block range:?|max(?:imum)? range(?: is)?:?)\s*([\d,]+)\s*(k?)", re.IGNORECASE)
+
+def _hex_hash(value) -> str:
+	"""A block hash as a lowercase 0x prefixed hex string, whether it is a JSON-RPC string or bytes."""
+	if isinstance(value, str):
+		return value.lower()
+	return "0x" + bytes(value).hex()
+
+
+def _forked_blocks(events, block_hashes: dict) -> list:
+	"""Numbers of the blocks whose events came from another fork than the block hashes we fetched."""
+	return sorted({ evt["blockNumber"] for evt in events
+		if evt["blockNumber"] in block_hashes and _hex_hash(evt["blockHash"]) != _hex_hash(block_hashes[evt["blockNumber"]]) })
+
+
+def _parse_block_number(value):
+	return int(value, 16) if value.lower().startswith("0x") else int(value)
+
+def classify_rpc_error(e: Exception) -> Tuple[str, Optional[Tuple[int, int]], Optional[int]]:
+	"""Tell what kind of failure an exception from a JSON-RPC call is.
+
+	:return: tuple(kind, block range the provider suggested or None, max block span the provider mentioned or None)
+	"""
+	if isinstance(e, (TypeError, AttributeError, KeyError, AssertionError)):
+		# Bugs on our side, retrying does not help
+		return FATAL, None, None
+
+	status = getattr(getattr(e, "response", None), "status_code", None)
+	message = str(e)
+	if e.args and isinstance(e.args[0], dict):
+		message = str(e.args[0].get("message", "")) + " " + str(e.args[0].get("data", ""))
+	lowered = message.lower()
+
+	suggested_range = None
+	m = _range_hint.search(message)
+	if m:
+		suggested_range = (_parse_block_number(m.group(1)), _parse_block_number(m.group(2)))
+	max_span = None
+	m = _span_hint.search(message)
+	if m:
+		max_span = int(m.group(1).replace(",", "")) * (1000 if m.group(2) else 1)
+
+	if status == 429 or any(text in lowered for text in _rate_limited_messages):
+		return RATE_LIMITED, None, None
+	if status in (401, 403) or any(text in lowered for text in _fatal_messages):
+		return FATAL, None, None
+	if suggested_range or max_span or any(text in lowered for text in _range_too_large_messages):
+		return RANGE_TOO_LARGE, suggested_range, max_span
+	if isinstance(e, requests.exceptions.ReadTimeout):
+		# Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
+		# from Go Ethereum. This translates to the error "context was cancelled" on the server side:
+		# https://github.com/ethereum/go-ethereum/issues/20426
+		return RANGE_TOO_LARGE, None, None
+	if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError, TimeoutError)) \
+			or (status is not None and status >= 500):
+		return TRANSIENT, None, None
+	# Unknown node errors, throttle down the range like we always did
+	return RANGE_TOO_LARGE, None, None
+
+def _retry_web3_call(func, start_block, end_block, retries, delay, max_delay=60.0, on_retry=None) -> Tuple[int, list]:
 	"""A custom retry loop to throttle down block range.
 
 	If our JSON-RPC server cannot serve all incoming `eth_getLogs` in a single request,
@@ -318,50 +1001,81 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
 	For example, Go Ethereum does not indicate what is an acceptable response size.
 	It just fails on the server-side with a "context was cancelled" warning.
 
+	Failures are classified with `classify_rpc_error`:
+
+	* Range too large: retry at once with a smaller range, the one the provider suggested if it did, otherwise half
+	* Rate limited or transient network errors: retry the same range after a jittered exponential backoff
+	* Fatal: raise at once
+
 	:param func: A callable that triggers Ethereum JSON-RPC, as func(start_block, end_block)
 	:param start_block: The initial start block of the block range
 	:param end_block: The initial start block of the block range
 	:param retries: How many times we retry
-	:param delay: Time to sleep between retries
+	:param delay: Base time to sleep between retries of rate limited or failed requests
+	:param max_delay: Longest time we sleep between retries
+	:param on_retry: Optional callable(kind, start_block, end_block, new_end_block, sleep_seconds) called before each retry
 	"""
+	backoffs = 0
 	for i in range(retries):
 		try:
 			return end_block, func(start_block, end_block)
 		except Exception as e:
-			# Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
-			# from Go Ethereum. This translates to the error "context was cancelled" on the server side:
-			# https://github.com/ethereum/go-ethereum/issues/20426
-			if i < retries - 1:
-				# Give some more verbose info than the default middleware
-				logger.warning(
-					"Retrying events for block range %d - %d (%d) failed with %s, retrying in %s seconds",
-					start_block,
-					end_block,
-					end_block-start_block,
-					e,
-					delay)
-				# Decrease the `eth_get_blocks` range
-				end_block = start_block + ((end_block - start_block) // 2)
-				# Let the JSON-RPC to recover e.g. from restart
-				time.sleep(delay)
-				continue
-			else:
-				logger.warning("Out of retries")
+			kind, suggested_range, max_span = classify_rpc_error(e)
+
+			if kind == FATAL or i == retries - 1:
+				if kind != FATAL:
+					logger.warning("Out of retries")
 				raise
 
+			if kind == RANGE_TOO_LARGE and end_block > start_block:
+				# Decrease the `eth_getLogs` range, no need to wait for the node
+				new_end_block = start_block + ((end_block - start_block) // 2)
+				if suggested_range and suggested_range[0] == start_block and start_block <= suggested_range[1] < end_block:
+					new_end_block = suggested_range[1]
+				elif max_span:
+					new_end_block = min(new_end_block, start_block + max_span - 1)
+				sleep = 0
+			else:
+				# Let the JSON-RPC to recover e.g. from restart or rate limiting
+				sleep = min(max_delay, delay * (2 ** backoffs)) * random.uniform(0.5, 1.5)
+				backoffs += 1
+				new_end_block = end_block
+
+			# Give some more verbose info than the default middleware
+			logger.warning(
+				"Retrying events for block range %d - %d (%d) failed with %s (%s), retrying with %d - %d in %.1f seconds",
+				start_block,
+				end_block,
+				end_block-start_block,
+				e,
+				kind,
+				start_block,
+				new_end_block,
+				sleep)
+			if on_retry:
+				on_retry(kind, start_block, end_block, new_end_block, sleep)
+			end_block = new_end_block
+			if sleep:
+				time.sleep(sleep)
+
 
 def _fetch_events_for_all_contracts(
 		web3,
 		event,
 		argument_filters: dict,
 		from_block: int,
-		to_block: int) -> Iterable:
+		to_block: int,
+		decoder: Optional[LogDecoder] = None,
+		metrics: Optional[ScanMetrics] = None,
+		durations: Optional[list] = None) -> Iterable:
 	"""Get events using eth_getLogs API.
 
 	This method is detached from any contract instance.
 
 	This is a stateless method, as opposed to createFilter.
 	It can be safely called against nodes which do not provide `eth_newFilter` API, like Infura.
+
+	The seconds the `eth_getLogs` call took are appended to `durations` if given.
 	"""
 
 	if from_block is None:
@@ -397,18 +1111,66 @@ def _fetch_events_for_all_contracts(
 
 	# Call JSON-RPC API on your Ethereum node.
 	# get_logs() returns raw AttributedDict entries
-	logs = web3.eth.get_logs(event_filter_params)
+	start = time.time()
+	with metrics.timer("rpc", method="eth_getLogs") if metrics else nullcontext():
+		logs = web3.eth.get_logs(event_filter_params)
+	if durations is not None:
+		durations.append(time.time() - start)
 
 	# Convert raw binary data to Python proxy objects as described by ABI
-	all_events = []
-	for log in logs:
-		# Convert raw JSON-RPC log result to human readable event by using ABI data
-		# More information how processLog works here
-		# https://github.com/ethereum/web3.py/blob/fbaf1ad11b0c7fac09ba34baff2c256cffe0a148/web3/_utils/events.py#L200
-		evt = get_event_data(codec, abi, log)
-		# Note: This was originally yield,
-		# but deferring the timeout exception caused the throttle logic not to work
-		all_events.append(evt)
-	return all_events
+	# Note: This was originally yield,
+	# but deferring the timeout exception caused the throttle logic not to work
+	if decoder is None:
+		decoder = LogDecoder([abi], codec)
+	with metrics.timer("decode") if metrics else nullcontext():
+		return decoder.decode_logs(logs)
+
+
+
+
+def _fetch_events_for_all_event_types(
+		web3,
+		events: List,
+		argument_filters: dict,
+		from_block: int,
+		to_block: int,
+		decoder: Optional[LogDecoder] = None,
+		metrics: Optional[ScanMetrics] = None,
+		durations: Optional[list] = None) -> Iterable:
+	"""Get events of several types using a single eth_getLogs call.
+
+	The filter carries an OR list of topic0 values, one per event type,
+	and every returned log is decoded with the ABI that matches its topic0.
+
+	Only the `address` entry of `argument_filters` is used,
+	as argument filters of different events cannot be combined in one query.
+
+	The seconds the `eth_getLogs` call took are appended to `durations` if given.
+	"""
+
+	if from_block is None:
+		raise TypeError("Missing mandatory keyword argument to getLogs: fromBlock")
+
+	if decoder is None:
+		decoder = LogDecoder([event._get_event_abi() for event in events], web3.codec)
+
+	# topic0 is the keccak of the event signature
+	event_filter_params = {
+		"topics": [[Web3.to_hex(topic) for topic in decoder.topics]],
+		"fromBlock": from_block,
+		"toBlock": to_block,
+	}
+	if argument_filters.get("address") is not None:
+		event_filter_params["address"] = argument_filters["address"]
+
+	logger.debug("Querying eth_getLogs with the following parameters: %s", event_filter_params)
 
+	start = time.time()
+	with metrics.timer("rpc", method="eth_getLogs") if metrics else nullcontext():
+		logs = web3.eth.get_logs(event_filter_params)
+	if durations is not None:
+		durations.append(time.time() - start)
 
+	# Logs without a topic0 we know are anonymous events we did not ask for, the decoder skips them
+	with metrics.timer("decode") if metrics else nullcontext():
+		return decoder.decode_logs(logs)
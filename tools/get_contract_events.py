@@ -3,7 +3,15 @@ Scan the chain for all events from a specific contract
 """
 
 from .eventscanner import EventScanner, EventScannerState
-from .scannerstate import JSONifiedState, TabularState
+from .scannerstate import TabularState
+from .jsonlstate import JSONLinesState
+from .parquetstate import ParquetState
+from .sqlitestate import SQLiteState
+from .multiplexstate import MultiplexState
+from .aggregatestate import AggregatingState, default_aggregates
+from .senders import SenderCache, resolve_senders
+from .blocktimes import BlockTimestampCache
+from .metrics import ChunkProfiler
 
 import datetime
 import time
@@ -26,18 +34,27 @@ import sys
 from web3.providers.rpc import HTTPProvider
 from tqdm import tqdm
 
-from utils import get_cached_abi, get_event_args, get_proxy_address
+from utils import get_cached_abi, get_event_args, get_event_types, get_proxy_address
 
 logger = logging.getLogger(__name__)
 
 import pandas as pd
 
-#def getContractEvents(api_url,min_start_block,contract_address,outfile,db_columns,scanned_events,abikw=""):
-def getContractEvents(api_url,min_start_block,contract_address,outfile,scanned_events,abikw="",follow_proxy=True):
-	# Enable logs to the stdout.
-	# DEBUG is very verbose level
-	logging.basicConfig(level=logging.INFO)
+def make_state(outfile,db_columns,event_types):
+	"""
+	Pick the state implementation from the output file name
+	outfile ending in .parquet is a directory of Parquet files, .sqlite or .db a SQLite database,
+	.jsonl a directory of JSON lines segments, anything else is a single csv
+	"""
+	if outfile.endswith(".parquet"):
+		return ParquetState(root=outfile,event_types=event_types)
+	if outfile.endswith(".sqlite") or outfile.endswith(".db"):
+		return SQLiteState(fname=outfile,event_types=event_types)
+	if outfile.endswith(".jsonl"):
+		return JSONLinesState(root=outfile)
+	return TabularState(fname=outfile,columns=db_columns)
 
+def _connect(api_url):
 	provider = HTTPProvider(api_url)
 
 	# Remove the default JSON-RPC retry middleware
@@ -45,8 +62,16 @@ def getContractEvents(api_url,min_start_block,contract_address,outfile,scanned_e
 	# throttle down.
 	provider.middlewares.clear()
 
-	web3 = Web3(provider)
+	return Web3(provider)
 
+def _load_contract(web3,contract_address,scanned_events,abikw="",follow_proxy=True,with_address=False):
+	"""
+	Get the abi of a contract, following proxies
+	Returns the checksum address, the contract, the columns and the (name, type) event arguments for the state and the events to scan,
+	or None if there is no abi
+	Events in scanned_events that are not in the abi are skipped
+	With with_address=True the contract (and so its events) carries its address, so the scanner decodes its logs only
+	"""
 	checksum_address = Web3.to_checksum_address(contract_address)
 	abi_address = checksum_address
 	if follow_proxy:
@@ -58,19 +83,158 @@ def getContractEvents(api_url,min_start_block,contract_address,outfile,scanned_e
 	abi = get_cached_abi(abi_address,abikw)
 	if abi is None:
 		print( f"Failed to get abi for {abi_address}" )
-		return
+		return None
 	event_names, event_args = get_event_args( checksum_address,scanned_events,abikw)
 	db_columns = event_args
+	event_types = get_event_types( checksum_address,scanned_events,abikw)
+
+	if with_address:
+		contract = web3.eth.contract(address=checksum_address,abi=abi)
+	else:
+		contract = web3.eth.contract(abi=abi)
+
+	missing = [evt for evt in scanned_events if evt not in event_names]
+	if missing:
+		print( f"{checksum_address} has no events {missing}, skipping them" )
+	target_events = [getattr(contract.events,evt) for evt in scanned_events if evt in event_names]
+
+	return checksum_address, contract, db_columns, event_types, target_events
+
+def _scan_blocks(scanner,start_block,end_block,workers,write_metrics):
+	"""
+	Scan start_block - end_block with a progress bar in the console
+	Returns the number of events and the number of chunks scanned
+	"""
+	events_scanned = 0
+	total_chunks_scanned = 0
+	with tqdm(total=end_block - start_block) as progress_bar:
+		# Stream the scan chunk by chunk, so memory does not grow with the number of events
+		if workers > 1:
+			batches = scanner.iter_scan_parallel(start_block, end_block, workers=workers)
+		else:
+			batches = scanner.iter_scan(start_block, end_block)
+		for batch in batches:
+			chunk_size = batch.end_block - batch.start_block + 1
+			if batch.end_block_timestamp:
+				formatted_time = batch.end_block_timestamp.strftime("%d-%m-%Y")
+			else:
+				formatted_time = "no block time available"
+			progress_bar.set_description(f"Current block: {batch.start_block} ({formatted_time}), blocks in a scan batch: {chunk_size}, events processed in a batch {len(batch.events)}")
+			progress_bar.update(chunk_size)
+			events_scanned += len(batch.events)
+			total_chunks_scanned += 1
+			write_metrics()
+	return events_scanned, total_chunks_scanned
+
+def _run_scan(scanner,state,min_start_block,workers=1,follow=False,ws_url=None,metrics_file=None,metrics_port=None,end_block=None):
+	"""
+	Scan from where the state left off to the end of the chain, or to end_block if given, and keep following new blocks with follow=True
+	Stage timings and counters are written to metrics_file (Prometheus text if it ends in .prom, JSON otherwise) every 10 seconds,
+	and served at http://127.0.0.1:<metrics_port>/metrics if metrics_port is given
+	"""
+	metrics = scanner.metrics
+	if metrics_port:
+		metrics.serve(metrics_port)
+	last_metrics_write = [0]
+	def _write_metrics(force=False):
+		if metrics_file and (force or time.time() - last_metrics_write[0] > 10):
+			metrics.write(metrics_file)
+			last_metrics_write[0] = time.time()
+
+	# Assume we might have scanned the blocks all the way to the last Ethereum block
+	# that mined a few seconds before the previous scan run ended.
+	# Because there might have been a minor Etherueum chain reorganisations
+	# since the last scan ended, we compare the hashes of the last scanned blocks with the node's
+	# and discard the blocks after the fork point, if there is one.
+	# Finalized blocks are never rescanned.
+
+	# Scan from [first block after the fork, or last block scanned] - [latest ethereum block]
+	start_block = max(scanner.get_suggested_scan_start_block(), min_start_block)
+	scanner.delete_potentially_forked_block_data(start_block)
+	if end_block is None:
+		end_block = scanner.get_suggested_scan_end_block()
+
+	# Render a progress bar in the console
+	start = time.time()
+	events_scanned = 0
+	total_chunks_scanned = 0
+	if start_block > end_block:
+		# Rerun before a new block was mined, nothing to scan
+		print(f"No new blocks to scan, last scanned block {start_block - 1}")
+	else:
+		print(f"Scanning events from blocks {start_block} - {end_block}")
+		events_scanned, total_chunks_scanned = _scan_blocks(scanner,start_block,end_block,workers,_write_metrics)
+
+	with metrics.timer("save"):
+		state.save()
+	duration = time.time() - start
+	print(f"Scanned total {events_scanned} events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed")
+	print(metrics.summary())
+	_write_metrics(force=True)
+
+	if follow:
+		def _log_new_events(start, end, current, current_block_timestamp, chunk_size, events_count):
+			if events_count > 0:
+				print(f"Block {current + chunk_size - 1}: {events_count} new events")
+			_write_metrics()
+
+		follow_from = max(start_block, end_block + 1)
+		print(f"Following new blocks from {follow_from}")
+		try:
+			scanner.follow(start_block=follow_from, ws_url=ws_url, progress_callback=_log_new_events)
+		except KeyboardInterrupt:
+			pass
+		with metrics.timer("save"):
+			state.save()
+		_write_metrics(force=True)
+
+def _total_supply(web3,address,abi,block):
+	"""
+	totalSupply() of a token at a block, 0 if the contract has no totalSupply or the node has no state for that block
+	"""
+	try:
+		return web3.eth.contract(address=address,abi=abi).functions.totalSupply().call(block_identifier=block)
+	except Exception as e:
+		print( f"Failed to read the total supply of {address} at block {block}, the supply series starts from 0" )
+		print( e )
+		return 0
+
+#def getContractEvents(api_url,min_start_block,contract_address,outfile,db_columns,scanned_events,abikw=""):
+def getContractEvents(api_url,min_start_block,contract_address,outfile,scanned_events,abikw="",follow_proxy=True,workers=1,follow=False,ws_url=None,
+		metrics_file=None,metrics_port=None,profile_every=0,aggregates_file=None,initial_supply=None):
+	"""
+	Scan the chain for events of one contract and save them to outfile
+	With workers > 1 the blocks are fetched by that many threads at the same time, which speeds up long backfills
+	With follow=True we keep scanning new blocks as they are mined until CTRL+C, using a newHeads subscription at ws_url if given
+	Timings of each stage of the scan are printed at the end, written to metrics_file and served on metrics_port if given,
+	and with profile_every > 0 one chunk out of that many is profiled with cProfile
+	With aggregates_file, event counts, counts by transaction sender and the supply series are updated at the end of every chunk
+	and written to that file, see tools/aggregatestate.py
+	initial_supply is the supply before the first scanned event, e.g. what the constructor minted without emitting an event,
+	if not given it is read with totalSupply() at min_start_block, which should be the block the contract was deployed in
+	"""
+	# Enable logs to the stdout.
+	# DEBUG is very verbose level
+	logging.basicConfig(level=logging.INFO)
 
-	contract = web3.eth.contract(abi=abi)
+	web3 = _connect(api_url)
 
-	state = TabularState(fname=outfile,columns=db_columns)
+	loaded = _load_contract(web3,contract_address,scanned_events,abikw,follow_proxy)
+	if loaded is None:
+		return
+	checksum_address, contract, db_columns, event_types, target_events = loaded
+
+	state = make_state(outfile,db_columns,event_types)
+	if aggregates_file:
+		if initial_supply is None:
+			initial_supply = _total_supply(web3,checksum_address,contract.abi,min_start_block)
+		sender_cache = SenderCache()
+		state = AggregatingState(state,aggregates_file,aggregates=default_aggregates(initial_supply),
+			senders=lambda txhashes: resolve_senders(web3,txhashes,cache=sender_cache))
 
 	# Restore/create our persistent state
 	state.restore()
 
-	target_events = [getattr(contract.events,evt) for evt in scanned_events]
-
 	# chain_id: int, web3: Web3, abi: dict, state: EventScannerState, events: List, filters: {}, max_chunk_scan_size: int=10000
 	scanner = EventScanner(
 		web3=web3,
@@ -78,42 +242,94 @@ def getContractEvents(api_url,min_start_block,contract_address,outfile,scanned_e
 		state=state,
 		events=target_events,
 		filters={"address": checksum_address}, #Get all events that are from the pool
-		# How many maximum blocks at the time we request from JSON-RPC
-		# and we are unlikely to exceed the response size limit of the JSON-RPC server
-		max_chunk_scan_size=100
+		# How many maximum blocks at the time we request from JSON-RPC,
+		# the scanner sizes chunks to stay under the response size limit of the JSON-RPC server
+		max_chunk_scan_size=10000,
+		# One eth_getLogs call per chunk for all scanned event types
+		single_filter=True,
+		# Block timestamps are kept on disk and shared by all scans of the same chain
+		block_timestamps=BlockTimestampCache.for_chain(web3),
+		profiler=ChunkProfiler(profile_every) if profile_every > 0 else None
 	)
 
-	# Assume we might have scanned the blocks all the way to the last Ethereum block
-	# that mined a few seconds before the previous scan run ended.
-	# Because there might have been a minor Etherueum chain reorganisations
-	# since the last scan ended, we need to discard
-	# the last few blocks from the previous scan results.
-	chain_reorg_safety_blocks = 10
-	scanner.delete_potentially_forked_block_data(state.get_last_scanned_block() - chain_reorg_safety_blocks)
+	_run_scan(scanner,state,min_start_block,workers,follow,ws_url,metrics_file,metrics_port)
 
-	# Scan from [last block scanned] - [latest ethereum block]
-	# Note that our chain reorg safety blocks cannot go negative
-	start_block = max(state.get_last_scanned_block() - chain_reorg_safety_blocks, min_start_block)
-	end_block = scanner.get_suggested_scan_end_block()
-	blocks_to_scan = end_block - start_block
+def getContractsEvents(api_url,min_start_block,outfiles,scanned_events,follow_proxy=True,workers=1,follow=False,ws_url=None,
+		metrics_file=None,metrics_port=None,profile_every=0):
+	"""
+	Scan the chain for events of several contracts in one pass and save the events of each contract to its own file
+	outfiles is a dictionary of contract address: outfile, the format of each file is picked by make_state
+	scanned_events is a list of event names scanned in every contract (events a contract does not have are skipped),
+	or a dictionary of contract address: list of event names
+	Every chunk of blocks is fetched with a single eth_getLogs call filtering on all the addresses,
+	and each log is decoded with the abi of the contract that emitted it
+	Contracts that are behind the others, e.g. just added to outfiles, are first scanned on their own until they catch up
+	"""
+	logging.basicConfig(level=logging.INFO)
 
-	print(f"Scanning events from blocks {start_block} - {end_block}")
+	web3 = _connect(api_url)
 
-	# Render a progress bar in the console
-	start = time.time()
-	with tqdm(total=blocks_to_scan) as progress_bar:
-		def _update_progress(start, end, current, current_block_timestamp, chunk_size, events_count):
-			if current_block_timestamp:
-				formatted_time = current_block_timestamp.strftime("%d-%m-%Y")
-			else:
-				formatted_time = "no block time available"
-			progress_bar.set_description(f"Current block: {current} ({formatted_time}), blocks in a scan batch: {chunk_size}, events processed in a batch {events_count}")
-			progress_bar.update(chunk_size)
+	states = {}
+	events_by_address = {}
+	for contract_address, outfile in outfiles.items():
+		events = scanned_events.get(contract_address,[]) if isinstance(scanned_events,dict) else scanned_events
+		loaded = _load_contract(web3,contract_address,events,follow_proxy=follow_proxy,with_address=True)
+		if loaded is None:
+			continue
+		checksum_address, contract, db_columns, event_types, contract_events = loaded
+		if not contract_events:
+			print( f"Nothing to scan for {checksum_address}" )
+			continue
+		states[checksum_address] = make_state(outfile,db_columns,event_types)
+		events_by_address[checksum_address] = contract_events
 
-		# Run the scan
-		result, total_chunks_scanned = scanner.scan(start_block, end_block, progress_callback=_update_progress)
+	if not states:
+		print( f"No contracts to scan" )
+		return
 
-	state.save()
-	duration = time.time() - start
-	print(f"Scanned total {len(result)} Transfer events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed")
+	_scan_contracts(web3,states,events_by_address,min_start_block,BlockTimestampCache.for_chain(web3),workers,follow,ws_url,
+		metrics_file,metrics_port,profile_every)
+
+def _scan_contracts(web3,states,events_by_address,min_start_block,block_timestamps,workers=1,follow=False,ws_url=None,
+		metrics_file=None,metrics_port=None,profile_every=0):
+	"""
+	Bring every contract up to the one furthest ahead on its own, then scan all of them together with one filter
+	states and events_by_address are dictionaries of checksum address: state, and checksum address: events of the contract
+	"""
+	state = MultiplexState(states)
+	state.restore()
+	target_events = [ event for events in events_by_address.values() for event in events ]
+	addresses = list(events_by_address)
+
+	#A contract added to outfiles, or one that saved less before a crash, is scanned on its own up to the others
+	#so the joint scan does not start (and delete the data of every contract) from its first block
+	target_block = max(contract_state.get_last_scanned_block() for contract_state in states.values())
+	for checksum_address, contract_state in states.items():
+		if max(contract_state.get_last_scanned_block(), min_start_block - 1) >= target_block:
+			continue
+		print( f"Scanning {checksum_address} on its own up to block {target_block}" )
+		backfill_scanner = EventScanner(
+			web3=web3,
+			contract=None,
+			state=contract_state,
+			events=events_by_address[checksum_address],
+			filters={"address": checksum_address},
+			max_chunk_scan_size=10000,
+			single_filter=True,
+			block_timestamps=block_timestamps
+		)
+		_run_scan(backfill_scanner,contract_state,min_start_block,workers,end_block=target_block)
+
+	scanner = EventScanner(
+		web3=web3,
+		contract=None,
+		state=state,
+		events=target_events,
+		filters={"address": addresses}, #One filter for the logs of every contract
+		max_chunk_scan_size=10000,
+		single_filter=True,
+		block_timestamps=block_timestamps,
+		profiler=ChunkProfiler(profile_every) if profile_every > 0 else None
+	)
 
+	_run_scan(scanner,state,min_start_block,workers,follow,ws_url,metrics_file,metrics_port)
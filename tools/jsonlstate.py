@@ -0,0 +1,278 @@
+"""Scanner state that stores events in append-only JSON lines files.
+
+Events are appended, one JSON object per line in block order, to segment files in a directory:
+
+	<root>/<first block>.jsonl
+
+A new segment is started once the last one reaches `segment_bytes`.
+A checkpoint file in the root directory lists the segments with their first and last block and their byte size,
+which is the sorted block index of the store.
+
+Saving appends only the events since the previous save and rewrites the small checkpoint.
+A reorg rollback finds the segment holding the block with a bisect over the index,
+then the first line of that block with a binary search over the byte offsets of the sorted segment,
+and truncates there, so it never reads more than a few lines.
+Readers only see the bytes listed in the checkpoint, use `read_events` to stream events of a block range.
+
+Integers are written as JSON numbers, so uint256 amounts come back as exact Python ints.
+"""
+
+from .eventscanner import EventScannerState
+from .scannerstate import write_json_atomic
+from .rows import event_row
+
+import bisect
+import datetime
+import json
+import logging
+import os
+import re
+import time
+from typing import Iterator, Optional
+
+from web3.datastructures import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+_segment_re = re.compile(r"^(\d+)\.jsonl$")
+
+def _checkpoint_fname(root):
+	return os.path.join(root, "_checkpoint.json")
+
+def _json_value(value):
+	if isinstance(value, (bytes, bytearray)):
+		return "0x" + bytes(value).hex()
+	return str(value)
+
+def _line_block(f, offset):
+	"""Block number of the line starting at offset."""
+	f.seek(offset)
+	return json.loads(f.readline())["block_number"]
+
+def _line_start(f, pos):
+	"""Offset of the first line starting at or after pos."""
+	if pos == 0:
+		return 0
+	f.seek(pos - 1)
+	f.readline()
+	return f.tell()
+
+def _seek_block(f, size, block_number):
+	"""Offset of the first line of a segment with a block number >= block_number, size if there is none.
+
+	The lines of a segment are sorted by block, so this is a binary search over byte offsets.
+	"""
+	lo, hi = 0, size
+	while lo < hi:
+		mid = (lo + hi) // 2
+		start = _line_start(f, mid)
+		if start >= size or _line_block(f, start) >= block_number:
+			hi = mid
+		else:
+			lo = mid + 1
+	return _line_start(f, lo)
+
+def _read_checkpoint(root):
+	with open(_checkpoint_fname(root), "rt") as f:
+		return json.load(f)
+
+def read_events(root, start_block=None, end_block=None, event_names=None) -> Iterator[dict]:
+	"""Stream the events written by JSONLinesState in block order, one dict per event.
+
+	Only the segments that overlap [start_block, end_block] are opened,
+	and the first one is entered at start_block with a binary search.
+
+	:param event_names: Only yield events with one of these names
+	"""
+	segments = _read_checkpoint(root)["segments"]
+	first_segment = 0
+	if start_block is not None:
+		first_segment = bisect.bisect_left([last for first, last, fname, size in segments], start_block)
+	for first, last, fname, size in segments[first_segment:]:
+		if end_block is not None and first > end_block:
+			return
+		with open(os.path.join(root, fname), "rb") as f:
+			offset = _seek_block(f, size, start_block) if start_block is not None and first < start_block else 0
+			f.seek(offset)
+			while offset < size:
+				line = f.readline()
+				offset += len(line)
+				event = json.loads(line)
+				if end_block is not None and event["block_number"] > end_block:
+					return
+				if event_names is None or event["event_name"] in event_names:
+					yield event
+
+class JSONLinesState(EventScannerState):
+	"""Store scanned events in append-only JSON lines segments with a sorted block index.
+
+	Rows are buffered in memory as encoded lines and appended to the last segment when the state is saved.
+	"""
+
+	def __init__(self, root="test-state.jsonl", segment_bytes=64 * 1024 * 1024):
+		"""
+		:param root: Directory the segments and the checkpoint are written to
+		:param segment_bytes: Start a new segment once the last one is this large
+		"""
+		self.state = None
+		self.root = root
+		self.segment_bytes = segment_bytes
+		self.checkpoint_fname = _checkpoint_fname(root)
+		# How many second ago we saved the files
+		self.last_save = 0
+
+	def reset(self):
+		"""Create initial state of nothing scanned."""
+		self.state = {
+			"last_scanned_block": 0,
+		}
+		# One [first block, last block, file name, byte size] entry per segment, ordered by block
+		self.segments = []
+		self.block_hashes = {}
+		# (block number, encoded line) of the events since the last save
+		self.buffer = []
+
+	def restore(self):
+		"""Restore the last scan state from the checkpoint file.
+
+		Bytes appended after the checkpoint are cut off and files it does not list are removed,
+		their blocks will be scanned again.
+		"""
+		self.reset()
+		try:
+			checkpoint = _read_checkpoint(self.root)
+		except (IOError, json.decoder.JSONDecodeError):
+			print("State starting from scratch")
+			return
+
+		self.state["last_scanned_block"] = checkpoint["last_scanned_block"]
+		self.segments = checkpoint["segments"]
+		self.block_hashes = { int(block_number): block_hash for block_number, block_hash in checkpoint.get("block_hashes", {}).items() }
+
+		for i, (first, last, fname, size) in enumerate(self.segments):
+			path = os.path.join(self.root, fname)
+			actual = os.path.getsize(path) if os.path.exists(path) else -1
+			if actual < size:
+				# Lost or cut short outside of the scanner, scan it again
+				print(f"{path} is shorter than its checkpoint, scanning again from block {first}")
+				self.segments = self.segments[:i]
+				self.state["last_scanned_block"] = min(self.state["last_scanned_block"], max(first - 1, 0))
+				self.block_hashes = { block_number: block_hash for block_number, block_hash in self.block_hashes.items() if block_number < first }
+				# Readers go by the checkpoint, it must not list the segments removed below
+				self._write_checkpoint()
+				break
+			if actual > size:
+				os.truncate(path, size)
+
+		listed = { fname for first, last, fname, size in self.segments }
+		for fname in os.listdir(self.root):
+			if _segment_re.match(fname) and fname not in listed:
+				os.remove(os.path.join(self.root, fname))
+		print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
+
+	def _write_checkpoint(self):
+		os.makedirs(self.root, exist_ok=True)
+		write_json_atomic(self.checkpoint_fname, {
+			"last_scanned_block": self.state["last_scanned_block"],
+			"segments": self.segments,
+			"block_hashes": self.block_hashes,
+		})
+
+	def save(self):
+		"""Append the buffered events to the last segment and update the checkpoint."""
+		os.makedirs(self.root, exist_ok=True)
+		if len(self.buffer) > 0:
+			data = b"".join(line for block_number, line in self.buffer)
+			if len(self.segments) == 0 or self.segments[-1][3] >= self.segment_bytes:
+				first = self.buffer[0][0]
+				self.segments.append([first, first, f"{first:012d}.jsonl", 0])
+				mode = "wb"
+			else:
+				mode = "ab"
+			segment = self.segments[-1]
+			with open(os.path.join(self.root, segment[2]), mode) as f:
+				f.write(data)
+				f.flush()
+				os.fsync(f.fileno())
+			segment[1] = max(segment[1], self.buffer[-1][0])
+			segment[3] += len(data)
+			self.buffer = []
+		self._write_checkpoint()
+		self.last_save = time.time()
+
+	def iter_events(self, start_block=None, end_block=None, event_names=None) -> Iterator[dict]:
+		"""Stream the saved events, see `read_events`."""
+		if len(self.segments) == 0:
+			return iter(())
+		return read_events(self.root, start_block, end_block, event_names)
+
+	#
+	# EventScannerState methods implemented below
+	#
+
+	def get_last_scanned_block(self):
+		"""The number of the last block we have stored."""
+		return self.state["last_scanned_block"]
+
+	def delete_data(self, since_block):
+		"""Remove potentially reorganised blocks from the scan data."""
+		since = max(since_block, 0)
+		if since > self.get_last_scanned_block():
+			return
+		self.buffer = [ (block_number, line) for block_number, line in self.buffer if block_number < since ]
+
+		# Segments ending before since are kept whole
+		i = bisect.bisect_left([last for first, last, fname, size in self.segments], since)
+		removed = []
+		truncated = []
+		for segment in self.segments[i:]:
+			first, last, fname, size = segment
+			if first >= since:
+				removed.append(fname)
+				continue
+			with open(os.path.join(self.root, fname), "rb") as f:
+				offset = _seek_block(f, size, since)
+			truncated.append( (fname, offset) )
+			# Only an upper bound of the last block that is left
+			segment[1] = since - 1
+			segment[3] = offset
+		self.segments = [ segment for segment in self.segments if segment[2] not in removed ]
+
+		self.state["last_scanned_block"] = max(since - 1, 0)
+		self.block_hashes = { block_number: block_hash for block_number, block_hash in self.block_hashes.items() if block_number < since }
+		# A crash after the checkpoint is written is repaired by restore, which cuts the files to the checkpoint
+		self._write_checkpoint()
+		for fname, offset in truncated:
+			os.truncate(os.path.join(self.root, fname), offset)
+		for fname in removed:
+			os.remove(os.path.join(self.root, fname))
+
+	def record_block_hash(self, block_number, block_hash):
+		"""Remember the hash of a scanned block, written with the next checkpoint."""
+		self.block_hashes[block_number] = block_hash
+		for old_block in sorted(self.block_hashes)[:-self.max_block_hashes]:
+			del self.block_hashes[old_block]
+
+	def get_block_hashes(self):
+		return self.block_hashes
+
+	def start_chunk(self, block_number, chunk_size):
+		pass
+
+	def end_chunk(self, block_number):
+		"""Save at the end of each block, so we can resume in the case of a crash or CTRL+C"""
+		# Next time the scanner is started we will resume from this block
+		self.state["last_scanned_block"] = block_number
+
+		# Save the files for every minute
+		if time.time() - self.last_save > 60:
+			self.save()
+
+	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+		"""Record an event as a line in the buffer."""
+		row = event_row(block_when, event)
+		line = json.dumps(row, default=_json_value) + "\n"
+		self.buffer.append( (row["block_number"], line.encode()) )
+
+		# Return a pointer that allows us to look up this event later if needed
+		return f"{row['block_number']}-{row['txhash']}-{row['log_index']}"
@@ -0,0 +1,216 @@
+"""Token balances computed offline by replaying scanned events.
+
+Events are applied in (block, log index) order with Python integers, so balances are exact.
+The ledger writes a snapshot every `snapshot_interval` blocks with the balances of the addresses
+that changed since the previous snapshot. The balance of an address at any block is its latest
+snapshot at or before that block, plus a replay of the few events after the snapshot.
+
+Supported events:
+
+* Transfer(from, to, value)
+* Issue(amount) and Redeem(amount) of USDT, which credit and debit the contract owner without a Transfer event
+* DestroyedBlackFunds(_blackListedUser, _balance) of USDT, which zeroes a blacklisted balance without a Transfer event
+"""
+
+import bisect
+import logging
+import sqlite3
+
+import numpy as np
+
+from .rows import to_int
+
+logger = logging.getLogger(__name__)
+
+LEDGER_EVENTS = ["Transfer", "Issue", "Redeem", "DestroyedBlackFunds"]
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+class BalanceLedger:
+	"""Per-address balances of one token, built by replaying its events."""
+
+	def __init__(self, fname, owners=None, snapshot_interval=100000, initial_balances=None):
+		"""
+		:param fname: SQLite database the snapshots are stored in
+		:param owners: List of (from block, owner address), needed for Issue and Redeem.
+			The USDT owner has changed over time and ownership transfers emit no event, so it is not inferred.
+		:param snapshot_interval: Write the changed balances every this many blocks
+		:param initial_balances: Dict of address: balance before the first event, e.g. a constructor mint without an event
+		"""
+		self.fname = fname
+		self.owners = sorted(owners or [])
+		self.snapshot_interval = snapshot_interval
+		self.conn = sqlite3.connect(fname)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots (address TEXT, block_number INTEGER, balance TEXT, PRIMARY KEY (address, block_number))")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS ledger_state (key TEXT PRIMARY KEY, value INTEGER)")
+		self.conn.commit()
+		self.balances = {}
+		self.dirty = set()
+		self.last_block = 0
+		self.last_log_index = -1
+		self._restore()
+		if self.last_block == 0 and initial_balances:
+			for address, balance in initial_balances.items():
+				self.balances[address] = to_int(balance)
+				self.dirty.add(address)
+
+	def _restore(self):
+		"""Load the latest balance of every address from the snapshots."""
+		state = dict(self.conn.execute("SELECT key, value FROM ledger_state"))
+		self.last_block = state.get("last_block", 0)
+		self.last_log_index = state.get("last_log_index", -1)
+		# SQLite returns the balance of the row with the max block_number for each address
+		for address, block_number, balance in self.conn.execute("SELECT address, MAX(block_number), balance FROM snapshots GROUP BY address"):
+			self.balances[address] = int(balance)
+
+	def owner_at(self, block_number):
+		i = bisect.bisect_right([from_block for from_block, owner in self.owners], block_number) - 1
+		if i < 0:
+			raise ValueError(f"No owner known at block {block_number}, pass owners to BalanceLedger")
+		return self.owners[i][1]
+
+	def _apply(self, balances, row):
+		"""Apply one event to a balances dict, return the addresses it changed."""
+		event_name = row["event_name"]
+		if event_name == "Transfer":
+			value = to_int(row["value"])
+			sender, receiver = row["from"], row["to"]
+			balances[sender] = balances.get(sender, 0) - value
+			balances[receiver] = balances.get(receiver, 0) + value
+			return (sender, receiver)
+		if event_name == "Issue" or event_name == "Redeem":
+			owner = self.owner_at(row["block_number"])
+			amount = to_int(row["amount"])
+			balances[owner] = balances.get(owner, 0) + (amount if event_name == "Issue" else -amount)
+			return (owner,)
+		if event_name == "DestroyedBlackFunds":
+			user = row["_blackListedUser"]
+			balances[user] = balances.get(user, 0) - to_int(row["_balance"])
+			return (user,)
+		return ()
+
+	def apply(self, row):
+		"""Apply one event, given as a dict with event_name, block_number, log_index and the event arguments.
+
+		Events at or before the last applied one are skipped, so replaying overlapping ranges is safe.
+		"""
+		block_number, log_index = int(row["block_number"]), int(row["log_index"])
+		if (block_number, log_index) <= (self.last_block, self.last_log_index):
+			return
+		if block_number // self.snapshot_interval > self.last_block // self.snapshot_interval:
+			# First event past a snapshot boundary, the balances are those at the end of the previous interval
+			self._write_snapshot(block_number // self.snapshot_interval * self.snapshot_interval - 1)
+		self.dirty.update(self._apply(self.balances, row))
+		self.last_block, self.last_log_index = block_number, log_index
+
+	def replay(self, rows, queries=None, events=None):
+		"""Apply an iterable of events in block and log index order.
+
+		:param queries: Optional iterable of (address, block number) whose balances we record during the replay
+		:param events: Event source for balance_at, needed for queries before the last block the ledger had already applied,
+			e.g. when a persistent ledger is replayed again on the next run
+		:return: Dict of (address, block number): balance at the end of that block, for the queries
+		"""
+		pending = []
+		answers = {}
+		for address, block_number in (queries or []):
+			if int(block_number) < self.last_block:
+				# The events of that block were applied on an earlier run, the balances have moved on since
+				answers[(address, int(block_number))] = self.balance_at(address, int(block_number), events)
+			else:
+				pending.append( (int(block_number), address) )
+		pending.sort()
+		i = 0
+		for row in rows:
+			block_number = int(row["block_number"])
+			while i < len(pending) and pending[i][0] < block_number:
+				answers[(pending[i][1], pending[i][0])] = self.balances.get(pending[i][1], 0)
+				i += 1
+			self.apply(row)
+		for block_number, address in pending[i:]:
+			answers[(address, block_number)] = self.balances.get(address, 0)
+		return answers
+
+	def _write_snapshot(self, block_number):
+		if not self.dirty:
+			return
+		self.conn.executemany("INSERT OR REPLACE INTO snapshots (address, block_number, balance) VALUES (?, ?, ?)",
+			[ (address, block_number, str(self.balances.get(address, 0))) for address in self.dirty ])
+		self.dirty = set()
+
+	def save(self):
+		"""Write a snapshot of the balances changed since the last one and commit."""
+		self._write_snapshot(self.last_block)
+		self.conn.executemany("INSERT OR REPLACE INTO ledger_state (key, value) VALUES (?, ?)",
+			[ ("last_block", self.last_block), ("last_log_index", self.last_log_index) ])
+		self.conn.commit()
+
+	def rollback(self, since_block):
+		"""Forget everything at or after since_block, e.g. after a chain reorganisation.
+
+		Events from the returned block + 1 onwards have to be replayed again.
+		"""
+		self.conn.execute("DELETE FROM snapshots WHERE block_number >= ?", (since_block,))
+		row = self.conn.execute("SELECT MAX(block_number) FROM snapshots").fetchone()
+		last_block = row[0] or 0
+		self.conn.executemany("INSERT OR REPLACE INTO ledger_state (key, value) VALUES (?, ?)",
+			[ ("last_block", last_block), ("last_log_index", 2**31) ])
+		self.conn.commit()
+		self.balances = {}
+		self.dirty = set()
+		self._restore()
+		return last_block
+
+	def balance_at(self, address, block_number, events=None):
+		"""Balance of an address at the end of a block.
+
+		:param events: Callable (address, from block, to block) returning the events of that block range
+			that may touch the address, in order. Needed when the block is not a snapshot block, see sqlite_event_source.
+		"""
+		if block_number >= self.last_block:
+			return self.balances.get(address, 0)
+
+		row = self.conn.execute(
+			"SELECT block_number, balance FROM snapshots WHERE address = ? AND block_number <= ? ORDER BY block_number DESC LIMIT 1",
+			(address, block_number)).fetchone()
+		snapshot_block, balance = (row[0], int(row[1])) if row else (-1, 0)
+		if snapshot_block == block_number:
+			return balance
+		if events is None:
+			raise ValueError(f"Balance at block {block_number} needs a replay from snapshot {snapshot_block}, pass events")
+
+		balances = {address: balance}
+		for evt in events(address, snapshot_block + 1, block_number):
+			self._apply(balances, evt)
+		return balances[address]
+
+def dataframe_event_source(df):
+	"""Event source for BalanceLedger.balance_at reading a DataFrame of events sorted by block and log index."""
+	block_numbers = df['block_number'].to_numpy()
+	def events(address, from_block, to_block):
+		first = np.searchsorted(block_numbers, from_block, side='left')
+		last = np.searchsorted(block_numbers, to_block, side='right')
+		rows = df.iloc[first:last]
+		touches = rows['event_name'].isin(['Issue', 'Redeem'])
+		for col in ['from', 'to', '_blackListedUser']:
+			if col in rows.columns:
+				touches |= rows[col] == address
+		return rows[touches].to_dict('records')
+	return events
+
+def sqlite_event_source(fname):
+	"""Event source for BalanceLedger.balance_at reading a database written by SQLiteState."""
+	def events(address, from_block, to_block):
+		conn = sqlite3.connect(fname)
+		conn.row_factory = sqlite3.Row
+		try:
+			rows = conn.execute(
+				'SELECT * FROM events WHERE block_number >= ? AND block_number <= ? AND ('
+				'(event_name = \'Transfer\' AND ("from" = ? OR "to" = ?)) OR '
+				'(event_name = \'DestroyedBlackFunds\' AND _blackListedUser = ?) OR '
+				'event_name IN (\'Issue\', \'Redeem\')) ORDER BY block_number, log_index',
+				(from_block, to_block, address, address, address)).fetchall()
+		finally:
+			conn.close()
+		return [dict(row) for row in rows]
+	return events
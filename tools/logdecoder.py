@@ -0,0 +1,241 @@
+"""Decode raw `eth_getLogs` results without going through `get_event_data` for every log.
+
+`get_event_data` inspects the event ABI again for every log it decodes
+and builds nested `AttributeDict`s, which the states then flatten into rows again.
+`LogDecoder` compiles every event ABI once, keyed by its topic0,
+and decodes the indexed topics and the data of a log straight into a flat tuple.
+
+Word sized types (address, uintN, intN, bool, bytesN) are sliced out of the 32 byte ABI words directly,
+other types go through the ABI codec once per log, and events with tuple arguments fall back to `get_event_data`.
+
+Usage::
+
+	decoder = LogDecoder([contract.events.Transfer._get_event_abi()], web3.codec)
+	events = decoder.decode_logs(web3.eth.get_logs(filter_params))
+	columns = decoder.decode_columns(logs)["Transfer"]
+"""
+
+import logging
+from typing import Dict, List, Optional, Tuple, Iterable
+
+from eth_abi.codec import ABICodec
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from web3._utils.abi import map_abi_data
+from web3._utils.events import get_event_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+
+logger = logging.getLogger(__name__)
+
+
+class DecodedEvent(dict):
+	"""A decoded event, a plain dict whose keys can also be read as attributes like web3's `AttributeDict`."""
+
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name)
+
+
+def _to_bytes(value) -> bytes:
+	"""Log topics and data are `HexBytes` from web3 but hex strings from a raw JSON-RPC response."""
+	if isinstance(value, str):
+		return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+	return bytes(value)
+
+
+# Checksumming hashes the address, and the same few addresses show up in most logs
+_checksummed = {}
+
+def _word_to_address(word: bytes) -> str:
+	raw = word[12:]
+	address = _checksummed.get(raw)
+	if address is None:
+		if len(_checksummed) > 1000000:
+			_checksummed.clear()
+		address = _checksummed[raw] = to_checksum_address(raw)
+	return address
+
+def _word_to_uint(word: bytes) -> int:
+	return int.from_bytes(word, "big")
+
+def _word_to_int(word: bytes) -> int:
+	return int.from_bytes(word, "big", signed=True)
+
+def _word_to_bool(word: bytes) -> bool:
+	return word[-1] != 0
+
+def _word_decoder(abi_type: str):
+	"""Function decoding one 32 byte ABI word of the given type, None if the type does not fit in a single word."""
+	if abi_type == "address":
+		return _word_to_address
+	if abi_type == "bool":
+		return _word_to_bool
+	if abi_type.startswith("uint") and abi_type[4:].isdigit():
+		return _word_to_uint
+	if abi_type.startswith("int") and abi_type[3:].isdigit():
+		return _word_to_int
+	if abi_type.startswith("bytes") and abi_type[5:].isdigit():
+		size = int(abi_type[5:])
+		return lambda word: word[:size]
+	return None
+
+def _raw_topic(word: bytes) -> bytes:
+	# Indexed strings, bytes, arrays and tuples are stored as the keccak of their value
+	return word
+
+
+class EventDecoder:
+	"""Decode the logs of a single event type, compiled once from its ABI."""
+
+	def __init__(self, abi: dict, codec: ABICodec):
+		self.abi = abi
+		self.codec = codec
+		self.name = abi["name"]
+		self.topic = event_abi_to_log_topic(abi)
+
+		indexed = [inp for inp in abi["inputs"] if inp.get("indexed")]
+		data = [inp for inp in abi["inputs"] if not inp.get("indexed")]
+		self.topic_names = [inp["name"] for inp in indexed]
+		self.data_names = [inp["name"] for inp in data]
+		# Argument names in the order of the flat tuples, the same order `get_event_data` puts them in `args`
+		self.arg_names = self.topic_names + self.data_names
+
+		self.topic_decoders = [_word_decoder(inp["type"]) or _raw_topic for inp in indexed]
+		self.data_types = [inp["type"] for inp in data]
+		word_decoders = [_word_decoder(abi_type) for abi_type in self.data_types]
+		# Every data argument fits in one word, so argument i is simply the i-th word
+		self.data_decoders = word_decoders if all(word_decoders) else None
+		# Tuples need named nested output, leave those to web3
+		self.use_web3 = any(inp["type"].startswith("tuple") for inp in abi["inputs"])
+
+	def decode_args(self, topics, data) -> tuple:
+		"""Decode the arguments of a log into a tuple ordered like `arg_names`.
+
+		:param topics: The topics of the log, including topic0
+		:param data: The data of the log
+		"""
+		if len(topics) != len(self.topic_decoders) + 1:
+			raise ValueError(f"Expected {len(self.topic_decoders) + 1} log topics for {self.name}. Got {len(topics)}")
+		values = [decode(_to_bytes(topic)) for decode, topic in zip(self.topic_decoders, topics[1:])]
+
+		data = _to_bytes(data)
+		if self.data_decoders is not None:
+			if len(data) < 32 * len(self.data_decoders):
+				raise ValueError(f"Expected {32 * len(self.data_decoders)} bytes of log data for {self.name}. Got {len(data)}")
+			values += [decode(data[32*i:32*(i+1)]) for i, decode in enumerate(self.data_decoders)]
+		elif self.data_types:
+			decoded = self.codec.decode(self.data_types, data)
+			values += map_abi_data(BASE_RETURN_NORMALIZERS, self.data_types, decoded)
+		return tuple(values)
+
+	def decode_log(self, log) -> DecodedEvent:
+		"""Decode a log into the same shape `get_event_data` returns."""
+		if self.use_web3:
+			return DecodedEvent(get_event_data(self.codec, self.abi, log))
+		return DecodedEvent(
+			args=DecodedEvent(zip(self.arg_names, self.decode_args(log["topics"], log["data"]))),
+			event=self.name,
+			logIndex=log["logIndex"],
+			transactionIndex=log["transactionIndex"],
+			transactionHash=log["transactionHash"],
+			address=log["address"],
+			blockHash=log["blockHash"],
+			blockNumber=log["blockNumber"],
+		)
+
+
+class LogDecoder:
+	"""Decode logs of several event types, picking the decoder by topic0.
+
+	Event types added with a contract address only decode logs of that contract,
+	so contracts whose ABIs disagree on an event signature can be scanned with the same filter.
+	"""
+
+	def __init__(self, abis: Iterable[dict], codec: ABICodec):
+		self.codec = codec
+		self.decoders: Dict[bytes, EventDecoder] = {}
+		# (lowercase contract address, topic0): decoder
+		self.address_decoders: Dict[Tuple[str, bytes], EventDecoder] = {}
+		for abi in abis:
+			self.add(abi)
+
+	def add(self, abi: dict, address: Optional[str] = None):
+		"""Compile an event ABI, for logs of any contract or only the one at `address`."""
+		if abi.get("anonymous"):
+			# No topic0 to tell them apart
+			logger.warning("Cannot decode anonymous event %s by topic, skipping it", abi["name"])
+			return
+		decoder = EventDecoder(abi, self.codec)
+		if address is None:
+			self.decoders[decoder.topic] = decoder
+		else:
+			self.address_decoders[(address.lower(), decoder.topic)] = decoder
+
+	@property
+	def topics(self) -> List[bytes]:
+		"""topic0 of every event type this decoder knows."""
+		return list(dict.fromkeys(list(self.decoders) + [topic for _, topic in self.address_decoders]))
+
+	def get_decoder(self, log) -> Optional[EventDecoder]:
+		"""Decoder for the event type of the log, None if the log is not one of ours."""
+		if not log["topics"]:
+			return None
+		topic = _to_bytes(log["topics"][0])
+		if self.address_decoders:
+			decoder = self.address_decoders.get((log["address"].lower(), topic))
+			if decoder is not None:
+				return decoder
+		return self.decoders.get(topic)
+
+	def decode_logs(self, logs) -> List[DecodedEvent]:
+		"""Decode a whole `eth_getLogs` response, skipping logs of other event types."""
+		events = []
+		for log in logs:
+			decoder = self.get_decoder(log)
+			if decoder is not None:
+				events.append(decoder.decode_log(log))
+		return events
+
+	def decode_rows(self, logs) -> List[Tuple[str, int, int, str, str, tuple]]:
+		"""Decode logs into flat tuples.
+
+		:return: list of (event name, block number, log index, transaction hash hex, contract address, argument tuple)
+		"""
+		rows = []
+		for log in logs:
+			decoder = self.get_decoder(log)
+			if decoder is None:
+				continue
+			rows.append((
+				decoder.name,
+				log["blockNumber"],
+				log["logIndex"],
+				_to_bytes(log["transactionHash"]).hex(),
+				log["address"],
+				decoder.decode_args(log["topics"], log["data"]),
+			))
+		return rows
+
+	def decode_columns(self, logs) -> Dict[str, Dict[str, list]]:
+		"""Decode logs into one dict of column lists per event type.
+
+		Every event type gets the columns block_number, log_index, txhash and contract_address,
+		followed by one column per event argument.
+		"""
+		columns = {}
+		for event_name, block_number, log_index, txhash, address, args in self.decode_rows(logs):
+			table = columns.get(event_name)
+			if table is None:
+				decoder = next(d for d in list(self.decoders.values()) + list(self.address_decoders.values()) if d.name == event_name)
+				table = columns[event_name] = {col: [] for col in ["block_number", "log_index", "txhash", "contract_address"] + decoder.arg_names}
+				table["_args"] = [table[name] for name in decoder.arg_names]
+			table["block_number"].append(block_number)
+			table["log_index"].append(log_index)
+			table["txhash"].append(txhash)
+			table["contract_address"].append(address)
+			for values, value in zip(table["_args"], args):
+				values.append(value)
+		for table in columns.values():
+			del table["_args"]
+		return columns
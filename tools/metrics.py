@@ -0,0 +1,196 @@
+"""Timing and counters of the stages of a scan.
+
+`EventScanner` records into a `ScanMetrics` object how long each stage takes
+(JSON-RPC calls by method, log decoding, block timestamp lookups, `process_event`, `end_chunk` and `save`),
+how often calls were retried and block ranges split, and the current chunk size and speed.
+
+The numbers can be read in process with `snapshot()`, written to a file as JSON or Prometheus text with `write()`,
+or served over HTTP for Prometheus to scrape with `serve()`.
+
+`ChunkProfiler` runs cProfile over every n-th chunk, to see where the time inside a stage goes.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _key(name: str, labels: dict) -> tuple:
+	return (name, tuple(sorted(labels.items())))
+
+def _label_text(labels) -> str:
+	if not labels:
+		return ""
+	return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class ScanMetrics:
+	"""Thread safe timers, counters and gauges, each with optional labels."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		# (name, labels): [count, total seconds, max seconds]
+		self.timers = {}
+		self.counters = {}
+		self.gauges = {}
+
+	def observe(self, name: str, seconds: float, **labels):
+		"""Add one timing of a stage."""
+		key = _key(name, labels)
+		with self.lock:
+			timer = self.timers.get(key)
+			if timer is None:
+				self.timers[key] = [1, seconds, seconds]
+			else:
+				timer[0] += 1
+				timer[1] += seconds
+				timer[2] = max(timer[2], seconds)
+
+	@contextmanager
+	def timer(self, name: str, **labels):
+		"""Time the code in a with block as one run of a stage."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, **labels)
+
+	def incr(self, name: str, n: int = 1, **labels):
+		key = _key(name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + n
+
+	def set(self, name: str, value: float, **labels):
+		with self.lock:
+			self.gauges[_key(name, labels)] = value
+
+	def snapshot(self) -> dict:
+		"""All metrics as a plain dict, labels written like name{label="value"}."""
+		with self.lock:
+			return {
+				"uptime_seconds": time.time() - self.started,
+				"timers": {
+					name + _label_text(labels): {"count": count, "total": total, "max": longest, "mean": total / count}
+					for (name, labels), (count, total, longest) in self.timers.items()
+				},
+				"counters": {name + _label_text(labels): value for (name, labels), value in self.counters.items()},
+				"gauges": {name + _label_text(labels): value for (name, labels), value in self.gauges.items()},
+			}
+
+	def to_json(self) -> str:
+		return json.dumps(self.snapshot(), indent=2)
+
+	def to_prometheus(self, prefix: str = "eventscanner") -> str:
+		"""Metrics in the Prometheus text exposition format."""
+		lines = []
+		with self.lock:
+			for (name, labels), (count, total, longest) in sorted(self.timers.items()):
+				lines.append(f"{prefix}_{name}_seconds_sum{_label_text(labels)} {total}")
+				lines.append(f"{prefix}_{name}_seconds_count{_label_text(labels)} {count}")
+				lines.append(f"{prefix}_{name}_seconds_max{_label_text(labels)} {longest}")
+			for (name, labels), value in sorted(self.counters.items()):
+				lines.append(f"{prefix}_{name}_total{_label_text(labels)} {value}")
+			for (name, labels), value in sorted(self.gauges.items()):
+				lines.append(f"{prefix}_{name}{_label_text(labels)} {value}")
+		return "\n".join(lines) + "\n"
+
+	def summary(self) -> str:
+		"""A table of the stages by total time, slowest first."""
+		timers = self.snapshot()["timers"]
+		lines = [f"{'stage':40} {'calls':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+		for name, timer in sorted(timers.items(), key=lambda item: -item[1]["total"]):
+			lines.append(f"{name:40} {timer['count']:>8} {timer['total']:>10.2f} {1000 * timer['mean']:>10.1f} {1000 * timer['max']:>10.1f}")
+		return "\n".join(lines)
+
+	def write(self, fname: str):
+		"""Write the metrics to a file, as Prometheus text if it ends in .prom and JSON otherwise.
+
+		The file is replaced atomically, so a collector reading it never sees a partial file.
+		"""
+		text = self.to_prometheus() if fname.endswith(".prom") else self.to_json()
+		tmp_fname = f"{fname}.tmp"
+		with open(tmp_fname, "wt") as f:
+			f.write(text)
+		os.replace(tmp_fname, fname)
+
+	def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+		"""Serve the metrics over HTTP in a background thread.
+
+		/metrics is Prometheus text, /metrics.json is JSON.
+		"""
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.startswith("/metrics.json"):
+					body, content_type = metrics.to_json().encode(), "application/json"
+				elif self.path.startswith("/metrics"):
+					body, content_type = metrics.to_prometheus().encode(), "text/plain; version=0.0.4"
+				else:
+					self.send_error(404)
+					return
+				self.send_response(200)
+				self.send_header("Content-Type", content_type)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = ThreadingHTTPServer((host, port), Handler)
+		server.daemon_threads = True
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		logger.info("Serving scan metrics at http://%s:%d/metrics", host, server.server_address[1])
+		return server
+
+
+class ChunkProfiler:
+	"""Profile every n-th chunk of a scan with cProfile.
+
+	cProfile only sees the thread it runs in, so with `scan_parallel`
+	it covers processing the chunks but not the fetches of the worker threads.
+	"""
+
+	def __init__(self, every: int = 100, out_dir: Optional[str] = None, top: int = 20):
+		"""
+		:param every: Profile one chunk out of this many
+		:param out_dir: Write each profile to <out_dir>/<label>.prof for snakeviz or pstats, log the top functions if not given
+		:param top: How many functions to log
+		"""
+		self.every = every
+		self.out_dir = out_dir
+		self.top = top
+		self.chunks = 0
+
+	@contextmanager
+	def profile(self, label: str):
+		self.chunks += 1
+		if self.every <= 0 or (self.chunks - 1) % self.every != 0:
+			yield
+			return
+
+		profiler = cProfile.Profile()
+		profiler.enable()
+		try:
+			yield
+		finally:
+			profiler.disable()
+			if self.out_dir:
+				os.makedirs(self.out_dir, exist_ok=True)
+				profiler.dump_stats(os.path.join(self.out_dir, f"{label}.prof"))
+			else:
+				out = io.StringIO()
+				pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(self.top)
+				logger.info("Profile of %s:\n%s", label, out.getvalue())
@@ -0,0 +1,284 @@
+"""A local stand-in for an Ethereum JSON-RPC node, for benchmarking the scanner.
+
+The node serves a synthetic chain of USDT events, or logs recorded from a real node,
+over HTTP on localhost. It answers the calls the scanner makes
+(eth_blockNumber, eth_getBlockByNumber, eth_getLogs, eth_chainId, eth_getStorageAt),
+including JSON-RPC batches, and can imitate the limits of hosted providers:
+
+* latency: seconds added to every HTTP request
+* max_logs: eth_getLogs answers with more logs fail like Infura does, with a block range hint
+* max_block_range: eth_getLogs over more blocks fail like Alchemy does
+* error_rate: share of HTTP requests calling one of error_methods (eth_getLogs by default)
+  that fail with 429 Too Many Requests or 503 Service Unavailable
+
+Usage::
+
+	node = MockNode(MockChain.synthetic(blocks=100000, logs_per_block=2))
+	node.start()
+	web3 = Web3(HTTPProvider(node.url))
+	...
+	print(node.stats)
+	node.stop()
+"""
+
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from eth_abi import encode
+from eth_utils import event_abi_to_log_topic, keccak
+
+logger = logging.getLogger(__name__)
+
+USDT_ADDRESS = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+
+# Event ABIs of the USDT contract used for the synthetic chain, and how often each shows up
+_usdt_events = [
+	({"name": "Transfer", "type": "event", "anonymous": False, "inputs": [
+		{"name": "from", "type": "address", "indexed": True},
+		{"name": "to", "type": "address", "indexed": True},
+		{"name": "value", "type": "uint256", "indexed": False}]}, 0.94),
+	({"name": "Issue", "type": "event", "anonymous": False, "inputs": [
+		{"name": "amount", "type": "uint256", "indexed": False}]}, 0.02),
+	({"name": "Redeem", "type": "event", "anonymous": False, "inputs": [
+		{"name": "amount", "type": "uint256", "indexed": False}]}, 0.02),
+	({"name": "AddedBlackList", "type": "event", "anonymous": False, "inputs": [
+		{"name": "_user", "type": "address", "indexed": False}]}, 0.01),
+	({"name": "RemovedBlackList", "type": "event", "anonymous": False, "inputs": [
+		{"name": "_user", "type": "address", "indexed": False}]}, 0.01),
+]
+
+def _hex(value: bytes) -> str:
+	return "0x" + value.hex()
+
+
+class MockChain:
+	"""The blocks and logs a MockNode serves, logs in JSON-RPC form sorted by block and log index."""
+
+	def __init__(self, logs: List[dict], head: int, first_timestamp: int = 1500000000, block_time: int = 12):
+		self.logs = logs
+		self.log_blocks = [int(log["blockNumber"], 16) for log in logs]
+		self.head = head
+		self.first_timestamp = first_timestamp
+		self.block_time = block_time
+
+	@classmethod
+	def synthetic(cls, blocks: int, logs_per_block: float = 1.0, holders: int = 10000, seed: int = 1, address: str = USDT_ADDRESS):
+		"""A chain of `blocks` blocks with USDT like events, `logs_per_block` on average."""
+		rnd = random.Random(seed)
+		accounts = [rnd.getrandbits(160).to_bytes(20, "big") for _ in range(holders)]
+		events = [(abi, event_abi_to_log_topic(abi)) for abi, _ in _usdt_events]
+		weights = [weight for _, weight in _usdt_events]
+		logs = []
+		tx = 0
+		for block_number in range(1, blocks + 1):
+			count = int(logs_per_block) + (rnd.random() < logs_per_block % 1)
+			block_hash = _hex(keccak(block_number.to_bytes(32, "big")))
+			for log_index in range(count):
+				abi, topic = rnd.choices(events, weights)[0]
+				topics = [topic]
+				data_types, data_values = [], []
+				for inp in abi["inputs"]:
+					value = rnd.choice(accounts) if inp["type"] == "address" else rnd.randrange(10**12)
+					if inp["type"] == "address":
+						value = _hex(value)
+					if inp["indexed"]:
+						topics.append(encode([inp["type"]], [value]))
+					else:
+						data_types.append(inp["type"])
+						data_values.append(value)
+				tx += 1
+				logs.append({
+					"address": address,
+					"topics": [_hex(t) for t in topics],
+					"data": _hex(encode(data_types, data_values)),
+					"blockNumber": hex(block_number),
+					"blockHash": block_hash,
+					"transactionHash": _hex(keccak(tx.to_bytes(32, "big"))),
+					"transactionIndex": hex(log_index),
+					"logIndex": hex(log_index),
+					"removed": False,
+				})
+		return cls(logs, blocks)
+
+	@classmethod
+	def from_file(cls, fname: str, head: Optional[int] = None):
+		"""Logs recorded from a real node, one JSON-RPC log object per line."""
+		with open(fname) as f:
+			logs = [json.loads(line) for line in f if line.strip()]
+		logs.sort(key=lambda log: (int(log["blockNumber"], 16), int(log["logIndex"], 16)))
+		if head is None:
+			head = int(logs[-1]["blockNumber"], 16) if logs else 0
+		return cls(logs, head)
+
+	def get_block(self, block_number: int) -> Optional[dict]:
+		if block_number < 0 or block_number > self.head:
+			return None
+		return {
+			"number": hex(block_number),
+			"hash": _hex(keccak(block_number.to_bytes(32, "big"))),
+			"parentHash": _hex(keccak(max(block_number - 1, 0).to_bytes(32, "big"))),
+			"timestamp": hex(self.first_timestamp + self.block_time * block_number),
+			"transactions": [],
+		}
+
+	def get_logs(self, from_block: int, to_block: int, address=None, topics=None) -> List[dict]:
+		first = bisect.bisect_left(self.log_blocks, from_block)
+		last = bisect.bisect_right(self.log_blocks, to_block)
+		logs = self.logs[first:last]
+		if address:
+			addresses = {a.lower() for a in ([address] if isinstance(address, str) else address)}
+			logs = [log for log in logs if log["address"].lower() in addresses]
+		for i, wanted in enumerate(topics or []):
+			if wanted is None:
+				continue
+			wanted = {t.lower() for t in ([wanted] if isinstance(wanted, str) else wanted)}
+			logs = [log for log in logs if len(log["topics"]) > i and log["topics"][i].lower() in wanted]
+		return logs
+
+
+class RPCError(Exception):
+	def __init__(self, code, message):
+		super().__init__(message)
+		self.code = code
+		self.message = message
+
+
+class MockNode:
+	"""Serve a MockChain over JSON-RPC on localhost, counting calls and bytes."""
+
+	def __init__(self, chain: MockChain, latency: float = 0.0, max_logs: Optional[int] = None,
+			max_block_range: Optional[int] = None, error_rate: float = 0.0, error_methods=("eth_getLogs",), seed: int = 1, chain_id: int = 1):
+		self.chain = chain
+		self.latency = latency
+		self.max_logs = max_logs
+		self.max_block_range = max_block_range
+		self.error_rate = error_rate
+		self.error_methods = set(error_methods)
+		self.chain_id = chain_id
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.server = None
+		self.thread = None
+		self.reset_stats()
+
+	def reset_stats(self):
+		self.stats = {
+			"http_requests": 0,
+			"rpc_calls": 0,
+			"calls": {},
+			"errors": 0,
+			"injected_errors": 0,
+			"bytes_in": 0,
+			"bytes_out": 0,
+		}
+
+	@property
+	def url(self) -> str:
+		host, port = self.server.server_address[:2]
+		return f"http://{host}:{port}"
+
+	def start(self):
+		node = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_POST(self):
+				body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+				status, response = node.handle(body)
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(response)))
+				self.end_headers()
+				self.wfile.write(response)
+				with node.lock:
+					node.stats["bytes_out"] += len(response)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+	def handle(self, body: bytes):
+		"""Answer one HTTP request body, returns (HTTP status, response body)."""
+		request = json.loads(body)
+		methods = {item.get("method") for item in (request if isinstance(request, list) else [request])}
+		with self.lock:
+			self.stats["http_requests"] += 1
+			self.stats["bytes_in"] += len(body)
+			inject = bool(self.error_rate) and bool(methods & self.error_methods) and self.random.random() < self.error_rate
+			if inject:
+				self.stats["injected_errors"] += 1
+				status = self.random.choice([429, 503])
+		if self.latency:
+			time.sleep(self.latency)
+		if inject:
+			return status, json.dumps({"jsonrpc": "2.0", "id": None, "error": {"code": -32005, "message": "Too Many Requests" if status == 429 else "Service Unavailable"}}).encode()
+
+		if isinstance(request, list):
+			response = [self.call(item) for item in request]
+		else:
+			response = self.call(request)
+		return 200, json.dumps(response).encode()
+
+	def call(self, request: dict) -> dict:
+		method = request.get("method")
+		with self.lock:
+			self.stats["rpc_calls"] += 1
+			self.stats["calls"][method] = self.stats["calls"].get(method, 0) + 1
+		try:
+			result = self.dispatch(method, request.get("params", []))
+			return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+		except RPCError as e:
+			with self.lock:
+				self.stats["errors"] += 1
+			return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": e.code, "message": e.message}}
+
+	def _block_number(self, tag) -> int:
+		if tag in ("latest", "pending", "safe", "finalized", None):
+			return self.chain.head - (64 if tag == "finalized" else 0)
+		if tag == "earliest":
+			return 0
+		return int(tag, 16)
+
+	def dispatch(self, method: str, params: list):
+		if method == "eth_chainId":
+			return hex(self.chain_id)
+		if method == "net_version":
+			return str(self.chain_id)
+		if method == "eth_blockNumber":
+			return hex(self.chain.head)
+		if method == "eth_getBlockByNumber":
+			return self.chain.get_block(self._block_number(params[0]))
+		if method == "eth_getStorageAt":
+			return "0x" + "00" * 32
+		if method == "eth_getLogs":
+			return self.get_logs(params[0])
+		raise RPCError(-32601, f"the method {method} does not exist/is not available")
+
+	def get_logs(self, params: dict) -> List[dict]:
+		from_block = self._block_number(params.get("fromBlock", "latest"))
+		to_block = self._block_number(params.get("toBlock", "latest"))
+		if self.max_block_range is not None and to_block - from_block + 1 > self.max_block_range:
+			raise RPCError(-32600, f"Log response size exceeded. You can make eth_getLogs requests with up to a {self.max_block_range} block range. "
+				f"Based on your parameters, this block range should work: [{hex(from_block)}, {hex(from_block + self.max_block_range - 1)}]")
+		logs = self.chain.get_logs(from_block, to_block, params.get("address"), params.get("topics"))
+		if self.max_logs is not None and len(logs) > self.max_logs:
+			# Suggest the range that ends before the block of the first log over the limit, like Infura
+			hint_end = max(from_block, int(logs[self.max_logs]["blockNumber"], 16) - 1)
+			raise RPCError(-32005, f"query returned more than {self.max_logs} results. Try with this block range [{hex(from_block)}, {hex(hint_end)}].")
+		return logs
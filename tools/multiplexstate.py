@@ -0,0 +1,89 @@
+"""Route the events of one scan over several contracts to one state per contract.
+
+Every contract keeps its own output file, in any of the formats `make_state` supports,
+while the scanner fetches the logs of all of them with a single `eth_getLogs` filter per chunk.
+"""
+
+from .eventscanner import EventScannerState
+
+import datetime
+import logging
+from typing import Dict
+
+from web3.datastructures import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+class MultiplexState(EventScannerState):
+	"""Store the events of several contracts, each in the state of its contract.
+
+	All contracts are scanned together, so the scan resumes from the contract that is furthest behind.
+	Every state only gets the chunks and events after its own last scanned block,
+	so the contracts that are ahead keep their data and are not given the same events twice.
+	A reorg rollback only touches the states that scanned the blocks it deletes.
+
+	The scanner deletes the data from the block it starts at, which for a contract added to the list is the first block,
+	so bring new contracts up to the others before a joint scan, see getContractsEvents.
+	"""
+
+	def __init__(self, states: Dict[str, EventScannerState]):
+		"""
+		:param states: Contract address: the state that stores the events of that contract
+		"""
+		self.states = { address.lower(): state for address, state in states.items() }
+
+	def reset(self):
+		for state in self.states.values():
+			state.reset()
+
+	def restore(self):
+		for state in self.states.values():
+			state.restore()
+
+	def save(self):
+		for state in self.states.values():
+			state.save()
+
+	def get_last_scanned_block(self):
+		"""The last block scanned for every contract."""
+		return min(state.get_last_scanned_block() for state in self.states.values())
+
+	def delete_data(self, since_block):
+		"""Remove potentially reorganised blocks from the data of the contracts that scanned them."""
+		for state in self.states.values():
+			if state.get_last_scanned_block() >= since_block:
+				state.delete_data(since_block)
+
+	def _behind(self, block_number):
+		"""The states that have not scanned block_number yet."""
+		return [ state for state in self.states.values() if state.get_last_scanned_block() < block_number ]
+
+	def record_block_hash(self, block_number, block_hash):
+		for state in self._behind(block_number):
+			state.record_block_hash(block_number, block_hash)
+
+	def get_block_hashes(self):
+		"""Hashes recorded by any of the contracts, the scanner checks them all against the chain."""
+		block_hashes = {}
+		for state in self.states.values():
+			block_hashes.update(state.get_block_hashes())
+		return block_hashes
+
+	def start_chunk(self, block_number, chunk_size):
+		for state in self._behind(block_number + chunk_size - 1):
+			state.start_chunk(block_number, chunk_size)
+
+	def end_chunk(self, block_number):
+		# A state that is ahead would move its last scanned block back
+		for state in self._behind(block_number):
+			state.end_chunk(block_number)
+
+	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> object:
+		"""Pass the event to the state of the contract that emitted it, unless that state already scanned its block."""
+		state = self.states.get(event["address"].lower())
+		if state is None:
+			logger.warning("No state for contract %s, skipping event %s", event["address"], event["event"])
+			return None
+		if event["blockNumber"] <= state.get_last_scanned_block():
+			return None
+		return state.process_event(block_when, event)
@@ -0,0 +1,317 @@
+"""Scanner state that stores events in Parquet files.
+
+Files are partitioned by event name and block range:
+
+	<root>/event_name=<event>/<first block>-<last block>.parquet
+
+Event arguments are stored with their ABI types.
+Integers wider than 64 bits (e.g. uint256 amounts) are stored losslessly as 32 byte big-endian binary,
+use `read_events` to load them back as Python ints.
+"""
+
+from .eventscanner import EventScannerState
+from .scannerstate import write_json_atomic
+
+import datetime
+import time
+import logging
+import os
+import re
+import json
+
+from web3.datastructures import AttributeDict
+import pandas as pd
+
+try:
+	import pyarrow as pa
+	import pyarrow.compute as pc
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pc = None
+	pq = None
+
+logger = logging.getLogger(__name__)
+
+_file_re = re.compile(r"^(\d+)-(\d+)(\.\d+)?\.parquet$")
+
+def _arrow_type(abi_type):
+	"""Arrow type used to store an ABI type."""
+	if abi_type == "address" or abi_type == "string":
+		return pa.string()
+	if abi_type == "bool":
+		return pa.bool_()
+	m = re.match(r"^(u?)int(\d*)$", abi_type)
+	if m:
+		bits = int(m.group(2) or 256)
+		if bits <= 64:
+			return pa.uint64() if m.group(1) else pa.int64()
+		# Wider integers do not fit in any Arrow integer, and decimal256 tops out at 76 digits
+		return pa.binary(32)
+	if abi_type.startswith("bytes"):
+		return pa.binary()
+	# Arrays and tuples
+	return pa.string()
+
+def _to_arrow_value(value, arrow_type, abi_type):
+	if value is None:
+		return None
+	if arrow_type == pa.binary(32):
+		# Two's complement for signed types
+		return int(value).to_bytes(32, "big", signed=abi_type.startswith("int"))
+	if arrow_type == pa.string() and not isinstance(value, str):
+		return str(value)
+	return value
+
+def _file_ranges(event_dir):
+	"""(first block, last block, path) of every file of one event, ordered by block."""
+	if not os.path.isdir(event_dir):
+		return []
+	ranges = []
+	for fname in os.listdir(event_dir):
+		m = _file_re.match(fname)
+		if m:
+			ranges.append( (int(m.group(1)), int(m.group(2)), os.path.join(event_dir, fname)) )
+	return sorted(ranges)
+
+def read_events(root, event_name, columns=None, start_block=None, end_block=None, decode_uint256=True):
+	"""Load the events of one type as a DataFrame.
+
+	Only the files that overlap [start_block, end_block] are opened,
+	and only the requested columns are read from them.
+
+	:param columns: Columns to load, all columns if None
+	:param decode_uint256: Convert 32 byte integer columns back to Python ints
+	"""
+	if pa is None:
+		raise ImportError("read_events needs pyarrow, run pip install pyarrow")
+
+	files = [ path for first, last, path in _file_ranges(os.path.join(root, f"event_name={event_name}"))
+		if (start_block is None or last >= start_block) and (end_block is None or first <= end_block) ]
+
+	filters = []
+	if start_block is not None:
+		filters.append( ("block_number", ">=", start_block) )
+	if end_block is not None:
+		filters.append( ("block_number", "<=", end_block) )
+
+	if len(files) == 0:
+		return pd.DataFrame(columns=columns)
+
+	if columns is not None and len(filters) > 0 and "block_number" not in columns:
+		read_columns = list(columns) + ["block_number"]
+	else:
+		read_columns = columns
+	tables = [ pq.read_table(path, columns=read_columns, filters=filters or None) for path in files ]
+	table = pa.concat_tables(tables)
+
+	metadata = table.schema.metadata or {}
+	abi_types = json.loads(metadata.get(b"abi_types", b"{}"))
+
+	df = table.to_pandas()
+	if decode_uint256:
+		for field in table.schema:
+			if field.type == pa.binary(32) and field.name in df.columns:
+				signed = abi_types.get(field.name, "uint256").startswith("int")
+				df[field.name] = df[field.name].map(lambda v: None if v is None else int.from_bytes(v, "big", signed=signed))
+	if columns is not None:
+		df = df[list(columns)]
+	return df
+
+class ParquetState(EventScannerState):
+	"""Store scanned events in typed, compressed Parquet files.
+
+	Rows are buffered in memory per event and written as a new file once a buffer holds `rows_per_file` rows,
+	or when `save(force=True)` is called at the end of a scan.
+	A small checkpoint file in the root directory records the last block whose events are all on disk.
+	"""
+
+	def __init__(self, root, event_types, rows_per_file=100000, compression="zstd"):
+		"""
+		:param root: Directory the Parquet files are written to
+		:param event_types: Dict of event name: list of (argument name, ABI type), see utils.get_event_types
+		:param rows_per_file: How many rows of one event we collect before writing a file
+		:param compression: Parquet compression codec
+		"""
+		if pa is None:
+			raise ImportError("ParquetState needs pyarrow, run pip install pyarrow")
+
+		self.state = None
+		self.root = root
+		self.event_types = event_types
+		self.rows_per_file = rows_per_file
+		self.compression = compression
+		self.checkpoint_fname = os.path.join(root, "_checkpoint.json")
+		# How many second ago we saved the files
+		self.last_save = 0
+
+		self.schemas = {}
+		for event_name, args in event_types.items():
+			fields = [
+				pa.field("block_number", pa.int64()),
+				pa.field("log_index", pa.int32()),
+				pa.field("txhash", pa.string()),
+				pa.field("timestamp", pa.timestamp("s")),
+				pa.field("contract_address", pa.string()),
+			]
+			fields += [ pa.field(name, _arrow_type(abi_type)) for name, abi_type in args ]
+			metadata = {"abi_types": json.dumps(dict(args))}
+			self.schemas[event_name] = pa.schema(fields, metadata=metadata)
+
+	def _event_dir(self, event_name):
+		return os.path.join(self.root, f"event_name={event_name}")
+
+	def _reset_buffer(self):
+		self.buffer = { event_name: { field.name: [] for field in schema } for event_name, schema in self.schemas.items() }
+
+	def reset(self):
+		"""Create initial state of nothing scanned."""
+		self.state = {
+			"last_scanned_block": 0,
+		}
+		self.block_hashes = {}
+		self._reset_buffer()
+
+	def restore(self):
+		"""Restore the last scan state from the checkpoint file."""
+		self._reset_buffer()
+		try:
+			with open(self.checkpoint_fname, "rt") as f:
+				checkpoint = json.load(f)
+		except (IOError, json.decoder.JSONDecodeError):
+			print("State starting from scratch")
+			self.reset()
+			return
+
+		self.state = {"last_scanned_block": checkpoint["last_scanned_block"]}
+		self.block_hashes = { int(block_number): block_hash for block_number, block_hash in checkpoint.get("block_hashes", {}).items()
+			if int(block_number) <= self.state["last_scanned_block"] }
+
+		# Drop files written after the checkpoint, their blocks will be scanned again
+		self._delete_files(self.state["last_scanned_block"] + 1)
+		print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
+
+	def _write_file(self, event_name, rows):
+		"""Write the rows of one event to a new file named after its block range."""
+		table = pa.Table.from_pydict(rows, schema=self.schemas[event_name])
+		first, last = min(rows["block_number"]), max(rows["block_number"])
+		event_dir = self._event_dir(event_name)
+		os.makedirs(event_dir, exist_ok=True)
+		fname = os.path.join(event_dir, f"{first:012d}-{last:012d}.parquet")
+		# A file for the same range can exist if the same blocks were rescanned after a rollback
+		n = 0
+		while os.path.exists(fname):
+			n += 1
+			fname = os.path.join(event_dir, f"{first:012d}-{last:012d}.{n}.parquet")
+		pq.write_table(table, fname + ".tmp", compression=self.compression)
+		os.replace(fname + ".tmp", fname)
+
+	def _checkpoint_block(self):
+		"""Last block whose events are all on disk."""
+		pending = [ min(rows["block_number"]) for rows in self.buffer.values() if len(rows["block_number"]) > 0 ]
+		if len(pending) > 0:
+			return min( self.state["last_scanned_block"], min(pending) - 1 )
+		return self.state["last_scanned_block"]
+
+	def _write_checkpoint(self):
+		os.makedirs(self.root, exist_ok=True)
+		write_json_atomic(self.checkpoint_fname, {
+			"last_scanned_block": self._checkpoint_block(),
+			"block_hashes": self.block_hashes,
+		})
+
+	def save(self, force=True):
+		"""Write buffered rows to Parquet files and update the checkpoint.
+
+		:param force: Write every buffer, not only the ones that reached rows_per_file rows
+		"""
+		os.makedirs(self.root, exist_ok=True)
+		for event_name, rows in self.buffer.items():
+			count = len(rows["block_number"])
+			if count > 0 and (force or count >= self.rows_per_file):
+				self._write_file(event_name, rows)
+				self.buffer[event_name] = { col: [] for col in rows }
+		self._write_checkpoint()
+		self.last_save = time.time()
+
+	def _delete_files(self, since_block):
+		"""Remove rows at or after since_block from the files on disk."""
+		for event_name, schema in self.schemas.items():
+			for first, last, path in _file_ranges(self._event_dir(event_name)):
+				if first >= since_block:
+					os.remove(path)
+				elif last >= since_block:
+					table = pq.read_table(path)
+					mask = pc.less(table["block_number"], since_block)
+					table = table.filter(mask)
+					os.remove(path)
+					if table.num_rows > 0:
+						self._write_file(event_name, table.to_pydict())
+
+	#
+	# EventScannerState methods implemented below
+	#
+
+	def get_last_scanned_block(self):
+		"""The number of the last block we have stored."""
+		return self.state["last_scanned_block"]
+
+	def delete_data(self, since_block):
+		"""Remove potentially reorganised blocks from the scan data."""
+		since = max(since_block,0)
+		if since <= self.get_last_scanned_block():
+			for event_name, rows in self.buffer.items():
+				keep = [ i for i, block_number in enumerate(rows["block_number"]) if block_number < since ]
+				self.buffer[event_name] = { col: [values[i] for i in keep] for col, values in rows.items() }
+			self._delete_files(since)
+			self.state["last_scanned_block"] = max(since - 1, 0)
+			self.block_hashes = { block_number: block_hash for block_number, block_hash in self.block_hashes.items() if block_number < since }
+			self._write_checkpoint()
+
+	def record_block_hash(self, block_number, block_hash):
+		"""Remember the hash of a scanned block, written with the next checkpoint."""
+		self.block_hashes[block_number] = block_hash
+		for old_block in sorted(self.block_hashes)[:-self.max_block_hashes]:
+			del self.block_hashes[old_block]
+
+	def get_block_hashes(self):
+		return self.block_hashes
+
+	def start_chunk(self, block_number, chunk_size):
+		pass
+
+	def end_chunk(self, block_number):
+		"""Write full buffers at the end of each block, so we can resume in the case of a crash or CTRL+C"""
+		# Next time the scanner is started we will resume from this block
+		self.state["last_scanned_block"] = block_number
+
+		# Save the files for every minute
+		if time.time() - self.last_save > 60:
+			self.save(force=False)
+
+	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+		"""Record an event in the buffer of its event type."""
+		event_name = event["event"]
+		if event_name not in self.buffer:
+			logger.warning("No schema for event %s, skipping it", event_name)
+			return None
+
+		args = event["args"]
+		abi_types = dict(self.event_types[event_name])
+		row = {
+			"block_number": event["blockNumber"],
+			"log_index": event["logIndex"],
+			"txhash": event["transactionHash"].hex(),
+			"timestamp": block_when,
+			"contract_address": event["address"],
+		}
+		schema = self.schemas[event_name]
+		for name, abi_type in abi_types.items():
+			row[name] = _to_arrow_value(args.get(name), schema.field(name).type, abi_type)
+
+		rows = self.buffer[event_name]
+		for col, values in rows.items():
+			values.append(row[col])
+
+		# Return a pointer that allows us to look up this event later if needed
+		return f"{row['block_number']}-{row['txhash']}-{row['log_index']}"
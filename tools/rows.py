@@ -0,0 +1,45 @@
+"""Flat rows of scanned events, as the states store them and the offline tools read them back.
+
+Every state stores the same base columns for an event, followed by the event arguments:
+
+* event_name, block_number, log_index, txhash, timestamp (ISO 8601) and contract_address
+* One column per event argument, bytes arguments as 0x-prefixed hex
+
+Amounts come back from csv files and databases as strings, floats or ints, `to_int` turns any of them into an exact int.
+"""
+
+import datetime
+from typing import Optional
+
+from web3.datastructures import AttributeDict
+
+# Columns every state stores for an event, in this order
+BASE_COLUMNS = ["event_name", "block_number", "log_index", "txhash", "timestamp", "contract_address"]
+
+def event_row(block_when: Optional[datetime.datetime], event: AttributeDict) -> dict:
+	"""Flat dict of an event, the base columns first, then the arguments that do not clash with them."""
+	row = {
+		"event_name": event["event"],
+		"block_number": event["blockNumber"],
+		"log_index": event["logIndex"],
+		"txhash": event["transactionHash"].hex(),
+		"timestamp": block_when.isoformat() if block_when else None,
+		"contract_address": event["address"],
+	}
+	for name, value in event["args"].items():
+		if name in BASE_COLUMNS:
+			continue
+		row[name] = "0x" + bytes(value).hex() if isinstance(value, (bytes, bytearray)) else value
+	return row
+
+def to_int(value):
+	"""Exact integer of a value read from a csv, database or event."""
+	if isinstance(value, int):
+		return value
+	if isinstance(value, str):
+		try:
+			return int(value)
+		except ValueError:
+			pass
+	# Floats are only exact up to 2**53, read csv amounts with dtype=str to avoid this
+	return int(float(value))
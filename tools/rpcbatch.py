@@ -0,0 +1,70 @@
+"""Send many JSON-RPC calls as batch requests.
+
+Web3.py sends one HTTP request per call, so looking up thousands of blocks or transactions
+spends most of its time on round-trips. A JSON-RPC batch is a list of calls in one HTTP request.
+"""
+
+import itertools
+import logging
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+_ids = itertools.count(1)
+_local = threading.local()
+
+def _session():
+	# requests sessions are not guaranteed to be thread safe, keep one per thread
+	if not hasattr(_local, "session"):
+		_local.session = requests.Session()
+	return _local.session
+
+def batch_request(web3, method, params_list, batch_size=100):
+	"""Call one JSON-RPC method with each of the params in params_list.
+
+	Calls are sent `batch_size` at a time in a single HTTP request.
+	Providers that are not HTTP fall back to one request per call.
+
+	:param method: JSON-RPC method, e.g. eth_getBlockByNumber
+	:param params_list: List of params lists, one per call
+	:return: List of raw JSON-RPC results in the order of params_list
+	"""
+	params_list = list(params_list)
+	provider = web3.provider
+	endpoint_uri = getattr(provider, "endpoint_uri", None)
+
+	if endpoint_uri is None or not str(endpoint_uri).startswith("http"):
+		results = []
+		for params in params_list:
+			response = provider.make_request(method, params)
+			if "error" in response:
+				raise ValueError(response["error"])
+			results.append(response.get("result"))
+		return results
+
+	request_kwargs = dict(getattr(provider, "get_request_kwargs", dict)())
+	request_kwargs.setdefault("timeout", 30)
+
+	results = []
+	for i in range(0, len(params_list), batch_size):
+		calls = [ {"jsonrpc": "2.0", "id": next(_ids), "method": method, "params": params} for params in params_list[i:i + batch_size] ]
+		logger.debug("Sending a batch of %d %s calls", len(calls), method)
+		response = _session().post(str(endpoint_uri), json=calls, **request_kwargs)
+		response.raise_for_status()
+		body = response.json()
+		if isinstance(body, dict):
+			# Some nodes answer a batch they refuse with a single error
+			raise ValueError(body.get("error", body))
+
+		# Responses of a batch can come back in any order
+		by_id = { item.get("id"): item for item in body }
+		for call in calls:
+			item = by_id.get(call["id"])
+			if item is None:
+				raise ValueError(f"No response to {method} call {call['params']}")
+			if "error" in item:
+				raise ValueError(item["error"])
+			results.append(item.get("result"))
+	return results
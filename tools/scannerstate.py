@@ -5,10 +5,12 @@ where events are added wherever the scanner left off.
 """
 
 from .eventscanner import EventScanner, EventScannerState
+from .rows import event_row, BASE_COLUMNS
 
 import datetime
 import time
 import logging
+import os
 from typing import Tuple, Optional, Callable, List, Iterable
 
 from web3 import Web3
@@ -18,13 +20,41 @@ import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+def write_json_atomic(fname, obj, sync=True):
+	"""Write a JSON file so that readers see either the old or the new content, never a partial file.
+
+	With sync=False the file is not fsynced, it survives the process crashing but maybe not the machine.
+	"""
+	tmp_fname = f"{fname}.tmp"
+	with open(tmp_fname, "wt") as f:
+		json.dump(obj, f)
+		f.flush()
+		if sync:
+			os.fsync(f.fileno())
+	os.replace(tmp_fname, fname)
+
 class TabularState(EventScannerState):
 	"""Store the state of scanned blocks and all events.
 
-	All state is an in-memory dict.
-	Simple load/store massive csv on start up.
+	New events are appended to per-column lists and only turned into
+	a DataFrame when the table is saved or asked for with `get_dataframe`,
+	so processing an event does not copy the whole table.
+
+	Saving appends only the rows added since the previous save to the csv,
+	then atomically replaces a small checkpoint file next to it, which happens at the end of every chunk.
+	Chunks are only fsynced every `sync_every` chunks and by an explicit `save`, so after a power loss
+	the checkpoint may not match the csv, and the state is restored from the csv instead.
+	The checkpoint records the last scanned block, the row count and size of the csv,
+	and the file offset where each save started,
+	so a reorg rollback truncates the csv instead of rewriting it.
+	Once saved the rows are only on disk, a loaded table is dropped so the next save does not copy it.
+
+	Restoring reads only the checkpoint and the first and last bytes of the csv it describes,
+	the table itself is loaded the first time `get_dataframe` is called.
 	"""
 
+	base_columns = ['event_name','block_number', 'txhash', 'log_index', 'timestamp' ]
+
 	def __init__(self,fname="",columns=[]):
 		self.state = None
 		self.columns = columns
@@ -32,19 +62,141 @@ class TabularState(EventScannerState):
 			self.fname = "test-state.csv"
 		else:
 			self.fname = fname
+		self.checkpoint_fname = self.fname + ".checkpoint.json"
 		# How many second ago we saved the JSON file
 		self.last_save = 0
+		self.table_columns = self._make_table_columns([])
+		self.buffer = {}
+		# Chunks saved since the last fsync
+		self.unsynced_chunks = 0
+		self._reset_checkpoint()
+
+	# How many saves we remember the file offset of, older rollbacks rewrite the whole file
+	max_segments = 1000
+
+	# How many bytes before the checkpoint offset we compare to tell the csv was not rewritten since
+	tail_size = 256
+
+	# How many chunks end_chunk saves before it fsyncs the csv and the checkpoint
+	sync_every = 100
+
+	def _reset_checkpoint(self):
+		# Rows of the table that are already in the file
+		self.saved_rows = 0
+		# Byte size of the file after the last save
+		self.saved_offset = 0
+		# Column order of the file on disk, None if there is no file yet
+		self.file_columns = None
+		# One [first_block, offset, rows_before] entry per save
+		self.segments = []
+		# Hashes of recently scanned blocks, to find where the chain forked
+		self.block_hashes = {}
+
+	def _read_tail(self, offset):
+		"""The bytes of the file just before offset, hex encoded."""
+		with open(self.fname, "rb") as f:
+			f.seek(max(offset - self.tail_size, 0))
+			return f.read(min(offset, self.tail_size)).hex()
+
+	def _write_checkpoint(self, sync=True):
+		write_json_atomic(self.checkpoint_fname, {
+			"last_scanned_block": self.state["last_scanned_block"],
+			"row_count": self.saved_rows,
+			"offset": self.saved_offset,
+			"tail": self._read_tail(self.saved_offset) if self.saved_offset > 0 else "",
+			"columns": self.file_columns,
+			"segments": self.segments[-self.max_segments:],
+			"block_hashes": self.block_hashes,
+		}, sync)
+
+	def _read_checkpoint(self):
+		try:
+			with open(self.checkpoint_fname, "rt") as f:
+				return json.load(f)
+		except (IOError, json.decoder.JSONDecodeError):
+			return None
+
+	def _checkpoint_matches_file(self, checkpoint):
+		"""Whether the csv is the one the checkpoint describes, maybe with rows appended after it.
+
+		A csv rewritten by something else, e.g. add_sender.py adding a column, has a different header or different bytes before the offset.
+		"""
+		if checkpoint.get("tail") is None or checkpoint.get("columns") is None:
+			return False
+		try:
+			if os.path.getsize(self.fname) < checkpoint["offset"]:
+				return False
+			return list(pd.read_csv(self.fname, nrows=0).columns) == checkpoint["columns"] and self._read_tail(checkpoint["offset"]) == checkpoint["tail"]
+		except Exception as e:
+			return False
+
+	def _make_table_columns(self,existing):
+		"""Column order of the table: existing columns first, then any missing base/event columns."""
+		table_columns = list(existing)
+		for col in self.base_columns + list(self.columns) + ['contract_address']:
+			if col not in table_columns:
+				table_columns.append(col)
+		return table_columns
+
+	def _reset_buffer(self):
+		self.buffer = { col: [] for col in self.table_columns }
+
+	def _buffered_rows(self):
+		return len(self.buffer.get('block_number',[]))
+
+	def _flush_buffer(self):
+		"""Move the buffered rows into the DataFrame with a single concat."""
+		if self._buffered_rows() == 0:
+			return
+		new_rows = pd.DataFrame(self.buffer,columns=self.table_columns)
+		if self.state['blocks'].shape[0] == 0:
+			self.state['blocks'] = new_rows
+		else:
+			self.state['blocks'] = pd.concat( [self.state['blocks'], new_rows], ignore_index=True )
+		self._reset_buffer()
+
+	def _load(self):
+		"""Read the rows saved in the file, if restore has not."""
+		if self.state['blocks'] is not None:
+			return
+		blocks = pd.read_csv(self.fname) if self.saved_rows > 0 else pd.DataFrame(columns=self.table_columns)
+		self.state['blocks'] = blocks.reindex(columns=self.table_columns)
+
+	def get_dataframe(self):
+		"""All events scanned so far as a DataFrame."""
+		self._load()
+		self._flush_buffer()
+		return self.state['blocks']
 
 	def reset(self):
 		"""Create initial state of nothing scanned."""
-		base_columns = ['event_name','block_number', 'txhash', 'log_index', 'timestamp' ] 
+		self.table_columns = self._make_table_columns([])
 		self.state = {
 			"last_scanned_block": 0,
-			"blocks": pd.DataFrame(columns=base_columns + self.columns)
+			"blocks": pd.DataFrame(columns=self.table_columns)
 		}
+		self._reset_buffer()
+		self._reset_checkpoint()
 
 	def restore(self):
-		"""Restore the last scan state from a file."""
+		"""Restore the last scan state from the checkpoint, or from the file if there is no usable checkpoint."""
+		checkpoint = self._read_checkpoint()
+		if checkpoint is not None and os.path.exists(self.fname) and self._checkpoint_matches_file(checkpoint):
+			if os.path.getsize(self.fname) > checkpoint["offset"]:
+				# We crashed after appending rows but before the checkpoint was written,
+				# drop the rows the checkpoint does not know about, they will be scanned again
+				os.truncate(self.fname, checkpoint["offset"])
+			self.state = { "last_scanned_block": checkpoint["last_scanned_block"], "blocks": None }
+			self.file_columns = checkpoint["columns"]
+			self.table_columns = self._make_table_columns(self.file_columns)
+			self.saved_rows = checkpoint["row_count"]
+			self.saved_offset = checkpoint["offset"]
+			self.segments = checkpoint["segments"]
+			self.block_hashes = { int(block_number): block_hash for block_number, block_hash in checkpoint.get("block_hashes", {}).items() }
+			self._reset_buffer()
+			print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
+			return
+
 		try:
 			self.state = {}
 			self.state['blocks'] = pd.read_csv(self.fname)
@@ -65,13 +217,112 @@ class TabularState(EventScannerState):
 			self.reset()
 			return
 
+		# Keep the column order of the file, e.g. an extra msg.sender column added by add_sender.py
+		self.file_columns = list(self.state['blocks'].columns)
+		self.table_columns = self._make_table_columns(self.file_columns)
+		self.saved_rows = self.state['blocks'].shape[0]
+		self.saved_offset = os.path.getsize(self.fname)
+		self.state['blocks'] = self.state['blocks'].reindex(columns=self.table_columns)
+		self._reset_buffer()
+
+		if checkpoint is not None and checkpoint["row_count"] == self.saved_rows and checkpoint["columns"] == self.file_columns:
+			# The checkpoint also knows about empty blocks scanned after the last event
+			self.state['last_scanned_block'] = max(self.state['last_scanned_block'], checkpoint["last_scanned_block"])
+			self.segments = checkpoint["segments"]
+			self.block_hashes = { int(block_number): block_hash for block_number, block_hash in checkpoint.get("block_hashes", {}).items() }
+
 		print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
 
-	def save(self):
-		"""Save everything we have scanned so far in a file."""
-		self.state['blocks'].to_csv(self.fname,index=False,header=True)
+	def save(self, sync=True):
+		"""Append the rows scanned since the previous save to the file and write a checkpoint.
+
+		:param sync: fsync the file and the checkpoint, end_chunk only does every `sync_every` chunks
+		"""
+		if self.file_columns != self.table_columns:
+			# New file, or the table gained columns the file does not have
+			self._rewrite()
+		if self.state['blocks'] is None:
+			# The table is not loaded, every row not in the file yet is in the buffer
+			new_rows = pd.DataFrame(self.buffer,columns=self.table_columns)
+			total_rows = self.saved_rows + new_rows.shape[0]
+			self._reset_buffer()
+		else:
+			blocks = self.get_dataframe()
+			new_rows = blocks.iloc[self.saved_rows:]
+			total_rows = blocks.shape[0]
+		if new_rows.shape[0] > 0:
+			self.segments.append( [int(new_rows['block_number'].iloc[0]), self.saved_offset, self.saved_rows] )
+			self.segments = self.segments[-self.max_segments:]
+			with open(self.fname, "at", newline="") as f:
+				new_rows.to_csv(f,index=False,header=False)
+			self.saved_rows = total_rows
+			self.saved_offset = os.path.getsize(self.fname)
+		if sync and os.path.exists(self.fname):
+			# Also syncs the rows appended by the saves without sync
+			with open(self.fname, "rb") as f:
+				os.fsync(f.fileno())
+		self.unsynced_chunks = 0 if sync else self.unsynced_chunks + 1
+		# Everything is in the file now, get_dataframe reads it back if asked
+		self.state['blocks'] = None
+		self._write_checkpoint(sync)
 		self.last_save = time.time()
 
+	def _rewrite(self):
+		"""Write the whole table to the file."""
+		blocks = self.get_dataframe()
+		blocks.to_csv(self.fname,index=False,header=True)
+		self.file_columns = list(self.table_columns)
+		self.saved_rows = blocks.shape[0]
+		self.saved_offset = os.path.getsize(self.fname)
+		self.segments = []
+
+	def _truncate(self, first_row):
+		"""Cut the rows from `first_row` onwards from the end of the file.
+
+		The file is truncated at the start of the save that wrote `first_row`,
+		and the earlier rows of that save are appended again by the next save.
+		"""
+		segments = [s for s in self.segments if s[2] <= first_row]
+		if len(segments) == 0:
+			# We do not remember where this row is in the file, rewrite everything
+			self.file_columns = None
+			return
+		first_block, offset, rows_before = segments[-1]
+		os.truncate(self.fname, offset)
+		self.saved_offset = offset
+		self.saved_rows = rows_before
+		self.segments = segments[:-1]
+
+	def _truncate_unloaded(self, since):
+		"""Cut the rows of blocks from `since` onwards from the end of the file without loading the table.
+
+		Rows are in block order, so every row before the last save that started below `since` is kept.
+		Only the rows written from that save on are read, the ones below `since` are written back as they were.
+		:return: False if no save started below `since`, and the table has to be loaded to cut it
+		"""
+		segments = [s for s in self.segments if s[0] < since]
+		if len(segments) == 0:
+			return False
+		first_block, offset, rows_before = segments[-1]
+		with open(self.fname, "rt", newline="") as f:
+			f.seek(offset)
+			# Read as strings, so the rows are written back byte for byte and large integers are not rounded
+			tail = pd.read_csv(f, header=None, names=self.file_columns, dtype=str, keep_default_na=False)
+		kept = tail[tail['block_number'].astype(int) < since]
+		os.truncate(self.fname, offset)
+		self.saved_offset = offset
+		self.saved_rows = rows_before
+		self.segments = segments[:-1]
+		if kept.shape[0] > 0:
+			self.segments.append( [int(kept['block_number'].iloc[0]), offset, rows_before] )
+			with open(self.fname, "at", newline="") as f:
+				kept.to_csv(f,index=False,header=False)
+				f.flush()
+				os.fsync(f.fileno())
+			self.saved_rows += kept.shape[0]
+			self.saved_offset = os.path.getsize(self.fname)
+		return True
+
 	#
 	# EventScannerState methods implemented below
 	#
@@ -83,117 +334,41 @@ class TabularState(EventScannerState):
 	def delete_data(self, since_block):
 		"""Remove potentially reorganised blocks from the scan data."""
 		since = max(since_block,0)
-		if since < self.get_last_scanned_block():
-			#self.state['blocks'] = self.state['blocks'].query(f"{since} < block_number")
-			self.state['blocks'] = self.state['blocks'][self.state['blocks']['block_number'] < since]
-
-	def start_chunk(self, block_number, chunk_size):
-		pass
-
-	def end_chunk(self, block_number):
-		"""Save at the end of each block, so we can resume in the case of a crash or CTRL+C"""
-		# Next time the scanner is started we will resume from this block
-		self.state["last_scanned_block"] = block_number
-
-		# Save the database file for every minute
-		if time.time() - self.last_save > 60:
+		if since <= self.get_last_scanned_block():
+			if self.state['blocks'] is None and self.file_columns == self.table_columns and self._truncate_unloaded(since):
+				keep = [ i for i, block_number in enumerate(self.buffer['block_number']) if block_number < since ]
+				self.buffer = { col: [values[i] for i in keep] for col, values in self.buffer.items() }
+			else:
+				blocks = self.get_dataframe()
+				keep = blocks['block_number'] < since
+				if not keep.all():
+					first_row = int((~keep).to_numpy().argmax())
+					if first_row < self.saved_rows:
+						self._truncate(first_row)
+					self.state['blocks'] = blocks[keep].reset_index(drop=True)
+			self.state['last_scanned_block'] = max(since - 1, 0)
+			self.block_hashes = { block_number: block_hash for block_number, block_hash in self.block_hashes.items() if block_number < since }
 			self.save()
 
-	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
-		"""Record a ERC-20 transfer in our database."""
-		# Events are keyed by their transaction hash and log index
-		# One transaction may contain multiple events
-		# and each one of those gets their own log index
-
-		args = event["args"]
-
-		#print( event.keys() )
-
-		row = { 
-			'event_name': event.event,
-			'contract_address': event.address,
-			'block_number': event.blockNumber, 
-			'txhash': event.transactionHash.hex(), 
-			'log_index': event.logIndex,
-			'timestamp': block_when.isoformat(),
-		}
-
-		extra_cols = list( set( args.keys() ).intersection( self.state['blocks'].columns ).difference( row.keys() ) )
-		if len(extra_cols) > 0:	
-			row.update( { col: args[col] for col in extra_cols } )
-		else:
-			print( "Error: This event didn't match any extra columns in the table" )
-			print( "Are you sure your table has the correct column names?" )
-
-	
-		#print( self.state['blocks'].columns )	
-		#print( pd.DataFrame([row]).columns )
-		self.state['blocks'] = pd.concat( [self.state['blocks'], pd.DataFrame( [row] )] )
-		#self.state['blocks'] = self.state['blocks'].append(row,ignore_index=True)
-
-		# Return a pointer that allows us to look up this event later if needed
-		return f"{event.blockNumber}-{event.transactionHash.hex()}-{event.logIndex}"
-
-class JSONifiedState(EventScannerState):
-	"""Store the state of scanned blocks and all events.
+	def record_block_hash(self, block_number, block_hash):
+		"""Remember the hash of a scanned block, written with the next checkpoint."""
+		self.block_hashes[block_number] = block_hash
+		for old_block in sorted(self.block_hashes)[:-self.max_block_hashes]:
+			del self.block_hashes[old_block]
 
-	All state is an in-memory dict.
-	Simple load/store massive JSON on start up.
-	"""
-
-	def __init__(self):
-		self.state = None
-		self.fname = "test-state.json"
-		# How many second ago we saved the JSON file
-		self.last_save = 0
-
-	def reset(self):
-		"""Create initial state of nothing scanned."""
-		self.state = {
-			"last_scanned_block": 0,
-			"blocks": {},
-		}
-
-	def restore(self):
-		"""Restore the last scan state from a file."""
-		try:
-			self.state = json.load(open(self.fname, "rt"))
-			print(f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
-		except (IOError, json.decoder.JSONDecodeError):
-			print("State starting from scratch")
-			self.reset()
-
-	def save(self):
-		"""Save everything we have scanned so far in a file."""
-		with open(self.fname, "wt") as f:
-			json.dump(self.state, f)
-		self.last_save = time.time()
-
-	#
-	# EventScannerState methods implemented below
-	#
-
-	def get_last_scanned_block(self):
-		"""The number of the last block we have stored."""
-		return self.state["last_scanned_block"]
-
-	def delete_data(self, since_block):
-		"""Remove potentially reorganised blocks from the scan data."""
-		for block_num in range(since_block, self.get_last_scanned_block()):
-			if block_num in self.state["blocks"]:
-				del self.state["blocks"][block_num]
+	def get_block_hashes(self):
+		return self.block_hashes
 
 	def start_chunk(self, block_number, chunk_size):
 		pass
 
 	def end_chunk(self, block_number):
-		"""Save at the end of each block, so we can resume in the case of a crash or CTRL+C"""
+		"""Save at the end of each chunk, so we can resume in the case of a crash or CTRL+C"""
 		# Next time the scanner is started we will resume from this block
 		self.state["last_scanned_block"] = block_number
 
-		# Save the database file for every minute
-		if time.time() - self.last_save > 60:
-			self.save()
+		# Append the rows of the chunk and write the checkpoint atomically, the checkpoint never gets ahead of the file
+		self.save(sync=self.unsynced_chunks + 1 >= self.sync_every)
 
 	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
 		"""Record a ERC-20 transfer in our database."""
@@ -201,35 +376,16 @@ class JSONifiedState(EventScannerState):
 		# One transaction may contain multiple events
 		# and each one of those gets their own log index
 
-		# event_name = event.event # "Transfer"
-		log_index = event.logIndex  # Log index within the block
-		# transaction_index = event.transactionIndex  # Transaction index within the block
-		txhash = event.transactionHash.hex()  # Transaction hash
-		block_number = event.blockNumber
-
-		# Convert ERC-20 Transfer event to our internal format
-		args = event["args"]
-		transfer = {
-			"from": args["from"],
-			"to": args.to,
-			"value": args.value,
-			"timestamp": block_when.isoformat(),
-		}
-
-		# Create empty dict as the block that contains all transactions by txhash
-		if block_number not in self.state["blocks"]:
-			self.state["blocks"][block_number] = {}
+		row = event_row(block_when, event)
 
-		block = self.state["blocks"][block_number]
-		if txhash not in block:
-			# We have not yet recorded any transfers in this transaction
-			# (One transaction may contain multiple events if executed by a smart contract).
-			# Create a tx entry that contains all events by a log index
-			self.state["blocks"][block_number][txhash] = {}
+		extra_cols = [ col for col in event["args"].keys() if col in self.buffer and col not in BASE_COLUMNS ]
+		if len(extra_cols) == 0:
+			print( "Error: This event didn't match any extra columns in the table" )
+			print( "Are you sure your table has the correct column names?" )
 
-		# Record ERC-20 transfer in our database
-		self.state["blocks"][block_number][txhash][log_index] = transfer
+		# Append to the column buffers, columns this event does not have are left empty
+		for col, values in self.buffer.items():
+			values.append( row.get(col) )
 
 		# Return a pointer that allows us to look up this event later if needed
-		return f"{block_number}-{txhash}-{log_index}"
-
+		return f"{row['block_number']}-{row['txhash']}-{row['log_index']}"
@@ -0,0 +1,92 @@
+"""Look up the sender (msg.sender / tx.from) of transactions.
+
+Events do not record who sent the transaction that emitted them.
+Senders are fetched with batched eth_getTransactionByHash calls from a few threads,
+and kept in a persistent txhash -> sender cache so a transaction is only looked up once.
+"""
+
+import csv
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from web3 import Web3
+
+from .rpcbatch import batch_request
+
+logger = logging.getLogger(__name__)
+
+def _normalize_txhash(txhash):
+	txhash = str(txhash).lower()
+	if not txhash.startswith("0x"):
+		txhash = "0x" + txhash
+	return txhash
+
+class SenderCache:
+	"""Persistent txhash -> sender mapping, stored as an append-only csv."""
+
+	def __init__(self, fname="data/tx_senders.csv"):
+		self.fname = fname
+		self.senders = {}
+		self.lock = threading.Lock()
+		if os.path.exists(fname):
+			with open(fname, "rt", newline="") as f:
+				for row in csv.reader(f):
+					if len(row) == 2:
+						self.senders[row[0]] = row[1]
+
+	def get(self, txhash):
+		return self.senders.get(_normalize_txhash(txhash))
+
+	def update(self, senders):
+		"""Add a dict of txhash: sender and append it to the file."""
+		with self.lock:
+			new = { txhash: sender for txhash, sender in senders.items() if txhash not in self.senders }
+			self.senders.update(new)
+			dirname = os.path.dirname(self.fname)
+			if dirname:
+				os.makedirs(dirname, exist_ok=True)
+			with open(self.fname, "at", newline="") as f:
+				csv.writer(f).writerows(new.items())
+
+def resolve_senders(web3, txhashes, cache=None, workers=4, batch_size=100):
+	"""Get the senders of many transactions.
+
+	Each distinct transaction is looked up once, cached ones not at all.
+
+	:param txhashes: Iterable of transaction hashes, duplicates are fine
+	:param cache: Optional SenderCache
+	:param workers: How many batch requests are in flight at the same time
+	:param batch_size: How many transactions we ask for in one batch request
+	:return: Dict of txhash (as given): sender, None for transactions we could not get
+	"""
+	given = { txhash: _normalize_txhash(txhash) for txhash in set(txhashes) }
+
+	found = {}
+	for txhash in set(given.values()):
+		sender = cache.get(txhash) if cache is not None else None
+		if sender is not None:
+			found[txhash] = sender
+
+	missing = sorted(set(given.values()) - found.keys())
+	batches = [ missing[i:i + batch_size] for i in range(0, len(missing), batch_size) ]
+
+	def fetch(batch):
+		try:
+			txs = batch_request(web3, "eth_getTransactionByHash", [[txhash] for txhash in batch], batch_size=batch_size)
+		except Exception as e:
+			logger.warning("Failed to get %d transactions: %s", len(batch), e)
+			return {}
+		senders = { txhash: Web3.to_checksum_address(tx["from"]) for txhash, tx in zip(batch, txs) if tx is not None }
+		if cache is not None:
+			cache.update(senders)
+		return senders
+
+	if batches:
+		logger.info("Looking up the senders of %d transactions", len(missing))
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			for senders in executor.map(fetch, batches):
+				found.update(senders)
+
+	return { txhash: found.get(normalized) for txhash, normalized in given.items() }
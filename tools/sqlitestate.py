@@ -0,0 +1,231 @@
+"""Scanner state that stores events in a SQLite database.
+
+Each scanned chunk is written in a single transaction, opened in `start_chunk` and committed in `end_chunk`
+together with the last scanned block, so the database never holds half a chunk.
+"""
+
+from .eventscanner import EventScannerState
+from .rows import event_row, BASE_COLUMNS
+
+import datetime
+import logging
+import re
+import sqlite3
+
+from web3.datastructures import AttributeDict
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def _quote(name):
+	"""Quote a column name, event arguments can be SQL keywords like from and to"""
+	return '"' + name.replace('"', '""') + '"'
+
+def _sql_type(abi_type):
+	"""SQLite column type used to store an ABI type.
+
+	SQLite integers are 64 bit, wider integers are stored as decimal strings so they are not rounded.
+	"""
+	m = re.match(r"^u?int(\d*)$", abi_type)
+	if m:
+		bits = int(m.group(1) or 256)
+		if bits < 64 or (bits == 64 and not abi_type.startswith("u")):
+			return "INTEGER"
+		return "TEXT"
+	if abi_type == "bool":
+		return "INTEGER"
+	return "TEXT"
+
+def load_events(fname, event_names=None, columns=None, start_block=None, end_block=None):
+	"""Load events from a database written by SQLiteState as a DataFrame.
+
+	Only the requested events, columns and blocks are read, using the (event_name, block_number) index.
+	"""
+	where = []
+	params = []
+	if event_names is not None:
+		where.append( "event_name IN (" + ",".join("?" * len(event_names)) + ")" )
+		params += list(event_names)
+	if start_block is not None:
+		where.append( "block_number >= ?" )
+		params.append(start_block)
+	if end_block is not None:
+		where.append( "block_number <= ?" )
+		params.append(end_block)
+
+	select = "*" if columns is None else ",".join(_quote(col) for col in columns)
+	query = f"SELECT {select} FROM events"
+	if len(where) > 0:
+		query += " WHERE " + " AND ".join(where)
+	query += " ORDER BY block_number, log_index"
+
+	conn = sqlite3.connect(fname)
+	try:
+		return pd.read_sql_query(query, conn, params=params)
+	finally:
+		conn.close()
+
+class SQLiteState(EventScannerState):
+	"""Store the state of scanned blocks and all events in a SQLite database.
+
+	Events go to one `events` table with a column per event argument,
+	indexed by (event_name, block_number), txhash, contract address and every address argument.
+	"""
+
+	base_columns = [
+		("event_name", "TEXT"),
+		("contract_address", "TEXT"),
+		("block_number", "INTEGER"),
+		("txhash", "TEXT"),
+		("log_index", "INTEGER"),
+		("timestamp", "TEXT"),
+	]
+
+	def __init__(self, fname, event_types):
+		"""
+		:param fname: Database file
+		:param event_types: Dict of event name: list of (argument name, ABI type), see utils.get_event_types
+		"""
+		self.fname = fname
+		self.event_types = event_types
+		self.conn = None
+		self.last_scanned_block = 0
+
+		# One column per argument name, the first event that uses a name decides its type
+		self.arg_columns = {}
+		for args in event_types.values():
+			for name, abi_type in args:
+				if name not in self.arg_columns and name not in dict(self.base_columns):
+					self.arg_columns[name] = abi_type
+
+	def _connect(self):
+		if self.conn is None:
+			# Autocommit mode, transactions are opened explicitly per chunk
+			self.conn = sqlite3.connect(self.fname, isolation_level=None)
+			self.conn.execute("PRAGMA journal_mode=WAL")
+			self._create_tables()
+		return self.conn
+
+	def _create_tables(self):
+		columns = self.base_columns + [ (name, _sql_type(abi_type)) for name, abi_type in self.arg_columns.items() ]
+		self.conn.execute("CREATE TABLE IF NOT EXISTS scan_state (key TEXT PRIMARY KEY, value INTEGER)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS block_hashes (block_number INTEGER PRIMARY KEY, hash TEXT)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS events (" +
+			", ".join(f"{_quote(name)} {sql_type}" for name, sql_type in columns) +
+			", UNIQUE (block_number, log_index))")
+
+		# Event arguments we did not know about when the table was created
+		existing = [ row[1] for row in self.conn.execute("PRAGMA table_info(events)") ]
+		for name, sql_type in columns:
+			if name not in existing:
+				self.conn.execute(f"ALTER TABLE events ADD COLUMN {_quote(name)} {sql_type}")
+
+		self.conn.execute("CREATE INDEX IF NOT EXISTS events_event_name_block ON events (event_name, block_number)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS events_txhash ON events (txhash)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS events_contract_address ON events (contract_address)")
+		for name, abi_type in self.arg_columns.items():
+			if abi_type == "address":
+				index_name = "events_" + re.sub(r"\W", "_", name)
+				self.conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote(index_name)} ON events ({_quote(name)})")
+
+	def _set_last_scanned_block(self, block_number):
+		self.last_scanned_block = block_number
+		self.conn.execute("INSERT OR REPLACE INTO scan_state (key, value) VALUES ('last_scanned_block', ?)", (block_number,))
+
+	def reset(self):
+		"""Create initial state of nothing scanned."""
+		conn = self._connect()
+		conn.execute("DELETE FROM events")
+		conn.execute("DELETE FROM block_hashes")
+		self._set_last_scanned_block(0)
+
+	def restore(self):
+		"""Restore the last scan state from the database."""
+		conn = self._connect()
+		row = conn.execute("SELECT value FROM scan_state WHERE key = 'last_scanned_block'").fetchone()
+		if row is None:
+			print("State starting from scratch")
+			self.reset()
+			return
+		self.last_scanned_block = row[0]
+		print(f"Restored the state, previously {self.last_scanned_block} blocks have been scanned")
+
+	def save(self):
+		"""Commit anything written outside of a chunk."""
+		if self.conn is not None and self.conn.in_transaction:
+			self.conn.execute("COMMIT")
+
+	def close(self):
+		self.save()
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+	#
+	# EventScannerState methods implemented below
+	#
+
+	def get_last_scanned_block(self):
+		"""The number of the last block we have stored."""
+		return self.last_scanned_block
+
+	def delete_data(self, since_block):
+		"""Remove potentially reorganised blocks from the scan data."""
+		since = max(since_block,0)
+		if since <= self.get_last_scanned_block():
+			conn = self._connect()
+			conn.execute("BEGIN")
+			conn.execute("DELETE FROM events WHERE block_number >= ?", (since,))
+			conn.execute("DELETE FROM block_hashes WHERE block_number >= ?", (since,))
+			self._set_last_scanned_block(max(since - 1, 0))
+			conn.execute("COMMIT")
+
+	def record_block_hash(self, block_number, block_hash):
+		"""Remember the hash of a scanned block, committed with the chunk."""
+		conn = self._connect()
+		conn.execute("INSERT OR REPLACE INTO block_hashes (block_number, hash) VALUES (?, ?)", (block_number, block_hash))
+		conn.execute("DELETE FROM block_hashes WHERE block_number <= (SELECT block_number FROM block_hashes ORDER BY block_number DESC LIMIT 1 OFFSET ?)",
+			(self.max_block_hashes,))
+
+	def get_block_hashes(self):
+		return dict(self._connect().execute("SELECT block_number, hash FROM block_hashes"))
+
+	def start_chunk(self, block_number, chunk_size):
+		"""Open the transaction that holds all events of this chunk."""
+		conn = self._connect()
+		if not conn.in_transaction:
+			conn.execute("BEGIN")
+
+	def end_chunk(self, block_number):
+		"""Commit the chunk together with the last scanned block, so we can resume in the case of a crash or CTRL+C"""
+		conn = self._connect()
+		if not conn.in_transaction:
+			conn.execute("BEGIN")
+		self._set_last_scanned_block(block_number)
+		conn.execute("COMMIT")
+
+	def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+		"""Insert an event into the events table."""
+		row = event_row(block_when, event)
+		for name in event["args"]:
+			if name in BASE_COLUMNS:
+				continue
+			if name not in self.arg_columns:
+				del row[name]
+				continue
+			value = row[name]
+			if isinstance(value, bool):
+				value = int(value)
+			elif isinstance(value, int):
+				if _sql_type(self.arg_columns[name]) == "TEXT":
+					value = str(value)
+			elif not isinstance(value, str):
+				value = str(value)
+			row[name] = value
+
+		self._connect().execute(
+			"INSERT OR REPLACE INTO events (" + ",".join(_quote(col) for col in row) + ") VALUES (" + ",".join("?" * len(row)) + ")",
+			list(row.values()))
+
+		# Return a pointer that allows us to look up this event later if needed
+		return f"{row['block_number']}-{row['txhash']}-{row['log_index']}"
@@ -5,17 +5,19 @@ Utilities for getting contract ABIs from Etherscan and caching them locally
 import requests
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 #from web3 import Web3
 import os
 
 ABI_ENDPOINT = 'https://api.etherscan.io/api?module=contract&action=getabi&address='
 
-if not os.path.exists('abis'):
-    os.makedirs('abis')
+_abi_dir = "abis" #One <address>.json file per contract
+_cache_file = "abis/cached_abis.json" #Old single file cache, still read but no longer written
 
-_cache_file = "abis/cached_abis.json"
-
-_cache = dict() #Dictionary of address: abi pairs
+_cache = dict() #Dictionary of address: abi pairs, shared by every caller in the process
+_legacy_cache = None #Contents of _cache_file, loaded on first miss
+_cache_lock = threading.Lock()
 
 def fetch_abi(contract_address,retry=0):
 	"""
@@ -35,7 +37,7 @@ def fetch_abi(contract_address,retry=0):
 			print( f"Failed to get abi" )
 			return None
 	except Exception as e:
-		print( f"Failed to get {address} from {ABI_ENDPOINT}" )
+		print( f"Failed to get {contract_address} from {ABI_ENDPOINT}" )
 		print( e )
 		return None
 
@@ -57,24 +59,53 @@ def fetch_abi(contract_address,retry=0):
 	#print( type( abi_json[0] ) ) #dict
 	return abi_json
 
+def _abi_key(contract_address):
+	#Addresses are case insensitive, so checksummed and lowercase lookups share an entry
+	return contract_address.lower()
+
+def _abi_fname(key):
+	return os.path.join(_abi_dir, f"{key}.json")
+
+def _read_abi_file(key):
+	global _legacy_cache
+	try:
+		with open(_abi_fname(key)) as f:
+			return json.load(f)
+	except (IOError, json.decoder.JSONDecodeError):
+		pass
+
+	if _legacy_cache is None:
+		try:
+			with open(_cache_file) as f:
+				_legacy_cache = { _abi_key(k): v for k, v in json.load(f).items() }
+		except Exception as e:
+			_legacy_cache = dict()
+	return _legacy_cache.get(key)
+
+def _write_abi_file(key,abi):
+	"""
+	Write one abi to its own file
+	The file is written under a temporary name and renamed, so concurrent scanners never see half a file
+	"""
+	os.makedirs(_abi_dir, exist_ok=True)
+	fname = _abi_fname(key)
+	tmp_fname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(tmp_fname, 'w') as outfile:
+		json.dump(abi, outfile)
+	os.replace(tmp_fname, fname)
+
 def set_abi(contract_address,abi,overwrite=True):
 	"""
 	Explicitly add a contract's abi to the cache
 	"""
-	try:
-		with open(_cache_file) as f:
-			_cache = json.load(f)
-	except Exception as e:
-		_cache = dict()
-	
-	if contract_address not in _cache.keys() or overwrite:
-		_cache[contract_address] = abi	
-		with open(_cache_file, 'w') as outfile:
-			json.dump(_cache, outfile,indent=2)
-	else:
-		print( f"abi already exists" )
-		
-
+	key = _abi_key(contract_address)
+	with _cache_lock:
+		if key in _cache or _read_abi_file(key) is not None:
+			if not overwrite:
+				print( f"abi already exists" )
+				return
+		_cache[key] = abi
+		_write_abi_file(key,abi)
 
 def get_cached_abi(contract_address,abikw=""):
 	"""
@@ -82,29 +113,84 @@ def get_cached_abi(contract_address,abikw=""):
 	If so, return it
 	If not, fetch it from Etherscan
 	"""
-
-	try:
-		with open(_cache_file) as f:
-			_cache = json.load(f)
-	except Exception as e:
-		_cache = dict()
-	
 	if abikw:
 		search_for = abikw
 	else:
 		search_for = contract_address
-	
-	abi = _cache.get(search_for)
+	key = _abi_key(search_for)
 
-	if not abi:
-		abi = fetch_abi(search_for)
-		if abi is not None:
-			_cache[search_for] = abi
-			with open(_cache_file, 'w') as outfile:
-				json.dump(_cache, outfile,indent=2)
+	abi = _cache.get(key)
+	if abi:
+		return abi
+
+	with _cache_lock:
+		abi = _read_abi_file(key)
+		if abi:
+			_cache[key] = abi
+			return abi
+
+	abi = fetch_abi(search_for)
+	if abi is not None:
+		with _cache_lock:
+			_cache[key] = abi
+			_write_abi_file(key,abi)
 		
 	return abi
 
+class _RateLimiter:
+	"""
+	Space out calls so that at most `rate` of them start per second, across threads
+	"""
+	def __init__(self,rate):
+		self.interval = 1.0 / rate
+		self.next_call = 0
+		self.lock = threading.Lock()
+
+	def wait(self):
+		with self.lock:
+			now = time.monotonic()
+			start = max(now, self.next_call)
+			self.next_call = start + self.interval
+		if start > now:
+			time.sleep(start - now)
+
+def prefetch_abis(contract_addresses,workers=4,rate=5):
+	"""
+	Get the abis of many contracts at once
+	Cached abis are read from disk, the rest are fetched from Etherscan by `workers` threads
+	with at most `rate` requests per second (the Etherscan free tier allows 5)
+	Returns a dictionary of address: abi, None if the abi could not be fetched
+	"""
+	abis = dict()
+	missing = []
+	for address in contract_addresses:
+		key = _abi_key(address)
+		abi = _cache.get(key)
+		if not abi:
+			with _cache_lock:
+				abi = _read_abi_file(key)
+				if abi:
+					_cache[key] = abi
+		if abi:
+			abis[address] = abi
+		elif address not in missing:
+			missing.append(address)
+
+	limiter = _RateLimiter(rate)
+	def fetch(address):
+		limiter.wait()
+		return fetch_abi(address)
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for address, abi in zip(missing, pool.map(fetch, missing)):
+			abis[address] = abi
+			if abi is not None:
+				with _cache_lock:
+					_cache[_abi_key(address)] = abi
+					_write_abi_file(_abi_key(address),abi)
+
+	return abis
+
 def create_contract(web3,address):
 	"""
 	Take an address and return a contract object referring to the contract at that address
@@ -144,48 +230,134 @@ def get_event_args(contract_address,target_events='all',abikw=''):
 
 	return event_names, event_args
 
-def get_proxy_address(web3,address):
+def get_event_types(contract_address,target_events='all',abikw=''):
+	"""
+	Get the (name, type) pairs of the arguments of each event in the ABI
+	"""
+	abi = get_cached_abi(contract_address,abikw)
+
+	events = [obj for obj in abi if obj['type'] == 'event' ]
+	if target_events != 'all':
+		events = [e for e in events if e['name'] in target_events]
+
+	return { e['name']: [ (inp['name'],inp['type']) for inp in e['inputs'] ] for e in events }
+
+_proxy_dir = "abis/proxies" #One <address>.json file per resolved contract
+
+_proxy_storage_locations = [
+	"0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc", 	#hex(int( Web3.keccak(text='eip1967.proxy.implementation').hex(), 16 ) - 1)   https://eips.ethereum.org/EIPS/eip-1967
+	"0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50",	#hex(int( Web3.keccak(text='eip1967.proxy.beacon').hex(), 16 ) - 1)   https://eips.ethereum.org/EIPS/eip-1967
+	"0x7050c9e0f4ca769c69bd3a8ef740bc37934f8e2c036e5a723fd8ee048ed3f8c3",	#Web3.keccak(text='org.zeppelinos.proxy.implementation').hex()    https://github.com/OpenZeppelin/openzeppelin-labs/blob/master/initializer_with_sol_editing/contracts/UpgradeabilityProxy.sol
+	"0xc5f16f0fcc639fa48a6947836d9850f504798523bf8c9a3a87d5876cf622bcf7",	#Web3.keccak(text='PROXIABLE').hex() https://eips.ethereum.org/EIPS/eip-1822
+	"0x5f3b5dfeb7b28cdbd7faba78963ee202a494e2a2cc8c9978d5e30d2aebb8c197" ] #Recommended by TrueBlocks https://github.com/TrueBlocks/trueblocks-core/blob/develop/src/libs/etherlib/ethcall.cpp#L540
+_beacon_storage_location = "0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50"
+
+def _read_proxy_cache(address):
+	try:
+		with open(os.path.join(_proxy_dir, f"{_abi_key(address)}.json")) as f:
+			return json.load(f)
+	except (IOError, json.decoder.JSONDecodeError):
+		return None
+
+def _write_proxy_cache(address,entry):
+	os.makedirs(_proxy_dir, exist_ok=True)
+	fname = os.path.join(_proxy_dir, f"{_abi_key(address)}.json")
+	tmp_fname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(tmp_fname, 'w') as outfile:
+		json.dump(entry, outfile)
+	os.replace(tmp_fname, fname)
+
+def _upgraded_since(web3,entry,address):
+	"""
+	Check for Upgraded or BeaconUpgraded events since the block the cached entry was resolved at
+	For beacon proxies the beacon emits Upgraded when it points to a new implementation, so we watch it too
+	Returns True if the proxy may point elsewhere now and has to be resolved again
+	Otherwise the entry's block is moved up to the head we checked, so the next check only covers the blocks after it
+	"""
+	addresses = [address]
+	if entry.get("beacon"):
+		addresses.append(entry["beacon"])
+	topics = [ web3.to_hex(web3.keccak(text=sig)) for sig in ["Upgraded(address)", "BeaconUpgraded(address)"] ]
+	try:
+		head = web3.eth.block_number
+		if head <= entry["block"]:
+			return False
+		#An explicit toBlock, with "latest" the head could move between the call and the block we record
+		logs = web3.eth.get_logs({ "address": addresses, "topics": [topics], "fromBlock": entry["block"] + 1, "toBlock": head })
+	except Exception as e:
+		print( f"Error in get_proxy_address: Failed to check {address} for upgrades" )
+		print( e )
+		return True
+	if len(logs) > 0:
+		return True
+	entry["block"] = head
+	return False
+
+def _resolve_proxy(web3,address):
+	"""
+	Read all the known implementation slots of a contract in one JSON-RPC batch
+	Returns a cache entry: the implementation address (the address itself if it is not a proxy), the beacon if any and the block it was read at
+	"""
+	from tools.rpcbatch import batch_request
+
+	block = web3.eth.block_number
+	entry = { "implementation": address, "beacon": None, "block": block }
+	try:
+		values = batch_request(web3, "eth_getStorageAt", [ [address, p, hex(block)] for p in _proxy_storage_locations ])
+	except Exception as e:
+		print(f"Error in get_proxy_address: Failed to read storage of {address}" )
+		print( e )
+		return None
+
+	for p, value in zip(_proxy_storage_locations, values):
+		if value is None:
+			continue
+		addr = value[-40:] #Last 20 bytes (40 hex chars) is the address
+		if int(addr,16) == 0:
+			continue
+		addr = web3.to_checksum_address("0x" + addr)
+		if p == _beacon_storage_location: #Beacon proxy https://eips.ethereum.org/EIPS/eip-1967
+			entry["beacon"] = addr
+			try:
+				beacon_abi = '[{"inputs":[],"name":"implementation","outputs":[{"internalType":"address","name":"","type":"address"}],"stateMutability":"view","type":"function"}]'
+				contract = web3.eth.contract(address=addr,abi=beacon_abi)
+				impl = contract.functions.implementation().call(block_identifier=block)
+				if impl is not None and int(impl,16) != 0:
+					addr = web3.to_checksum_address(impl)
+			except Exception as e:
+				print( f"Error getting beacon implementation" )
+				print( f"{addr}" )
+				print( f"{beacon_abi}" )
+				print( e )
+		entry["implementation"] = addr
+		break
+	return entry
+
+def get_proxy_address(web3,address,use_cache=True):
 	"""
 		Check if a contract is a proxy, and if so, return the address of the underlying implementation
+		The result is cached per address in abis/proxies along with the block it was read at,
+		and only read again if the proxy (or its beacon) emitted an Upgraded event since then
 	"""
-	storage_locations = [
-		"0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc", 	#hex(int( Web3.keccak(text='eip1967.proxy.implementation').hex(), 16 ) - 1)   https://eips.ethereum.org/EIPS/eip-1967
-		"0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50",	#hex(int( Web3.keccak(text='eip1967.proxy.beacon').hex(), 16 ) - 1)   https://eips.ethereum.org/EIPS/eip-1967
-		"0x7050c9e0f4ca769c69bd3a8ef740bc37934f8e2c036e5a723fd8ee048ed3f8c3",	#Web3.keccak(text='org.zeppelinos.proxy.implementation').hex()    https://github.com/OpenZeppelin/openzeppelin-labs/blob/master/initializer_with_sol_editing/contracts/UpgradeabilityProxy.sol
-		"0xc5f16f0fcc639fa48a6947836d9850f504798523bf8c9a3a87d5876cf622bcf7",	#Web3.keccak(text='PROXIABLE').hex() https://eips.ethereum.org/EIPS/eip-1822
-		"0x5f3b5dfeb7b28cdbd7faba78963ee202a494e2a2cc8c9978d5e30d2aebb8c197" ] #Recommended by TrueBlocks https://github.com/TrueBlocks/trueblocks-core/blob/develop/src/libs/etherlib/ethcall.cpp#L540
-	addr = None
-	for p in storage_locations:
-		try:
-			addr = web3.eth.get_storage_at(address,p) #Returns 32 bytes
-			addr = addr.hex() 
-			addr = "0x" + addr[-40:] #Last 20 bytes (40 hex chars) is the address
-			addr = web3.to_checksum_address(addr)
-		except Exception as e:
-			addr = None
-			print(f"Error in get_proxy_address: Failed to read address at location {p}" )
-			print( e )
-		if addr is not None and int(addr,16) != 0:
-			if p == "0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50": #Beacon proxy https://eips.ethereum.org/EIPS/eip-1967
-				try:
-					beacon_abi = '[{"inputs":[],"name":"implementation","outputs":[{"internalType":"address","name":"","type":"address"}],"stateMutability":"view","type":"function"}]'
-					contract = web3.eth.contract(address=addr,abi=beacon_abi)
-					impl = contract.functions.implementation().call()
-					if impl is not None and int(impl,16) != 0:
-						addr = web3.to_checksum_address(impl)
-				except Exception as e:
-					print( f"Error getting beacon implementation" )
-					print( f"{addr}" )
-					print( f"{beacon_abi}" )
-					print( e )
-			break
-
-	if addr is None or int(addr,16) == 0:
-		addr = address #Contract was not a proxy, so we return the original address
-	else:
+	entry = _read_proxy_cache(address) if use_cache else None
+	checked_block = entry["block"] if entry is not None else None
+	resolved = False
+	if entry is None or _upgraded_since(web3,entry,address):
+		entry = _resolve_proxy(web3,address)
+		if entry is None:
+			return address
+		_write_proxy_cache(address,entry)
+		resolved = True
+	elif entry["block"] != checked_block:
+		#No upgrade up to the head, remember how far we checked
+		_write_proxy_cache(address,entry)
+
+	addr = entry["implementation"]
+	if int(addr,16) != int(address,16) and (resolved or _read_abi_file(_abi_key(address)) is None):
 		#Cache the abi
 		abi = get_cached_abi(addr)
-		set_abi(address,abi) #Record this as the abi for the *original* address so future calls to get_cached_abi will get it
+		if abi is not None:
+			set_abi(address,abi) #Record this as the abi for the *original* address so future calls to get_cached_abi will get it
 
 	return addr
 